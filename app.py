@@ -1,24 +1,81 @@
-from flask import Flask, render_template, request, jsonify, session, make_response
+import os
+import sys
+
+# ============= ASYNC MODE =============
+# threading: servidor de desarrollo de Werkzeug (un hilo por conexión).
+# eventlet / gevent: servidor de green threads para producción. El monkey patch
+# tiene que aplicarse antes de importar cualquier módulo que use sockets o hilos
+# (flask, mysql.connector, smtplib...), por eso el modo se resuelve aquí arriba.
+ASYNC_MODES = ('threading', 'eventlet', 'gevent')
+
+def resolve_async_mode(argv):
+    """--mode from the command line, else CUIX_ASYNC_MODE, else threading"""
+    mode = os.environ.get('CUIX_ASYNC_MODE', 'threading')
+    for i, arg in enumerate(argv):
+        if arg == '--mode' and i + 1 < len(argv):
+            mode = argv[i + 1]
+        elif arg.startswith('--mode='):
+            mode = arg.split('=', 1)[1]
+    return mode if mode in ASYNC_MODES else 'threading'
+
+# Importado por un servidor externo (gunicorn) sys.argv no es nuestro: solo cuenta la variable de entorno
+ASYNC_MODE = resolve_async_mode(sys.argv[1:] if __name__ == '__main__' else [])
+
+if ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, render_template, request, jsonify, session, make_response, send_file
 from flask_socketio import SocketIO, emit, send, join_room, leave_room
 import uuid
 import json
 import logging
 import time
-from datetime import datetime
-import sys
-import os
+from datetime import datetime, timedelta, timezone
 import sqlite3
 import threading
+import queue
+import argparse
+import functools
+import bisect
+import csv
+import atexit
+from types import MappingProxyType
+from collections import deque, OrderedDict, namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import copy
 import mysql.connector
+try:
+    import redis
+except ImportError:
+    redis = None
+try:
+    import yaml
+except ImportError:
+    yaml = None
 from mysql.connector import pooling
 import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.image import MIMEImage
-from email.utils import formataddr
+from email.header import Header
+from email.utils import formataddr, formatdate, make_msgid
+from urllib.parse import quote
+import urllib.request
+import tempfile
+import io
 import base64
 import hashlib
+import hmac
+import mimetypes
+import re
+import random
 import secrets
+import unicodedata
+import codecs
+import imaging
 
 # Configure logging first
 logging.basicConfig(
@@ -36,485 +93,2257 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = 'funko-live-chat-secret-key-2026'
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
+CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
+
+# ============= SETTINGS =============
+DEFAULT_SETTINGS = {'email_enabled': True, 'email_destinatarios': 'cuicuix.studio@gmail.com'}
+
+# Claves que acepta /api/admin/settings: tipo y mínimo (números) u opciones válidas.
+# Muchas se leen con int()/float() al importar; un valor inválido impediría arrancar.
+# En caliente se aplican email_*, smtp_* (salvo smtp_pool_size) y trace_sample_rate /
+# trace_slow_ms; las demás se leen al arrancar y requieren reiniciar el servidor
+SETTINGS_SCHEMA = {
+    'email_enabled': (bool, None),
+    'email_destinatarios': (str, None),
+    'email_max_bytes': (int, 1024),
+    'email_spool_memory': (int, 0),
+    'default_language': (str, None),
+    'message_queue': ((str, type(None)), None),
+    'mysql_pool_size': (int, 1),
+    'mysql_checkout_timeout': (float, 0),
+    'mysql_retry_interval': (float, 0),
+    'chat_flush_interval': (float, 0.01),
+    'chat_flush_max_pending': (int, 1),
+    'summary_cache_size': (int, 1),
+    'intent_memo_size': (int, 1),
+    'session_backend': (str, ('memory', 'redis')),
+    'session_redis_url': (str, None),
+    'session_ttl': (int, 1),
+    'session_max_sessions': (int, 1),
+    'session_max_bytes': (int, 1),
+    'upload_chunk_size': (int, 1024),
+    'upload_max_bytes': (int, 1),
+    'upload_ttl': (int, 1),
+    'image_max_edge': (int, 16),
+    'image_thumb_edge': (int, 16),
+    'image_quality': (int, 1),
+    'image_workers': (int, 1),
+    'smtp_server': (str, None),
+    'smtp_port': (int, 1),
+    'smtp_security': (str, ('ssl', 'starttls', 'none')),
+    'smtp_username': (str, None),
+    'smtp_password': (str, None),
+    'smtp_from': (str, None),
+    'smtp_timeout': (float, 0.1),
+    'smtp_pool_size': (int, 1),
+    'smtp_checkout_timeout': (float, 0),
+    'smtp_keepalive': (float, 1),
+    'smtp_max_idle': (float, 1),
+    'smtp_max_messages': (int, 1),
+    'funnel_buffer_size': (int, 1),
+    'funnel_flush_interval': (float, 0.1),
+    'funnel_abandon_after': (int, 1),
+    'trace_sample_rate': (float, 0),
+    'trace_slow_ms': (float, 0),
+    'trace_file': (str, None),
+    'trace_otlp_endpoint': ((str, type(None)), None),
+    'admin_token_secret': (str, None),
+    'admin_token_ttl': (int, 60)
+}
+
+# Nunca salen por GET /api/admin/settings; el marcador devuelto en su lugar se ignora al guardar
+SECRET_SETTINGS = ('smtp_password', 'admin_token_secret')
+SETTINGS_REDACTED = '***'
+
+def redact_settings(values):
+    return {key: SETTINGS_REDACTED if key in SECRET_SETTINGS and value else value for key, value in values.items()}
+
+def validate_settings(changes):
+    """Errors for settings the app could not load back (unknown key, wrong type or range)"""
+    if not isinstance(changes, dict):
+        return ['settings must be a JSON object']
+    errors = []
+    for key, value in changes.items():
+        if key not in SETTINGS_SCHEMA:
+            errors.append(f"{key}: unknown setting")
+            continue
+        kind, rule = SETTINGS_SCHEMA[key]
+        accepted = (int, float) if kind is float else kind
+        # bool es subclase de int: True no es un tamaño de pool válido
+        if not isinstance(value, accepted) or (isinstance(value, bool) and kind is not bool):
+            errors.append(f"{key}: invalid type {type(value).__name__}")
+        elif isinstance(rule, tuple) and value not in rule:
+            errors.append(f"{key}: expected one of {', '.join(rule)}")
+        elif isinstance(rule, (int, float)) and value < rule:
+            errors.append(f"{key}: must be >= {rule}")
+    return errors
+
+class SettingsService:
+    """In-memory snapshot of config.json.
+
+    Reads are served from the snapshot; at most every ``check_interval``
+    seconds a read stats the file and reparses it if the mtime changed, so
+    edits made by hand or by another worker process are picked up without
+    a restart. update() merges, writes a temp file, fsyncs and renames it
+    over config.json, so a crash never leaves a truncated file behind.
+    Components that cache derived values subscribe() to be told when keys
+    change.
+    """
+
+    def __init__(self, path, defaults=None, check_interval=2.0):
+        self.path = path
+        self.defaults = dict(defaults or {})
+        self.check_interval = check_interval
+        self._values = {}
+        self._mtime = None
+        self._checked_at = 0
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self._reload()
+
+    def get(self, key, default=None):
+        self.refresh()
+        if key in self._values:
+            return self._values[key]
+        return self.defaults.get(key, default)
+
+    def as_dict(self):
+        """Defaults overlaid with the file contents (a copy)"""
+        self.refresh()
+        return {**self.defaults, **self._values}
+
+    def refresh(self, force=False):
+        """Reload config.json if its mtime changed (throttled unless force)"""
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime != self._mtime:
+            self._reload()
+
+    def update(self, changes):
+        """Merge changes into config.json atomically and publish them"""
+        with self._lock:
+            self.refresh(force=True)
+            values = {**self._values, **changes}
+            directory = os.path.dirname(self.path)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(values, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            try:
+                dir_fd = os.open(directory, os.O_RDONLY)
+                try:
+                    os.fsync(dir_fd)
+                finally:
+                    os.close(dir_fd)
+            except OSError:
+                pass  # sin fsync de directorios (p. ej. Windows)
+            self._apply(values, os.stat(self.path).st_mtime_ns)
+
+    def subscribe(self, callback):
+        """callback(settings, changed_keys) after every change"""
+        self._subscribers.append(callback)
+
+    def _reload(self):
+        with self._lock:
+            try:
+                with open(self.path, 'r') as f:
+                    mtime = os.fstat(f.fileno()).st_mtime_ns
+                    values = json.load(f)
+            except FileNotFoundError:
+                values, mtime = {}, None
+            except Exception as e:
+                # Archivo a medio editar o inválido: se conserva el snapshot anterior
+                logger.error(f"Error loading settings: {e}")
+                return
+            self._apply(values, mtime)
+
+    def _apply(self, values, mtime):
+        old = self._values
+        self._values = values
+        self._mtime = mtime
+        changed = {key for key in set(old) | set(values) if old.get(key) != values.get(key)}
+        if changed:
+            for callback in list(self._subscribers):
+                try:
+                    callback(self, changed)
+                except Exception as e:
+                    logger.error(f"Error in settings subscriber {callback}: {e}")
+
+app_settings = SettingsService(CONFIG_PATH, DEFAULT_SETTINGS)
+
+# Con varios procesos/nodos los emit pasan por una cola compartida (redis://...)
+# para que lleguen a clientes conectados a cualquier worker
+MESSAGE_QUEUE = os.environ.get('CUIX_MESSAGE_QUEUE', app_settings.get('message_queue')) or None
+
+def connect_redis(url, purpose):
+    """Redis client for url, or None (with a warning) if it cannot be used"""
+    if redis is None:
+        logger.warning(f"redis package is not installed, {purpose} stays in process memory")
+        return None
+    try:
+        client = redis.Redis.from_url(url)
+        client.ping()
+        logger.info(f"{purpose} using Redis at {url}")
+        return client
+    except Exception as e:
+        logger.warning(f"Redis not available for {purpose}, using process memory: {e}")
+        return None
+
 # Configure SocketIO
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE, message_queue=MESSAGE_QUEUE)
+
+# ============= METRICS =============
+# Métricas en memoria por proceso, expuestas en /metrics con el formato de
+# texto de Prometheus. Con --processes > 1 cada worker se scrapea en su puerto.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536, 262144, 1048576)
+
+def _label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base of Counter/Gauge/Histogram: one value per tuple of label values"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry or metrics_registry).register(self)
+
+    def _labels(self, labelvalues, extra=()):
+        pairs = list(zip(self.labelnames, labelvalues)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_label_value(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        with self._lock:
+            return [(self.name + self._labels(labels), value) for labels, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(f"{name} {_format_value(value)}" for name, value in self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+class Gauge(Metric):
+    """Set directly, or computed at scrape time by ``callback`` returning
+    {label values tuple: value}"""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.callback = callback
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def samples(self):
+        if self.callback is not None:
+            try:
+                values = self.callback()
+            except Exception as e:
+                logger.error(f"Error collecting metric {self.name}: {e}")
+                return []
+            with self._lock:
+                self._values = dict(values)
+        return super().samples()
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                # [conteo por bucket (no acumulado)..., +Inf, suma]
+                state = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labelvalues)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((labels, list(state)) for labels, state in self._values.items())
+        samples = []
+        for labels, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                samples.append((self.name + '_bucket' + self._labels(labels, [('le', _format_value(bound))]), cumulative))
+            samples.append((self.name + '_sum' + self._labels(labels), state[-1]))
+            samples.append((self.name + '_count' + self._labels(labels), cumulative))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self._metrics) + '\n'
+
+metrics_registry = MetricsRegistry()
+
+def call_site(depth=2):
+    """Name of the function ``depth`` frames above the caller (metric label)"""
+    try:
+        return sys._getframe(depth + 1).f_code.co_name
+    except ValueError:
+        return 'unknown'
+
+SOCKET_EVENT_SECONDS = Histogram('cuix_socketio_event_seconds', 'Socket.IO handler latency by event', ['event'])
+SOCKET_EVENT_ERRORS = Counter('cuix_socketio_event_errors_total', 'Socket.IO handlers that raised, by event', ['event'])
+DB_SECONDS = Histogram('cuix_db_seconds', 'Time a database connection is held, by database and calling function', ['db', 'site'])
+SMTP_SEND_SECONDS = Histogram('cuix_smtp_send_seconds', 'Duration of SMTP deliveries (including reconnect and retry)')
+SMTP_FAILURES = Counter('cuix_smtp_failures_total', 'SMTP deliveries that failed, by exception type', ['error'])
+ORDER_UPDATE_BYTES = Histogram('cuix_order_updated_bytes', 'JSON size of order_updated payloads, by format', ['format'], SIZE_BUCKETS)
+
+# ============= TRACING =============
+TRACING_CONFIG = {
+    'sample_rate': float(os.environ.get('CUIX_TRACE_SAMPLE_RATE', app_settings.get('trace_sample_rate', 0.0))),
+    'slow_ms': float(app_settings.get('trace_slow_ms', 1000)),          # trazas más lentas se exportan siempre (0 = no)
+    'path': app_settings.get('trace_file', 'logs/traces.jsonl'),
+    'otlp_endpoint': app_settings.get('trace_otlp_endpoint'),          # p. ej. http://localhost:4318/v1/traces
+    'queue_size': 10000,
+    'max_spans': 500,                                                   # por traza
+    'service_name': 'cuix-livechat'
+}
+
+# SpanKind y StatusCode de OTLP
+SPAN_KINDS = {'INTERNAL': 1, 'SERVER': 2, 'CLIENT': 3}
+STATUS_CODES = {'STATUS_CODE_UNSET': 0, 'STATUS_CODE_OK': 1, 'STATUS_CODE_ERROR': 2}
+
+class Trace:
+    __slots__ = ('trace_id', 'sampled', 'attributes', 'spans')
+
+    def __init__(self, sampled):
+        self.trace_id = f"{random.getrandbits(128):032x}"
+        self.sampled = sampled
+        self.attributes = {}
+        self.spans = []
+
+class Span:
+    """One timed operation of a trace, with OpenTelemetry's span fields"""
+
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, trace, parent_id, name, kind, attributes):
+        self.trace = trace
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.attributes = dict(attributes) if attributes else {}
+        self.error = None
+        self.end = None
+        self.start = time.time_ns()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+class Tracer:
+    """In-process tracing of socket handlers, order jobs, database and SMTP calls.
+
+    A trace starts at a handler or an order job and collects child spans (one
+    per pooled DB connection, SMTP delivery, ...) on a thread-local stack;
+    nothing leaves the process until the root span ends. The trace is then
+    exported if it was head-sampled (``sample_rate``) or took ``slow_ms`` or
+    more, so latency outliers are kept at any sample rate. Attributes given
+    to annotate() (user id, step id) are copied to every span of the trace.
+    A background thread appends spans as JSON lines to ``path`` and, with
+    ``otlp_endpoint``, posts them to an OpenTelemetry collector (OTLP/HTTP JSON).
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._local = threading.local()
+        self._queue = queue.Queue(maxsize=config['queue_size'])
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {'traces': 0, 'exported': 0, 'spans': 0, 'dropped': 0, 'export_errors': 0}
+        app_settings.subscribe(self.on_settings_changed)
+
+    def on_settings_changed(self, settings, changed):
+        if 'trace_sample_rate' in changed:
+            self.config['sample_rate'] = float(settings.get('trace_sample_rate') or 0)
+        if 'trace_slow_ms' in changed:
+            self.config['slow_ms'] = float(settings.get('trace_slow_ms') or 0)
+
+    @property
+    def enabled(self):
+        return self.config['sample_rate'] > 0 or self.config['slow_ms'] > 0
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    @contextmanager
+    def _run_span(self, stack, span):
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            stack.pop()
+            span.end = time.time_ns()
+            if len(span.trace.spans) < self.config['max_spans']:
+                span.trace.spans.append(span)
+
+    @contextmanager
+    def trace(self, name, kind='SERVER', attributes=None):
+        """Root span of a new trace (a child span if a trace is already active)"""
+        stack = self._stack()
+        if stack:
+            with self.span(name, kind, attributes) as span:
+                yield span
+            return
+        if not self.enabled:
+            yield None
+            return
+
+        trace = Trace(random.random() < self.config['sample_rate'])
+        root = Span(trace, None, name, kind, attributes)
+        try:
+            with self._run_span(stack, root):
+                yield root
+        finally:
+            slow_ms = self.config['slow_ms']
+            slow = slow_ms > 0 and root.end - root.start >= slow_ms * 1e6
+            with self._lock:
+                self._stats['traces'] += 1
+            if trace.sampled or slow:
+                root.attributes['trace.reason'] = 'sampled' if trace.sampled else 'slow'
+                self._export(trace)
+
+    @contextmanager
+    def span(self, name, kind='INTERNAL', attributes=None):
+        """Child span of the active trace; does nothing outside a trace"""
+        stack = getattr(self._local, 'stack', None)
+        if not stack:
+            yield None
+            return
+        parent = stack[-1]
+        with self._run_span(stack, Span(parent.trace, parent.span_id, name, kind, attributes)) as span:
+            yield span
+
+    def annotate(self, **attributes):
+        """Attributes for every span of the active trace (e.g. user_id, step_id)"""
+        stack = getattr(self._local, 'stack', None)
+        if stack:
+            stack[0].trace.attributes.update(attributes)
+
+    def _export(self, trace):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._export_loop, name='trace-export', daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            with self._lock:
+                self._stats['dropped'] += 1
+
+    def _record(self, trace, span):
+        status = {'code': 'STATUS_CODE_ERROR', 'message': span.error} if span.error else {'code': 'STATUS_CODE_UNSET'}
+        return {
+            'trace_id': trace.trace_id,
+            'span_id': span.span_id,
+            'parent_span_id': span.parent_id,
+            'name': span.name,
+            'kind': f"SPAN_KIND_{span.kind}",
+            'start_time_unix_nano': span.start,
+            'end_time_unix_nano': span.end,
+            'duration_ms': round((span.end - span.start) / 1e6, 3),
+            'attributes': {**trace.attributes, **span.attributes},
+            'status': status,
+            'resource': {'service.name': self.config['service_name'], 'process.pid': os.getpid()}
+        }
+
+    def _export_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 200:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            records = [self._record(trace, span) for trace in batch if trace is not None for span in trace.spans]
+            if records:
+                self._write(records)
+            if stopping:
+                return
+
+    def _write(self, records):
+        try:
+            with open(self.config['path'], 'a', encoding='utf-8') as f:
+                f.writelines(json.dumps(record, ensure_ascii=False, default=str) + '\n' for record in records)
+            if self.config['otlp_endpoint']:
+                self._post_otlp(records)
+            with self._lock:
+                self._stats['exported'] += len({record['trace_id'] for record in records})
+                self._stats['spans'] += len(records)
+        except Exception as e:
+            with self._lock:
+                self._stats['export_errors'] += 1
+            logger.warning(f"Error exporting traces: {e}")
+
+    def _post_otlp(self, records):
+        def attribute(key, value):
+            if isinstance(value, bool):
+                return {'key': key, 'value': {'boolValue': value}}
+            if isinstance(value, int):
+                return {'key': key, 'value': {'intValue': str(value)}}
+            if isinstance(value, float):
+                return {'key': key, 'value': {'doubleValue': value}}
+            return {'key': key, 'value': {'stringValue': str(value)}}
+
+        spans = [{
+            'traceId': record['trace_id'],
+            'spanId': record['span_id'],
+            'parentSpanId': record['parent_span_id'] or '',
+            'name': record['name'],
+            'kind': SPAN_KINDS[record['kind'][len('SPAN_KIND_'):]],
+            'startTimeUnixNano': str(record['start_time_unix_nano']),
+            'endTimeUnixNano': str(record['end_time_unix_nano']),
+            'attributes': [attribute(k, v) for k, v in record['attributes'].items() if v is not None],
+            'status': {'code': STATUS_CODES[record['status']['code']], 'message': record['status'].get('message', '')}
+        } for record in records]
+        body = {'resourceSpans': [{
+            'resource': {'attributes': [attribute(k, v) for k, v in records[0]['resource'].items()]},
+            'scopeSpans': [{'scope': {'name': 'cuix.app'}, 'spans': spans}]
+        }]}
+        request_ = urllib.request.Request(
+            self.config['otlp_endpoint'], data=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}, method='POST'
+        )
+        urllib.request.urlopen(request_, timeout=5).close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize()
+        stats['sample_rate'] = self.config['sample_rate']
+        stats['slow_ms'] = self.config['slow_ms']
+        return stats
+
+    def close(self):
+        """Export what is queued and stop the exporter thread"""
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+
+tracer = Tracer(TRACING_CONFIG)
+atexit.register(tracer.close)
 
 # ============= MYSQL CONFIGURATION =============
+
 MYSQL_CONFIG = {
     'host': '172.25.80.1',
     'user': 'root',
     'password': 'root',
     'database': 'cuix_db',
     'pool_name': 'cuix_pool',
-    'pool_size': 5,
+    'pool_size': int(app_settings.get('mysql_pool_size', 5)),
     'connect_timeout': 3
 }
+# La extensión C bloquea el hub de green threads; en eventlet/gevent se usa el driver puro (sockets parcheados).
+# En threading no se pasa la clave: use_pure=False exige la extensión C aunque no esté instalada
+if ASYNC_MODE != 'threading':
+    MYSQL_CONFIG['use_pure'] = True
+
+MYSQL_POOL_OPTIONS = {
+    'checkout_timeout': float(app_settings.get('mysql_checkout_timeout', 5)),
+    'retry_interval': float(app_settings.get('mysql_retry_interval', 30))
+}
 
-db_pool = None
-try:
-    db_pool = pooling.MySQLConnectionPool(**MYSQL_CONFIG)
-    logger.info("MySQL connection pool created successfully")
-except Exception as e:
-    logger.warning(f"MySQL not available, using SQLite: {e}")
-    db_pool = None
-
-def get_db_connection():
-    """Get MySQL database connection"""
-    if db_pool:
+class MySQLPool:
+    """Single entry point for MySQL connections.
+
+    Wraps mysql.connector's pool with a blocking checkout (the stock pool
+    raises as soon as it is exhausted), a ping health check before handing
+    a connection out, and a retry window while MySQL is down so callers fall
+    back to SQLite at once instead of paying ``connect_timeout`` per request.
+    """
+
+    def __init__(self, config, checkout_timeout=5, retry_interval=30):
+        self.config = config
+        self.checkout_timeout = checkout_timeout
+        self.retry_interval = retry_interval
+        self._pool = None
+        self._down_until = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config['pool_size'])
+        self._stats = {'checkouts': 0, 'in_use': 0, 'peak_in_use': 0, 'exhausted': 0, 'failures': 0}
+        self._create_pool()
+
+    def _create_pool(self):
         try:
-            return db_pool.get_connection()
+            self._pool = pooling.MySQLConnectionPool(**self.config)
+            self._down_until = 0
+            logger.info("MySQL connection pool created successfully")
         except Exception as e:
-            logger.error(f"Error getting connection from pool: {e}")
-    return None
+            logger.warning(f"MySQL not available, using SQLite: {e}")
+            self._pool = None
+            self._down_until = time.time() + self.retry_interval
 
-def get_mysql_connection():
-    """Get a new MySQL connection (alternative)"""
-    try:
-        return mysql.connector.connect(**MYSQL_CONFIG)
-    except Exception as e:
-        logger.error(f"MySQL connection error: {e}")
-        return None
+    def _mark_down(self):
+        self._down_until = time.time() + self.retry_interval
 
-class ResponseManager:
-    """Manages predefined responses for the chat system without AI"""
+    def is_available(self):
+        """True if MySQL is (believed to be) reachable; retries after the window"""
+        if time.time() < self._down_until:
+            return False
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None and time.time() >= self._down_until:
+                    self._create_pool()
+        return self._pool is not None
+
+    def acquire(self):
+        """Check out a healthy connection, or None if MySQL is unavailable"""
+        if not self.is_available():
+            return None
 
-    def __init__(self):
-        self.responses = {
-            'greeting': [
-                "¡Hola! Soy tu asistente Funko y estoy aquí para ayudarte a crear tu figura personalizada. 🎯",
-                "¡Bienvenido! Estoy listo para diseñar tu Funko único. Comencemos con los detalles. 🎨",
-                "¡Hola! Vamos a crear tu figura Funko personalizada paso a paso. ¡Empecemos! 🚀"
-            ],
-            'acknowledgment': [
-                "Entendido perfectamente.",
-                "¡Excelente detalle!",
-                "Perfecto, he anotado eso.",
-                "¡Genio! Me encanta esa idea.",
-                "Entendido, continuemos con eso.",
-                "¡Perfecto! Agregado a tu diseño."
-            ],
-            'continue_prompt': [
-                "¿Hay algo más que quieras agregar a esta sección?",
-                "¿Algun otro detalle para esta parte?",
-                "¿Te gustaría añadir algo más aquí?",
-                "¿Estás listo/a para continuar con la siguiente sección?"
-            ],
-            'step_complete': [
-                "¡Perfecto! He completado esta sección de tu Funko.",
-                "¡Excelente! Esta parte está lista.",
-                "¡Genio! Sección completada con éxito.",
-                "¡Perfecto! Detalles guardados correctamente."
-            ],
-            'next_section': [
-                "Ahora vamos con la siguiente sección.",
-                "Continuemos con el siguiente paso.",
-                "Pasemos a la siguiente parte de tu diseño.",
-                "Excelente, ahora sigamos adelante."
-            ],
-            'confirmation_positive': [
-                "¡Perfecto! Tu pedido ha sido confirmado.",
-                "¡Excelente! Todo está correcto.",
-                "¡Genio! Confirmación recibida.",
-                "¡Perfecto! Pedido confirmado exitosamente."
-            ],
-            'confirmation_negative': [
-                "Entendido. Vamos a corregir los detalles.",
-                "No hay problema. Revisemos qué cambiar.",
-                "Perfecto, vamos a ajustar tu diseño.",
-                "Entendido. Corrijamos lo necesario."
-            ],
-            'error_generic': [
-                "Lo siento, tuve un problema. Por favor intenta nuevamente.",
-                "Ha ocurrido un error. Por favor repite tu mensaje.",
-                "Disculpa, no entendí. ¿Podrías repetirlo?",
-                "Tuve un problema técnico. Por favor intenta de nuevo."
-            ],
-            'order_complete': [
-                "¡Felicidades! Tu Funko personalizado está completo. 🎉",
-                "¡Excelente! Hemos terminado tu diseño Funko. 🎯",
-                "¡Perfecto! Tu figura está lista para producción. 🚀",
-                "¡Genio! Tu Funko personalizado está finalizado. ✨"
-            ]
+        if not self._slots.acquire(timeout=self.checkout_timeout):
+            with self._lock:
+                self._stats['exhausted'] += 1
+            logger.warning("MySQL pool exhausted, using SQLite")
+            return None
+
+        conn = None
+        try:
+            conn = self._pool.get_connection()
+            conn.ping(reconnect=True, attempts=1, delay=0)
+        except Exception as e:
+            if conn is not None:
+                # Devolverla al pool de mysql.connector: sin close() el hueco se pierde para siempre
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._slots.release()
+            with self._lock:
+                self._stats['failures'] += 1
+            self._mark_down()
+            logger.error(f"MySQL connection error: {e}")
+            return None
+
+        with self._lock:
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            self._stats['peak_in_use'] = max(self._stats['peak_in_use'], self._stats['in_use'])
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        try:
+            conn.close()
+        except Exception as e:
+            logger.error(f"Error returning MySQL connection: {e}")
+        finally:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        """Pooled connection for a ``with`` block (yields None if unavailable)"""
+        site = call_site()
+        started = time.perf_counter()
+        with tracer.span(f"mysql {site}", 'CLIENT', {'db.system': 'mysql', 'code.function': site}) as span:
+            conn = self.acquire()
+            if conn is None and span is not None:
+                span.set_attribute('db.unavailable', True)
+            try:
+                yield conn
+            finally:
+                if conn is not None:
+                    self.release(conn)
+                    DB_SECONDS.observe(time.perf_counter() - started, 'mysql', site)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = self.config['pool_size']
+        stats['available'] = self.config['pool_size'] - stats['in_use']
+        stats['healthy'] = self._pool is not None and time.time() >= self._down_until
+        return stats
+
+db_pool = MySQLPool(MYSQL_CONFIG, **MYSQL_POOL_OPTIONS)
+
+# ============= SQLITE CONFIGURATION =============
+SQLITE_CONFIG = {
+    'database': 'conversations.db',
+    'pool_size': 8,
+    'timeout': 10,
+    'cached_statements': 256,
+    'cache_size': -16000,      # negativo = KiB (16 MB por conexión)
+    'mmap_size': 64 * 1024 * 1024
+}
+
+class SQLitePool:
+    """Pool of long-lived SQLite connections shared by all handlers.
+
+    Connections are opened lazily up to ``pool_size`` and reused, so each
+    keeps its page cache and its prepared statement cache (sqlite3 caches
+    compiled statements per connection, keyed by SQL text). WAL mode lets
+    readers run while a writer commits, and ``busy_timeout`` makes writers
+    wait for the lock instead of failing with "database is locked".
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._closed = False
+
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.config['database'],
+            timeout=self.config['timeout'],
+            cached_statements=self.config['cached_statements'],
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f"PRAGMA cache_size={int(self.config['cache_size'])}")
+        conn.execute(f"PRAGMA mmap_size={int(self.config['mmap_size'])}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.config['timeout'] * 1000)}")
+        conn.execute('PRAGMA temp_store=MEMORY')
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError('SQLite pool is closed')
+            if len(self._connections) < self.config['pool_size']:
+                conn = self._connect()
+                self._connections.append(conn)
+                return conn
+
+        return self._idle.get(timeout=self.config['timeout'])
+
+    def _release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Check out a connection; uncommitted work is rolled back on return"""
+        site = call_site()
+        started = time.perf_counter()
+        with tracer.span(f"sqlite {site}", 'CLIENT', {'db.system': 'sqlite', 'code.function': site}):
+            conn = self._acquire()
+            try:
+                yield conn
+            finally:
+                self._release(conn)
+                DB_SECONDS.observe(time.perf_counter() - started, 'sqlite', site)
+
+    def stats(self):
+        with self._lock:
+            opened = len(self._connections)
+        idle = self._idle.qsize()
+        return {'size': self.config['pool_size'], 'open': opened, 'idle': idle, 'in_use': max(0, opened - idle)}
+
+    def close_all(self):
+        """Close every pooled connection (registered as a shutdown hook)"""
+        with self._lock:
+            self._closed = True
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception as e:
+                logger.error(f"Error closing SQLite connection: {e}")
+        logger.info("SQLite connection pool closed")
+
+sqlite_pool = SQLitePool(SQLITE_CONFIG)
+atexit.register(sqlite_pool.close_all)
+
+# ============= SCHEMA MIGRATIONS =============
+def add_column_if_missing(conn, table, column, definition):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column not in columns:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+# (versión, descripción, lista de sentencias SQL o función que recibe la conexión).
+# Nunca modificar una migración ya publicada: agregar una nueva al final.
+SCHEMA_MIGRATIONS = [
+    (1, 'conversations and messages', [
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT UNIQUE NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            order_data TEXT,
+            status TEXT DEFAULT 'active'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            conversation_id INTEGER,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+        )
+        '''
+    ]),
+    (2, 'orders table (SQLite fallback)', [
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            cliente TEXT,
+            customer_phone TEXT,
+            tipo TEXT,
+            description TEXT,
+            clothing TEXT,
+            shoes TEXT,
+            accessories TEXT,
+            price REAL DEFAULT 0,
+            status TEXT DEFAULT 'pending',
+            delivery_date TEXT,
+            delivery_notes TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP
+        )
+        '''
+    ]),
+    (3, 'orders.order_data column',
+        lambda conn: add_column_if_missing(conn, 'orders', 'order_data', 'TEXT')),
+    (4, 'order finalization queue', [
+        '''
+        CREATE TABLE IF NOT EXISTS order_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT NOT NULL,
+            order_data TEXT NOT NULL,
+            notify_sid TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_run_at REAL NOT NULL,
+            locked_until REAL,
+            order_id INTEGER,
+            email_sent INTEGER DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        '''
+    ]),
+    (5, 'indexes for history lookup, order listing and job polling', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_conversation_ts ON messages (conversation_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_created ON orders (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS idx_order_jobs_status_due ON order_jobs (status, next_run_at)'
+    ]),
+    (6, 'report rollups', [
+        '''
+        CREATE TABLE IF NOT EXISTS report_orders (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            status TEXT NOT NULL,
+            orders INTEGER DEFAULT 0,
+            revenue REAL DEFAULT 0,
+            PRIMARY KEY (period, bucket, status)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS report_confirm_times (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            bin INTEGER NOT NULL,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (period, bucket, bin)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS report_funnel (
+            period TEXT NOT NULL,
+            bucket TEXT NOT NULL,
+            depth INTEGER NOT NULL,
+            conversations INTEGER DEFAULT 0,
+            ordered INTEGER DEFAULT 0,
+            PRIMARY KEY (period, bucket, depth)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS report_conversations (
+            conversation_id INTEGER PRIMARY KEY,
+            day TEXT NOT NULL,
+            user_messages INTEGER DEFAULT 0,
+            ordered INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS report_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        '''
+    ]),
+    (7, 'per-step funnel metrics', [
+        '''
+        CREATE TABLE IF NOT EXISTS step_metrics (
+            day TEXT NOT NULL,
+            flow TEXT NOT NULL,
+            step TEXT NOT NULL,
+            entered INTEGER DEFAULT 0,
+            exited INTEGER DEFAULT 0,
+            seconds REAL DEFAULT 0,
+            messages INTEGER DEFAULT 0,
+            edits INTEGER DEFAULT 0,
+            photos INTEGER DEFAULT 0,
+            abandoned INTEGER DEFAULT 0,
+            PRIMARY KEY (day, flow, step)
+        )
+        '''
+    ]),
+    (8, 'session settings on conversations (language, order deltas)', [
+        'ALTER TABLE conversations ADD COLUMN lang TEXT',
+        'ALTER TABLE conversations ADD COLUMN deltas INTEGER DEFAULT 0'
+    ])
+]
+
+def run_migrations(conn):
+    """Apply pending SCHEMA_MIGRATIONS in order; returns how many were applied.
+
+    Each migration runs in its own IMMEDIATE transaction together with its
+    schema_version row, so concurrent processes starting at the same time
+    apply it exactly once and a failed migration leaves no partial changes.
+    """
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+
+    applied = 0
+    for version, description, steps in SCHEMA_MIGRATIONS:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('SELECT 1 FROM schema_version WHERE version = ?', (version,)).fetchone():
+                conn.rollback()
+                continue
+
+            if callable(steps):
+                steps(conn)
+            else:
+                for statement in steps:
+                    conn.execute(statement)
+
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)', (version, description))
+            conn.commit()
+            applied += 1
+            logger.info(f"Migración {version} aplicada: {description}")
+        except Exception:
+            conn.rollback()
+            raise
+
+    return applied
+
+# ============= BLOB STORE =============
+class BlobStore:
+    """Content-addressed storage for reference photos.
+
+    Files live under the uploads folder keyed by their SHA-256, so the same
+    photo uploaded twice is stored once, and order_data only carries a small
+    reference (hash, filename, size, mime) instead of the base64 payload.
+    """
+
+    DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def is_valid_digest(self, digest):
+        return bool(digest and self.DIGEST_RE.match(digest))
+
+    def path_for(self, digest):
+        """Path of a blob on disk (sharded by the first two hex chars)"""
+        return os.path.join(self.root, digest[:2], digest)
+
+    def exists(self, digest):
+        return self.is_valid_digest(digest) and os.path.exists(self.path_for(digest))
+
+    def put(self, data, filename, mime=None):
+        """Store raw bytes and return the reference kept in order_data"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path_for(digest)
+
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+        return {
+            'hash': digest,
+            'filename': filename,
+            'size': len(data),
+            'mime': mime or mimetypes.guess_type(filename or '')[0] or 'image/jpeg',
+            'timestamp': datetime.now().isoformat()
+        }
+
+    def put_file(self, src_path, filename, mime=None):
+        """Move a fully written file into the store (hashed in blocks, never loaded whole)"""
+        digest = hashlib.sha256()
+        size = 0
+        with open(src_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+                size += len(block)
+        digest = digest.hexdigest()
+        path = self.path_for(digest)
+
+        if os.path.exists(path):
+            os.remove(src_path)
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(src_path, path)
+
+        return {
+            'hash': digest,
+            'filename': filename,
+            'size': size,
+            'mime': mime or mimetypes.guess_type(filename or '')[0] or 'image/jpeg',
+            'timestamp': datetime.now().isoformat()
         }
 
-    def get_response(self, response_type, context=None):
-        """Get a predefined response based on type and context"""
-        import random
+    def put_base64(self, data, filename):
+        """Store a base64 payload, with or without a data URL header"""
+        mime = None
+        if data.startswith('data:') and ',' in data:
+            header, data = data.split(',', 1)
+            mime = header[5:].split(';')[0] or None
+        return self.put(base64.b64decode(data), filename, mime)
+
+    def read(self, foto):
+        """Return the bytes of a photo reference (also accepts legacy inline photos)"""
+        if foto.get('hash'):
+            with open(self.path_for(foto['hash']), 'rb') as f:
+                return f.read()
+
+        img_data_str = foto.get('data', '')
+        if ',' in img_data_str:
+            img_data_str = img_data_str.split(',')[1]
+        return base64.b64decode(img_data_str)
+
+    def open(self, foto):
+        """Binary file object and size of a photo reference, for streaming it"""
+        if foto.get('hash'):
+            path = self.path_for(foto['hash'])
+            return open(path, 'rb'), os.path.getsize(path)
+        data = self.read(foto)
+        return io.BytesIO(data), len(data)
+
+    def externalize(self, order_data):
+        """Replace legacy inline photos in order_data with blob references"""
+        fotos = order_data.get('fotos_referencia') or []
+        for i, foto in enumerate(fotos):
+            if isinstance(foto, dict) and not foto.get('hash') and foto.get('data'):
+                try:
+                    ref = self.put_base64(foto['data'], foto.get('filename') or f'referencia_{i+1}.jpg')
+                    ref['timestamp'] = foto.get('timestamp', ref['timestamp'])
+                    fotos[i] = ref
+                except Exception as e:
+                    logger.error(f"Error externalizing photo {i}: {e}")
+        return order_data
 
-        if response_type in self.responses:
-            responses = self.responses[response_type]
-            base_response = random.choice(responses)
+blob_store = BlobStore(app.config['UPLOAD_FOLDER'])
 
-            # Add context-specific modifications
-            if context:
-                if context.get('step_name'):
-                    base_response += f" Sección: {context['step_name']}"
-                if context.get('next_prompt'):
-                    base_response += f"\n\n{context['next_prompt']}"
-                if context.get('summary'):
-                    base_response += f"\n\n{context['summary']}"
+# ============= CHUNKED UPLOADS =============
+UPLOAD_CONFIG = {
+    'max_bytes': int(app_settings.get('upload_max_bytes', 20 * 1024 * 1024)),
+    'chunk_size': int(app_settings.get('upload_chunk_size', 256 * 1024)),  # < max_http_buffer_size (1 MB)
+    'ttl': int(app_settings.get('upload_ttl', 24 * 3600)),                 # segundos que se guarda una subida incompleta
+    'allowed_types': ('image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/heic', 'image/heif')
+}
 
-            return base_response
+def sniff_image_type(head):
+    """Image MIME type from the first bytes of a file, or None if it is not a known image"""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'image/jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'image/png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'heic', b'heix', b'hevc', b'heim', b'heis'):
+            return 'image/heic'
+        if brand in (b'mif1', b'msf1', b'heif'):
+            return 'image/heif'
+    return None
 
-        return self.responses['acknowledgment'][0]
+class UploadError(Exception):
+    """A chunked upload request that was rejected (message is shown to the client)"""
+
+class ChunkedUploadManager:
+    """Resumable uploads streamed to disk chunk by chunk.
+
+    Every upload is a partial file plus a small JSON manifest under
+    ``<root>/partial``. The random upload_id is the only capability needed to
+    continue an upload, so a client can resume from the server's offset after
+    a reconnect (new socket, new sid). Size and type are checked on
+    upload_start and on the first chunk, before the rest of the file is sent;
+    finish() moves the file into the BlobStore without reading it into memory.
+    """
+
+    ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+    def __init__(self, store, config=None):
+        self.store = store
+        self.config = config or UPLOAD_CONFIG
+        self.partial_dir = os.path.join(store.root, 'partial')
+        os.makedirs(self.partial_dir, exist_ok=True)
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._last_cleanup = 0
+
+    def _paths(self, upload_id):
+        if not upload_id or not self.ID_RE.match(upload_id):
+            raise UploadError('Subida no encontrada')
+        base = os.path.join(self.partial_dir, upload_id)
+        return base + '.part', base + '.json'
+
+    def _upload_lock(self, upload_id):
+        with self._lock:
+            return self._locks.setdefault(upload_id, threading.Lock())
+
+    def _manifest(self, upload_id):
+        part_path, meta_path = self._paths(upload_id)
+        try:
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise UploadError('Subida no encontrada o expirada')
+        meta['offset'] = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        return meta
+
+    def start(self, filename, size, mime=None, upload_id=None):
+        """Begin (or resume, when upload_id is known) an upload; returns its state"""
+        self.cleanup()
+        # Antes de comparar con el manifiesto: el cliente puede mandar el tamaño como texto ("2789")
+        try:
+            size = int(size)
+        except (TypeError, ValueError):
+            raise UploadError('Tamaño de archivo inválido')
+        if size <= 0:
+            raise UploadError('El archivo está vacío')
+        if size > self.config['max_bytes']:
+            raise UploadError(f"La imagen supera el máximo de {self.config['max_bytes'] // (1024 * 1024)} MB")
+
+        if upload_id:
+            try:
+                meta = self._manifest(upload_id)
+                if meta['size'] == size and meta['filename'] == filename:
+                    return self._state(upload_id, meta)
+            except UploadError:
+                pass  # expirada: se empieza de nuevo
+
+        mime = (mime or mimetypes.guess_type(filename or '')[0] or '').lower()
+        if mime and mime not in self.config['allowed_types']:
+            raise UploadError('Tipo de archivo no permitido')
+
+        upload_id = uuid.uuid4().hex
+        part_path, meta_path = self._paths(upload_id)
+        meta = {'filename': filename, 'size': size, 'mime': mime or None, 'created': time.time()}
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f)
+        open(part_path, 'wb').close()
+        meta['offset'] = 0
+        return self._state(upload_id, meta)
+
+    def _state(self, upload_id, meta):
+        return {
+            'upload_id': upload_id,
+            'offset': meta['offset'],
+            'size': meta['size'],
+            'chunk_size': self.config['chunk_size']
+        }
 
-    def generate_step_response(self, step_id, message_content, order_data):
-        """Generate appropriate response for current step"""
-        message_lower = message_content.lower()
+    def status(self, upload_id):
+        return self._state(upload_id, self._manifest(upload_id))
 
-        # Check for continuation signals
-        continue_signals = ['siguiente', 'listo', 'terminado', 'continuar', 'avanzar', 'ya está', 'eso es todo', 'pasemos', 'pase al siguiente']
-        is_continue = any(signal in message_lower for signal in continue_signals)
+    def append(self, upload_id, offset, data):
+        """Write one chunk at offset; returns the new offset.
 
-        # Check for completion signals
-        completion_signals = ['listo', 'terminado', 'completado', 'fin', 'acabado']
-        is_complete = any(signal in message_lower for signal in completion_signals)
+        A chunk for an offset the server has already passed (a retry whose
+        ack was lost) is ignored; one beyond it is refused with the current
+        offset so the client seeks back.
+        """
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        if not data or len(data) > self.config['chunk_size']:
+            raise UploadError('Tamaño de fragmento inválido')
+
+        with self._upload_lock(upload_id):
+            meta = self._manifest(upload_id)
+            current = meta['offset']
+            if offset != current:
+                return current
+            if current + len(data) > meta['size']:
+                raise UploadError('El archivo excede el tamaño declarado')
+            if current == 0:
+                sniffed = sniff_image_type(data[:16])
+                if sniffed is None or sniffed not in self.config['allowed_types']:
+                    self.abort(upload_id)
+                    raise UploadError('El archivo no es una imagen válida')
+                if sniffed != meta.get('mime'):
+                    meta['mime'] = sniffed
+                    self._write_manifest(upload_id, meta)
+
+            part_path, _ = self._paths(upload_id)
+            with open(part_path, 'ab') as f:
+                f.write(data)
+            return current + len(data)
+
+    def _write_manifest(self, upload_id, meta):
+        _, meta_path = self._paths(upload_id)
+        with open(meta_path, 'w') as f:
+            json.dump({k: v for k, v in meta.items() if k != 'offset'}, f)
+
+    def finish(self, upload_id):
+        """Move a complete upload into the blob store and return the photo reference"""
+        with self._upload_lock(upload_id):
+            meta = self._manifest(upload_id)
+            if meta['offset'] != meta['size']:
+                raise UploadError(f"Subida incompleta ({meta['offset']}/{meta['size']} bytes)")
+            part_path, meta_path = self._paths(upload_id)
+            ref = self.store.put_file(part_path, meta['filename'], meta.get('mime'))
+            os.remove(meta_path)
+        with self._lock:
+            self._locks.pop(upload_id, None)
+        return ref
+
+    def abort(self, upload_id):
+        for path in self._paths(upload_id):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._locks.pop(upload_id, None)
 
-        if is_continue or is_complete:
-            return self.get_response('step_complete') + " " + self.get_response('next_section')
+    def cleanup(self):
+        """Drop partial uploads older than the TTL (at most once a minute)"""
+        now = time.time()
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for name in os.listdir(self.partial_dir):
+            path = os.path.join(self.partial_dir, name)
+            try:
+                if now - os.path.getmtime(path) > self.config['ttl']:
+                    os.remove(path)
+            except OSError:
+                pass
+        # Locks de subidas expiradas o de ids que nunca existieron (append/finish fallidos)
+        with self._lock:
+            for upload_id, lock in list(self._locks.items()):
+                if not lock.locked() and not os.path.exists(self._paths(upload_id)[1]):
+                    del self._locks[upload_id]
+
+upload_manager = ChunkedUploadManager(blob_store)
+
+# ============= IMAGE PROCESSING =============
+IMAGE_CONFIG = {
+    'display_edge': int(app_settings.get('image_max_edge', 1600)),   # px, lado mayor de la versión para correo
+    'thumb_edge': int(app_settings.get('image_thumb_edge', 320)),    # px, miniaturas del admin y del correo
+    'quality': int(app_settings.get('image_quality', 85)),
+    'workers': int(app_settings.get('image_workers', 2))
+}
+
+@contextmanager
+def _main_module_hidden():
+    """Hide __main__'s file and spec from multiprocessing while it starts workers.
+
+    spawn re-runs the parent's __main__ in every new worker; with
+    ``python app.py`` that is all of app.py (monkey patching, SocketIO,
+    database pools and migrations, background threads, atexit hooks).
+    Image workers only need the imaging module, which they import when
+    unpickling the job.
+    """
+    main = sys.modules['__main__']
+    saved = {name: main.__dict__[name] for name in ('__file__', '__spec__') if name in main.__dict__}
+    main.__file__ = main.__spec__ = None
+    try:
+        yield
+    finally:
+        del main.__file__, main.__spec__
+        main.__dict__.update(saved)
+
+class ImageProcessor:
+    """Derived versions of reference photos, rendered off the request path.
+
+    'display' (long edge capped for email) and 'thumb' (admin list and
+    email body) are written once per blob to uploads/derived, keyed by the
+    photo's SHA-256, by a process pool so decoding never blocks chat
+    handlers. Originals are kept untouched. Without Pillow, or for formats
+    it cannot decode, every variant falls back to the original file.
+    """
+
+    VARIANTS = ('display', 'thumb')
+
+    def __init__(self, store, config=None):
+        self.store = store
+        self.config = config or IMAGE_CONFIG
+        self.root = os.path.join(store.root, 'derived')
+        self.enabled = imaging.Image is not None
+        self._executor = None
+        self._pending = {}   # digest -> Future
+        self._failed = set()
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+        if not self.enabled:
+            logger.warning("Pillow no está instalado: las fotos de referencia se usarán en tamaño original")
+
+    def variant_path(self, digest, variant):
+        return os.path.join(self.root, digest[:2], f"{digest}_{variant}.jpg")
+
+    def _pool(self):
+        if self._executor is None:
+            # spawn: a estas alturas el proceso ya tiene hilos (pools, write-behind, jobs) y puede
+            # estar parcheado por eventlet/gevent; un fork heredaría locks tomados por otros hilos.
+            # Los workers solo importan imaging (sin los efectos de importar app.py)
+            context = multiprocessing.get_context('spawn')
+            self._executor = ProcessPoolExecutor(max_workers=self.config['workers'], mp_context=context)
+        return self._executor
+
+    def submit(self, foto):
+        """Queue rendering of a photo's variants; returns the pending Future or None"""
+        digest = foto.get('hash')
+        if not self.enabled or not self.store.is_valid_digest(digest):
+            return None
+        with self._lock:
+            if digest in self._pending:
+                return self._pending[digest]
+            if digest in self._failed or all(os.path.exists(self.variant_path(digest, v)) for v in self.VARIANTS):
+                return None
+            targets = {
+                'display': (self.variant_path(digest, 'display'), self.config['display_edge']),
+                'thumb': (self.variant_path(digest, 'thumb'), self.config['thumb_edge'])
+            }
+            try:
+                # El pool arranca los workers dentro de submit(), a medida que hacen falta
+                with _main_module_hidden():
+                    future = self._pool().submit(
+                        imaging.render_image_variants, self.store.path_for(digest), targets, self.config['quality']
+                    )
+            except Exception as e:
+                logger.error(f"Image pool unavailable: {e}")
+                return None
+            self._pending[digest] = future
+        future.add_done_callback(lambda f, digest=digest: self._done(digest, f))
+        return future
+
+    def _done(self, digest, future):
+        with self._lock:
+            self._pending.pop(digest, None)
+            if future.cancelled():
+                # shutdown(cancel_futures=True): no es un fallo, se reintentará en el próximo arranque
+                return
+            error = future.exception()
+            if error is not None:
+                # Formato no soportado (p. ej. HEIC sin plugin): se usará el original
+                self._failed.add(digest)
+        if error is not None:
+            logger.warning(f"Could not process image {digest[:12]}: {error}")
+        else:
+            sizes = {variant: info['size'] for variant, info in future.result().items()}
+            logger.info(f"Image {digest[:12]} processed: {sizes}")
+
+    def variant(self, foto, variant, timeout=None):
+        """(path, mime) of a photo variant, waiting up to timeout seconds for it
+        to be rendered; falls back to the original blob"""
+        digest = foto.get('hash')
+        if self.enabled and variant in self.VARIANTS and self.store.is_valid_digest(digest):
+            path = self.variant_path(digest, variant)
+            if not os.path.exists(path) and timeout:
+                future = self.submit(foto)
+                if future is not None:
+                    try:
+                        future.result(timeout=timeout)
+                    except Exception:
+                        pass
+            if os.path.exists(path):
+                return path, 'image/jpeg'
+        return None, foto.get('mime') or 'image/jpeg'
+
+    def open(self, foto, variant, timeout=30):
+        """(file, mime, size) of a photo variant, the original blob as fallback"""
+        path, mime = self.variant(foto, variant, timeout)
+        if path is None:
+            f, size = self.store.open(foto)
+            return f, mime, size
+        return open(path, 'rb'), mime, os.path.getsize(path)
+
+    def shutdown(self):
+        if self._executor is not None:
+            # wait=True: con eventlet, dejar los workers vivos cuelga la salida del proceso
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+image_processor = ImageProcessor(blob_store)
+atexit.register(image_processor.shutdown)
+
+# ============= INTENT MATCHING =============
+def _build_fold_table():
+    # Latin-1 + Latin Extended-A/B: cada letra acentuada -> su letra base (Í -> i, ñ -> n)
+    table = {}
+    for code in range(0xC0, 0x250):
+        base = unicodedata.normalize('NFD', chr(code))[0].lower()
+        if len(base) == 1 and base != chr(code):
+            table[code] = base
+    return table
+
+_FOLD_TABLE = _build_fold_table()
+
+def _fold_char(char):
+    """Latin-1 character playing the same role as ``char`` in folded text:
+    ' ' for whitespace, '.' for any other separator, otherwise the letter
+    lowercased and without accents"""
+    if char.isspace():
+        return ' '
+    if not (char.isalnum() or char == '_'):
+        return '.'
+    folded = _FOLD_TABLE.get(ord(char), char).lower()
+    # Letras sin equivalente Latin-1 (ł, ж, ...) siguen contando como parte de la palabra
+    return folded if len(folded) == 1 and ord(folded) < 0x100 else '\xaa'
+
+# Separadores que no son espacio en blanco -> b'\t' (ver IntentMatcher._strict_pattern)
+_FOLD_BYTES = bytes(ord(_fold_char(chr(code)).replace('.', '\t')) for code in range(0x100))
+
+def _fold_encode_error(exc):
+    # El sustituto pasa después por _FOLD_BYTES como cualquier carácter Latin-1
+    return _fold_char(exc.object[exc.start]), exc.start + 1
+
+codecs.register_error('cuix-fold', _fold_encode_error)
+
+def fold_text(text):
+    """Bytes form of ``text`` the intent matchers scan: lowercased, accents
+    stripped (Sí -> si), whitespace as b' ' and any other separator as b'\\t'.
+    One byte per character, so match spans index into the original message"""
+    # encode + translate recorren el texto en C (sin regex ni dict por carácter);
+    # solo lo que no es Latin-1 (emojis, ł, comillas tipográficas) pasa por _fold_encode_error
+    return text.encode('latin-1', 'cuix-fold').translate(_FOLD_BYTES)
+
+# Resultados de find_all memorizados por texto (solo mensajes de hasta
+# INTENT_MEMO_MAX_LENGTH caracteres)
+INTENT_MEMO_SIZE = int(app_settings.get('intent_memo_size', 4096))
+INTENT_MEMO_MAX_LENGTH = 64
+
+IntentMatch = namedtuple('IntentMatch', ['intent', 'phrase', 'start', 'end'])
+# Sin pasar por el __new__ en Python del namedtuple: se crea uno por coincidencia
+_new_match = functools.partial(tuple.__new__, IntentMatch)
+
+def _phrase_trie_pattern(phrases):
+    """Regex alternation for ``phrases`` factored as a character trie, so the
+    engine walks shared prefixes once instead of retrying every phrase"""
+    root = {}
+    for phrase in phrases:
+        node = root
+        for char in phrase:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def emit(node):
+        branches = [
+            (' +' if char == ' ' else re.escape(char)) + emit(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if branches and '' in node:
+            # Rama vacía al final en vez de (?:...)?: en cada posición gana la frase
+            # más larga, y re no tiene que montar un REPEAT por cada nodo opcional
+            branches.append('')
+        return branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+
+    return emit(root)
+
+class IntentMatcher:
+    """Keyword intent matcher compiled once into a single regex.
+
+    ``intents`` is a list of (intent, phrases) in precedence order. Phrases
+    are accent-folded and matched on word boundaries (so 'no' does not
+    match 'bueno' and 'si' does not match 'casi'). Longer phrases win at the
+    same position ('no esta bien' over 'no'), and when several intents
+    appear in one message the one listed first wins.
+    """
+
+    def __init__(self, intents):
+        self.precedence = {intent: rank for rank, (intent, _) in enumerate(intents)}
+        self._phrases = {}
+        for intent, phrases in intents:
+            for phrase in phrases:
+                key = b' '.join(fold_text(phrase).split())
+                self._phrases.setdefault(key, (intent, key.decode('latin-1')))
+
+        if self._phrases:
+            trie = _phrase_trie_pattern([key.decode('latin-1') for key in self._phrases]).encode('latin-1')
+            # Con un único byte separador delante, re busca ese literal en C y solo
+            # prueba el trie al inicio de cada palabra. _strict_pattern distingue
+            # espacios (b' ') de puntuación (b'\t'); _pattern los trata igual y es el
+            # que se usa salvo que una frase de varias palabras cruce puntuación
+            self._pattern = re.compile(b' (?:' + trie + b')(?= )')
+            self._strict_pattern = re.compile(b'[ \t](?:' + trie + b')(?=[ \t])')
         else:
-            return self.get_response('acknowledgment') + " " + self.get_response('continue_prompt')
+            self._pattern = self._strict_pattern = None
+        self._memo = {}     # texto corto -> resultado de find_all
+
+    def find_all(self, text):
+        """Every non-overlapping match, left to right (tuple of IntentMatch)"""
+        matches = self._memo.get(text)
+        if matches is None:
+            matches = self._find_all(text)
+            if len(text) <= INTENT_MEMO_MAX_LENGTH:
+                # Las respuestas cortas se repiten mucho ("si", "ok", "confirmo"); sin
+                # LRU ni lock: un get/set de dict es atómico y al llenarse se vacía
+                if len(self._memo) >= INTENT_MEMO_SIZE:
+                    self._memo.clear()
+                self._memo[text] = matches
+        return matches
+
+    def _find_all(self, text):
+        if self._pattern is None:
+            return ()
+        folded = fold_text(f' {text} ')
+
+        # Caso más común: el mensaje entero es una frase ("Sí", "ok!", "de acuerdo")
+        entry = self._phrases.get(folded.strip())
+        if entry is not None:
+            start = len(folded) - len(folded.lstrip()) - 1
+            return (_new_match((entry[0], entry[1], start, start + len(entry[1]))),)
+
+        matches = self._scan(self._pattern, folded.replace(b'\t', b' '), folded)
+        return tuple(matches if matches is not None else self._scan(self._strict_pattern, folded, None))
+
+    def _scan(self, pattern, folded, strict):
+        matches = []
+        for m in pattern.finditer(folded):
+            start, end = m.span()
+            phrase = m.group()[1:]
+            if b' ' in phrase:
+                # Entre las palabras de una frase solo vale espacio en blanco ("no, es
+                # correcto" no es "no es correcto"): si hay puntuación, pasada estricta
+                if strict is not None and strict.find(b'\t', start + 1, end) >= 0:
+                    return None
+                if b'  ' in phrase:
+                    phrase = b' '.join(phrase.split())
+            intent, phrase = self._phrases[phrase]
+            matches.append(_new_match((intent, phrase, start, end - 1)))
+        return matches
+
+    def match(self, text):
+        """Highest-precedence match (earliest on ties), or None"""
+        return self.best(self.find_all(text))
+
+    def best(self, matches):
+        """Highest-precedence entry of find_all()'s result (earliest on ties)"""
+        best = None
+        for found in matches:
+            if best is None or self.precedence[found.intent] < self.precedence[best.intent]:
+                best = found
+        return best
+
+# Respuesta del cliente en la revisión final. 'cambiar' va primero: "sí, pero
+# cambiar la cabeza" es un cambio, no una confirmación. Las dudas ("no sé si está
+# bien") vuelven a preguntar antes que confirmar, y ante un "sí" suelto junto a
+# otra negación se confirma antes que rechazar, porque rechazar reinicia todo el
+# pedido (salvo negación al inicio, ver extract_confirmation).
+CONFIRMATION_MATCHER = IntentMatcher([
+    ('cambiar', ['cambiar', 'cambia', 'cambio', 'modificar', 'change']),
+    ('pendiente', ['no se', 'no lo se', 'no estoy seguro', 'no estoy segura', 'tal vez', 'quizas', 'quiza',
+                   'not sure', 'maybe']),
+    ('confirmado', ['sí', 'si', 'confirmar', 'confirmo', 'correcto', 'ok', 'okey', 'dale', 'de acuerdo',
+                    'esta bien', 'todo bien', 'perfecto', 'no hay problema', 'no hay cambios',
+                    'yes', 'confirm', 'correct']),
+    ('rechazado', ['no', 'incorrecto', 'mal', 'esta mal', 'no esta bien', 'no es correcto',
+                   'no esta correcto', 'no confirmo', 'wrong', 'incorrect']),
+])
+
+STEP_SIGNAL_MATCHER = IntentMatcher([
+    ('continue', ['siguiente', 'listo', 'terminado', 'continuar', 'avanzar', 'ya está', 'eso es todo', 'pasemos', 'pase al siguiente',
+                  'next', 'done', 'continue']),
+    ('complete', ['completado', 'fin', 'acabado']),
+])
+
+class ResponseManager:
+    """Manages predefined responses for the chat system without AI.
+
+    The texts live in the message catalog under 'responses.<type>'
+    (see i18n/es.json); each type has several variants picked at random.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    def get_response(self, response_type, lang=None):
+        """Get a predefined response based on type"""
+        if not self.catalog.has(f"responses.{response_type}"):
+            response_type = 'acknowledgment'
+
+        return self.catalog.render(f"responses.{response_type}", lang)
+
+    def generate_step_response(self, step_id, message_content, order_data, lang=None):
+        """Generate appropriate response for current step"""
+        # Continuation or completion signals ('listo', 'siguiente', ...)
+        if STEP_SIGNAL_MATCHER.match(message_content):
+            return self.get_response('step_complete', lang=lang) + " " + self.get_response('next_section', lang=lang)
+        else:
+            return self.get_response('acknowledgment', lang=lang) + " " + self.get_response('continue_prompt', lang=lang)
+
+CHAT_WRITE_BEHIND_CONFIG = {
+    'flush_interval': float(app_settings.get('chat_flush_interval', 0.5)),  # segundos
+    'max_pending': int(app_settings.get('chat_flush_max_pending', 200))     # mensajes en buffer antes de forzar flush
+}
 
 class ConversationManager:
-    def __init__(self):
+    """Conversation persistence with a write-behind buffer.
+
+    save_message / update_order_data only queue the write; a background
+    flusher coalesces everything queued (latest order_data per user wins)
+    into one SQLite transaction every ``flush_interval`` seconds or as soon
+    as ``max_pending`` messages are waiting. Reads flush first so callers
+    always see their own writes, and flush() is also called on order
+    confirmation and at shutdown.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or CHAT_WRITE_BEHIND_CONFIG
+        self._pending_messages = []     # (user_id, role, content, timestamp)
+        self._pending_order_data = {}   # user_id -> order_data snapshot
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._flushes = 0
         self.init_database()
 
     def init_database(self):
-        """Initialize SQLite database for conversations"""
+        """Initialize SQLite database for conversations (applies pending migrations)"""
         try:
-            conn = sqlite3.connect('conversations.db')
-            cursor = conn.cursor()
-
-            # Create conversations table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT UNIQUE NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    order_data TEXT,
-                    status TEXT DEFAULT 'active'
-                )
-            ''')
-
-            # Create messages table
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    conversation_id INTEGER,
-                    role TEXT NOT NULL,
-                    content TEXT NOT NULL,
-                    timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (conversation_id) REFERENCES conversations (id)
-                )
-            ''')
-
-            conn.commit()
-            conn.close()
-            logger.info("Database initialized successfully")
+            with sqlite_pool.connection() as conn:
+                applied = run_migrations(conn)
+            logger.info(f"Database initialized successfully (migrations applied: {applied})")
 
         except Exception as e:
             logger.error(f"Database initialization error: {e}")
 
     def get_or_create_conversation(self, user_id):
-        """Get existing conversation or create new one"""
+        """Get existing conversation or create new one: (id, order_data, session settings)"""
+        self.flush()
         try:
-            conn = sqlite3.connect('conversations.db')
-            cursor = conn.cursor()
-
-            # Check if conversation exists
-            cursor.execute('SELECT id, order_data FROM conversations WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-
-            if result:
-                conv_id, order_data = result
-                order_data = json.loads(order_data) if order_data else {}
-            else:
-                # Create new conversation
-                cursor.execute('''
-                    INSERT INTO conversations (user_id, order_data) VALUES (?, ?)
-                ''', (user_id, json.dumps({})))
-                conn.commit()
-                conv_id = cursor.lastrowid
-                order_data = {}
+            with sqlite_pool.connection() as conn:
+                cursor = conn.cursor()
+
+                # Check if conversation exists
+                cursor.execute('SELECT id, order_data, lang, deltas FROM conversations WHERE user_id = ?', (user_id,))
+                result = cursor.fetchone()
+
+                if result:
+                    conv_id, order_data, lang, deltas = result
+                    order_data = json.loads(order_data) if order_data else {}
+                    blob_store.externalize(order_data)
+                    settings = {'lang': lang, 'deltas': bool(deltas)}
+                else:
+                    # Create new conversation
+                    cursor.execute('''
+                        INSERT INTO conversations (user_id, order_data) VALUES (?, ?)
+                    ''', (user_id, json.dumps({})))
+                    conn.commit()
+                    conv_id = cursor.lastrowid
+                    order_data = {}
+                    settings = {}
 
-            conn.close()
-            return conv_id, order_data
+            return conv_id, order_data, settings
 
         except Exception as e:
             logger.error(f"Error getting/creating conversation: {e}")
-            return None, {}
+            return None, {}, {}
 
-    def save_message(self, user_id, role, content, order_data=None):
-        """Save message to database"""
+    def save_session_settings(self, user_id, lang, deltas):
+        """Store the connection settings a rehydrated session must keep (language, order deltas)"""
         try:
-            conn = sqlite3.connect('conversations.db')
-            cursor = conn.cursor()
-
-            # Get conversation ID
-            cursor.execute('SELECT id FROM conversations WHERE user_id = ?', (user_id,))
-            result = cursor.fetchone()
-
-            if not result:
-                # Create conversation if it doesn't exist
-                cursor.execute('INSERT INTO conversations (user_id) VALUES (?)', (user_id,))
-                conv_id = cursor.lastrowid
-            else:
-                conv_id = result[0]
-
-            # Save message
-            cursor.execute('''
-                INSERT INTO messages (conversation_id, role, content) VALUES (?, ?, ?)
-            ''', (conv_id, role, content))
+            with sqlite_pool.connection() as conn:
+                conn.execute('UPDATE conversations SET lang = ?, deltas = ? WHERE user_id = ?',
+                             (lang, int(bool(deltas)), user_id))
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error saving session settings for {user_id}: {e}")
 
-            # Update order data if provided
+    def save_message(self, user_id, role, content, order_data=None):
+        """Queue a message (and optionally the current order data) for the next flush"""
+        # Timestamp fijado al encolar: el orden del historial no depende de cuándo se hace el flush
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        with self._lock:
+            self._pending_messages.append((user_id, role, content, timestamp))
             if order_data is not None:
-                cursor.execute('''
-                    UPDATE conversations
-                    SET order_data = ?, updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = ?
-                ''', (json.dumps(order_data), user_id))
+                self._pending_order_data[user_id] = dict(order_data)
+            full = len(self._pending_messages) >= self.config['max_pending']
+        self._schedule(full)
 
-            conn.commit()
-            conn.close()
-
-        except Exception as e:
-            logger.error(f"Error saving message: {e}")
+    def update_order_data(self, user_id, order_data):
+        """Queue an order data update for a conversation (coalesced per user)"""
+        with self._lock:
+            self._pending_order_data[user_id] = dict(order_data)
+        self._schedule(False)
 
     def get_conversation_history(self, user_id, limit=20):
         """Get conversation history for a user"""
+        self.flush()
         try:
-            conn = sqlite3.connect('conversations.db')
-            cursor = conn.cursor()
+            with sqlite_pool.connection() as conn:
+                cursor = conn.cursor()
 
-            cursor.execute('''
-                SELECT role, content, timestamp
-                FROM messages m
-                JOIN conversations c ON m.conversation_id = c.id
-                WHERE c.user_id = ?
-                ORDER BY m.timestamp ASC
-                LIMIT ?
-            ''', (user_id, limit))
-
-            messages = []
-            for role, content, timestamp in cursor.fetchall():
-                messages.append({
-                    'role': role,
-                    'content': content,
-                    'timestamp': timestamp
-                })
+                # Range scan on idx_messages_conversation_ts
+                cursor.execute('''
+                    SELECT role, content, timestamp
+                    FROM messages
+                    WHERE conversation_id = (SELECT id FROM conversations WHERE user_id = ?)
+                    ORDER BY timestamp ASC, id ASC
+                    LIMIT ?
+                ''', (user_id, limit))
+
+                messages = []
+                for role, content, timestamp in cursor.fetchall():
+                    messages.append({
+                        'role': role,
+                        'content': content,
+                        'timestamp': timestamp
+                    })
 
-            conn.close()
             return messages
 
         except Exception as e:
             logger.error(f"Error getting conversation history: {e}")
             return []
 
-    def update_order_data(self, user_id, order_data):
-        """Update order data for a conversation"""
-        try:
-            conn = sqlite3.connect('conversations.db')
-            cursor = conn.cursor()
+    def flush(self):
+        """Write everything queued so far in a single transaction"""
+        with self._flush_lock:
+            with self._lock:
+                messages, self._pending_messages = self._pending_messages, []
+                order_data, self._pending_order_data = self._pending_order_data, {}
+            if not messages and not order_data:
+                return 0
 
-            cursor.execute('''
-                UPDATE conversations
-                SET order_data = ?, updated_at = CURRENT_TIMESTAMP
-                WHERE user_id = ?
-            ''', (json.dumps(order_data), user_id))
+            try:
+                users = {m[0] for m in messages} | set(order_data)
+                with sqlite_pool.connection() as conn:
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO conversations (user_id, order_data) VALUES (?, '{}')",
+                        [(user_id,) for user_id in users]
+                    )
+                    conn.executemany('''
+                        INSERT INTO messages (conversation_id, role, content, timestamp)
+                        VALUES ((SELECT id FROM conversations WHERE user_id = ?), ?, ?, ?)
+                    ''', messages)
+                    conn.executemany('''
+                        UPDATE conversations
+                        SET order_data = ?, updated_at = CURRENT_TIMESTAMP
+                        WHERE user_id = ?
+                    ''', [(json.dumps(data), user_id) for user_id, data in order_data.items()])
+                    conn.commit()
+                self._flushes += 1
+                return len(messages)
+
+            except Exception as e:
+                logger.error(f"Error flushing conversation writes: {e}")
+                # Devolver al buffer para el siguiente intento; lo encolado después es más reciente
+                with self._lock:
+                    self._pending_messages[:0] = messages
+                    for user_id, data in order_data.items():
+                        self._pending_order_data.setdefault(user_id, data)
+                return 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending_messages': len(self._pending_messages),
+                'pending_order_data': len(self._pending_order_data),
+                'flushes': self._flushes
+            }
 
-            conn.commit()
-            conn.close()
+    def close(self):
+        """Stop the flusher and write whatever is still queued"""
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def _schedule(self, now):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._flush_loop, name='chat-write-behind', daemon=True)
+                    self._thread.start()
+        if now:
+            self._wakeup.set()
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.config['flush_interval'])
+            self._wakeup.clear()
+            self.flush()
+
+# ============= MESSAGES / I18N =============
+# Textos del bot por idioma en i18n/<lang>.json. El catálogo del idioma por
+# defecto trae las respuestas y mensajes del chat; los textos de cada flujo
+# (nombre de pasos, prompts, títulos del resumen) salen de flows/<id>.json y los
+# demás idiomas los sobrescriben bajo "flows.<id>". Lo que falte en un idioma
+# se sirve en el idioma por defecto.
+I18N_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'i18n')
+DEFAULT_LANGUAGE = app_settings.get('default_language', 'es')
+SUMMARY_CACHE_SIZE = int(app_settings.get('summary_cache_size', 512))
+
+class MessageTemplate:
+    """Bot message compiled once into literal chunks and {PLACEHOLDER} slots"""
+
+    __slots__ = ('source', 'parts', 'fields')
+
+    PLACEHOLDER = re.compile(r'\{([A-Z][A-Z0-9_]*)\}')
+
+    def __init__(self, source):
+        self.source = source
+        # split() alterna literal, placeholder, literal, ...
+        self.parts = tuple(self.PLACEHOLDER.split(source))
+        self.fields = frozenset(self.parts[1::2])
+
+    def render(self, **values):
+        if not self.fields:
+            return self.source
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = str(values.get(parts[i], ''))
+        return ''.join(parts)
+
+class MessageCatalog:
+    """Compiled message templates per language, with fallback to the default language.
+
+    Catalog files are nested JSON objects; keys are addressed with dots
+    ('chat.saved_next', 'flows.funko.steps.cabeza.prompt'). A list value holds
+    variants, one of which is picked at random on each render.
+    """
+
+    def __init__(self, directory=I18N_DIR, default_lang=DEFAULT_LANGUAGE):
+        self.default_lang = default_lang
+        self._tables = {}
+        for name in sorted(os.listdir(directory)):
+            lang, ext = os.path.splitext(name)
+            if ext.lower() != '.json':
+                continue
+            try:
+                with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                    self._tables[lang] = self._compile(json.load(f))
+                logger.info(f"Message catalog '{lang}' loaded ({len(self._tables[lang])} keys)")
+            except Exception as e:
+                logger.error(f"Error loading message catalog {name}: {e}")
+
+        if default_lang not in self._tables:
+            raise RuntimeError(f"Default message catalog '{default_lang}' not found in {directory}")
+
+    def _compile(self, tree, prefix=''):
+        table = {}
+        for key, value in tree.items():
+            path = f"{prefix}{key}"
+            if isinstance(value, dict):
+                table.update(self._compile(value, path + '.'))
+            else:
+                variants = value if isinstance(value, list) else [value]
+                table[path] = tuple(MessageTemplate(str(variant)) for variant in variants)
+        return table
+
+    def register_flow(self, flow):
+        """Add a flow's own texts as the default-language entries (catalog files take precedence)"""
+        table = self._tables[self.default_lang]
+        prefix = f"flows.{flow.id}."
+        entries = {'nombre': flow.nombre}
+        if flow.summary.get('title'):
+            entries['summary.title'] = flow.summary['title']
+        for section in flow.summary.get('sections', []):
+            entries[f"summary.sections.{section['field']}"] = section['title']
+        for step in flow.graph.steps:
+            entries[f"steps.{step.id}.nombre"] = step.nombre
+            entries[f"steps.{step.id}.prompt"] = step.prompt
+        for key, text in entries.items():
+            table.setdefault(prefix + key, (MessageTemplate(text),))
+
+    def section_aliases(self, flow_id):
+        """Translated 'cambiar <sección>' names of a flow, from every catalog"""
+        prefix = f"flows.{flow_id}.change_sections."
+        return {
+            key[len(prefix):]: variants[0].source
+            for table in self._tables.values()
+            for key, variants in table.items() if key.startswith(prefix)
+        }
+
+    @property
+    def languages(self):
+        return sorted(self._tables)
+
+    def resolve(self, lang):
+        """Supported language for a client hint ('en-US' -> 'en'), else the default"""
+        if lang:
+            lang = str(lang).lower().replace('_', '-')
+            if lang in self._tables:
+                return lang
+            base = lang.split('-', 1)[0]
+            if base in self._tables:
+                return base
+        return self.default_lang
+
+    def has(self, key):
+        return key in self._tables[self.default_lang]
+
+    def template(self, key, lang=None):
+        variants = self._tables.get(lang or self.default_lang, {}).get(key) or self._tables[self.default_lang].get(key)
+        if not variants:
+            logger.warning(f"Missing message '{key}'")
+            return MessageTemplate(key)
+        return variants[0] if len(variants) == 1 else random.choice(variants)
+
+    def render(self, key, lang=None, **values):
+        return self.template(key, lang).render(**values)
+
+message_catalog = MessageCatalog()
+
+# ============= ORDER FLOWS =============
+# Cada producto (Funko, llaveros, bustos...) es un flujo declarado en flows/<id>.json
+# (o .yaml si PyYAML está instalado). Los pasos referencian por nombre los
+# extractores y validadores registrados aquí abajo.
+FLOWS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'flows')
+DEFAULT_FLOW_ID = 'funko'
+
+STEP_EXTRACTORS = {}
+STEP_VALIDATORS = {}
+
+def step_extractor(name):
+    """Register fn(flow, step, message, extracted) as a step extractor"""
+    def register(fn):
+        STEP_EXTRACTORS[name] = fn
+        return fn
+    return register
+
+def step_validator(name):
+    """Register fn(step, order_data) -> bool as a step completion check"""
+    def register(fn):
+        STEP_VALIDATORS[name] = fn
+        return fn
+    return register
+
+@step_validator('has_content')
+def validate_has_content(step, order_data):
+    """Complete when any of the step's fields has content"""
+    for field in step.fields:
+        value = order_data.get(field)
+        if isinstance(value, str):
+            if value.strip():
+                return True
+        elif value:
+            return True
+    return False
+
+@step_validator('manual')
+def validate_manual(step, order_data):
+    """Never complete by itself (e.g. the final confirmation)"""
+    return False
+
+@step_extractor('text')
+def extract_text(flow, step, message, extracted):
+    """Store the message as-is in the step's target field"""
+    if message:
+        extracted[step.target] = message
+
+@step_extractor('confirmation')
+def extract_confirmation(flow, step, message, extracted):
+    """Classify the answer to the final review"""
+    matches = CONFIRMATION_MATCHER.find_all(message)
+    match = CONFIRMATION_MATCHER.best(matches)
+    if match and match.intent == 'confirmado' and not match.phrase.startswith('no ') \
+            and matches[0].intent == 'rechazado' and not message[:matches[0].start].strip(' \t\n¡!¿?.,;:-'):
+        # "No, si..." / "no, todo bien": la negación al inicio pesa más que el sí que
+        # viene después; no se confirma (ni se reinicia el pedido), se vuelve a preguntar
+        match = None
+    extracted[step.target] = match.intent if match else 'pendiente'
+
+    if extracted[step.target] == 'cambiar':
+        # Extraer qué se quiere cambiar
+        section = flow.section_matcher.match(message)
+        if section:
+            extracted['cambiar_seccion'] = section.intent
+
+class OrderStep:
+    """One compiled wizard step (immutable after StepGraph builds it)"""
+
+    __slots__ = ('index', 'bit', 'id', 'nombre', 'descripcion', 'prompt', 'key_field', 'fields',
+                 'target', 'extractor', 'validator', 'next_id')
+
+    def __init__(self, index, definition):
+        self.index = index
+        self.bit = 1 << index
+        self.id = definition['id']
+        self.nombre = definition['nombre']
+        self.descripcion = definition.get('descripcion', '')
+        self.prompt = definition['prompt']
+        self.key_field = definition['key_field']
+        # Campos de order_data que completan el paso / campo donde el extractor escribe
+        self.fields = tuple(definition.get('fields', (self.key_field,)))
+        self.target = definition.get('target', self.key_field)
+        self.extractor = self._lookup(STEP_EXTRACTORS, definition.get('extractor', 'text'), 'extractor')
+        self.validator = self._lookup(STEP_VALIDATORS, definition.get('validator', 'has_content'), 'validator')
+        self.next_id = definition.get('next')
+
+    def _lookup(self, registry, name, kind):
+        if name not in registry:
+            raise ValueError(f"Step '{self.id}': unknown {kind} '{name}'")
+        return registry[name]
+
+    def is_complete(self, order_data):
+        return self.validator(self, order_data)
+
+    def __repr__(self):
+        return f"OrderStep({self.id!r})"
+
+class StepGraph:
+    """Order wizard compiled once: O(1) lookups and completion as a bitmap.
+
+    Bit i of a completion bitmap is set when step i is complete. The current
+    step is the lowest clear bit, and after an edit only the steps that own
+    the changed fields are re-evaluated.
+    """
+
+    __slots__ = ('steps', 'by_id', 'by_key_field', 'by_field', 'full_mask')
+
+    def __init__(self, definitions):
+        self.steps = tuple(OrderStep(i, d) for i, d in enumerate(definitions))
+        self.by_id = MappingProxyType({step.id: step for step in self.steps})
+        self.by_key_field = MappingProxyType({step.key_field: step for step in self.steps})
+        by_field = {}
+        for step in self.steps:
+            for field in step.fields:
+                by_field.setdefault(field, []).append(step)
+        self.by_field = MappingProxyType({field: tuple(steps) for field, steps in by_field.items()})
+        self.full_mask = (1 << len(self.steps)) - 1
+
+    def next(self, step):
+        if step.next_id:
+            return self.by_id.get(step.next_id)
+        return self.steps[step.index + 1] if step.index + 1 < len(self.steps) else None
+
+    def completion(self, order_data):
+        bits = 0
+        for step in self.steps:
+            if step.is_complete(order_data):
+                bits |= step.bit
+        return bits
+
+    def update_completion(self, bits, order_data, fields):
+        """Re-evaluate only the steps that own the changed fields"""
+        for field in fields:
+            for step in self.by_field.get(field, ()):
+                if step.is_complete(order_data):
+                    bits |= step.bit
+                else:
+                    bits &= ~step.bit
+        return bits
 
+    def first_incomplete(self, bits):
+        pending = ~bits & self.full_mask
+        if not pending:
+            return None
+        return self.steps[(pending & -pending).bit_length() - 1]
+
+class OrderFlow:
+    """A product's order flow, compiled once from its definition file"""
+
+    __slots__ = ('id', 'nombre', 'fields', 'graph', 'summary', 'change_sections', 'section_matcher', 'source')
+
+    def __init__(self, definition, source=None, section_aliases=None):
+        self.id = definition['id']
+        self.nombre = definition.get('nombre', self.id)
+        self.fields = MappingProxyType(dict(definition['fields']))
+        self.graph = StepGraph(definition['steps'])
+        self.summary = definition.get('summary', {})
+        # Nombre de sección que el cliente escribe tras "cambiar" -> id del paso
+        change_sections = dict(definition.get('change_sections', {}))
+        for name, step_id in (section_aliases or {}).items():
+            change_sections.setdefault(name, step_id)
+        self.change_sections = MappingProxyType(change_sections)
+        self.section_matcher = IntentMatcher([(name, [name]) for name in self.change_sections])
+        self.source = source
+
+        for step_id in self.change_sections.values():
+            if step_id not in self.graph.by_id:
+                raise ValueError(f"Flow '{self.id}': change section points to unknown step '{step_id}'")
+
+def load_flows(directory=FLOWS_DIR, catalog=None):
+    """Load and compile every flow definition in directory, keyed by flow id"""
+    flows = {}
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        ext = os.path.splitext(name)[1].lower()
+        try:
+            if ext == '.json':
+                with open(path, 'r', encoding='utf-8') as f:
+                    definition = json.load(f)
+            elif ext in ('.yaml', '.yml'):
+                if yaml is None:
+                    logger.warning(f"Skipping flow {name}: PyYAML is not installed")
+                    continue
+                with open(path, 'r', encoding='utf-8') as f:
+                    definition = yaml.safe_load(f)
+            else:
+                continue
+            aliases = catalog.section_aliases(definition.get('id')) if catalog else None
+            flow = OrderFlow(definition, source=path, section_aliases=aliases)
+            if catalog:
+                catalog.register_flow(flow)
+            flows[flow.id] = flow
+            logger.info(f"Order flow '{flow.id}' loaded ({len(flow.graph.steps)} steps)")
         except Exception as e:
-            logger.error(f"Error updating order data: {e}")
+            logger.error(f"Error loading order flow {name}: {e}")
 
-class FunkoOrderManager:
-    def __init__(self):
-        self.pasos_orden = [
-            {
-                'id': 'datos_cliente',
-                'nombre': 'DATOS DEL CLIENTE',
-                'descripcion': 'nombre y telefono del cliente',
-                'prompt': "📱 **DATOS DE CONTACTO:**\n\nPara finalizar tu pedido, necesito tus datos:\n\n• **Nombre completo:**\n• **Número de WhatsApp:** (con código de país)\n\nEjemplo: Juan Pérez, +51 987654321\n\n¿Cuál es tu nombre y número de teléfono?",
-                'key_field': 'datos_cliente'
-            },
-            {
-                'id': 'cabeza',
-                'nombre': 'CABEZA',
-                'descripcion': 'detalles de la cabeza',
-                'prompt': "🧠 **Vamos a diseñar la CABEZA de tu Funko:**\n\nPor favor, descríbeme en detalle:\n• **Cabello:** color, estilo, longitud\n• **Rostro:** forma, expresión, características especiales\n• **Accesorios:** casco, gafas, sombrero, diadema, etc.\n• **Otros detalles:** barba, bigote, maquillaje, etc.\n\nPuedes darme los detalles en varios mensajes si lo prefieres. Cuando termines, dime **'listo'** o **'continuar'**.\n\n¿Cómo quieres la cabeza de tu figura?",
-                'key_field': 'cabeza'
-            },
-            {
-                'id': 'parte_superior',
-                'nombre': 'PARTE SUPERIOR DEL CUERPO',
-                'descripcion': 'detalles del torso y brazos',
-                'prompt': "👕 **Ahora la PARTE SUPERIOR DEL CUERPO:**\n\nDescribe el torso y brazos:\n• **Torso:** camisa, polo, suéter, chaleco, blusa (color y estilo)\n• **Brazos:** posición, tatuajes, relojes, brazalete\n• **Hombros:** hombreras, mochila, etc.\n\nPuedes agregar detalles en varios mensajes. Cuando termines, dime **'listo'** o **'continuar'**.\n\n¿Qué detalles quieres para la parte superior?",
-                'key_field': 'parte_superior'
-            },
-            {
-                'id': 'parte_inferior',
-                'nombre': 'PARTE INFERIOR DEL CUERPO',
-                'descripcion': 'detalles de cintura hacia abajo',
-                'prompt': "👖 **Ahora la PARTE INFERIOR DEL CUERPO:**\n\nDescribe desde la cintura hacia abajo:\n• **Cintura/Cadera:** cinturón, faldas, shorts\n• **Piernas:** pantalón, jeans, vestido (estilo y color)\n• **Posición:** de pie, sentado, corriendo, saltando\n\nPuedes agregar detalles en varios mensajes. Cuando termines, dime **'listo'** o **'continuar'**.\n\n¿Cómo quieres la parte inferior del cuerpo?",
-                'key_field': 'parte_inferior'
-            },
-            {
-                'id': 'pies',
-                'nombre': 'PIES',
-                'descripcion': 'detalles del calzado',
-                'prompt': "👟 **Finalmente los PIES y calzado:**\n\nDescribe:\n• **Calzado:** botas, tenis, zapatos, sandalias, zapatillas\n• **Estilo:** deportivo, formal, casual, color específico\n• **Detalles:** cordones, hebillas, plataforma, etc.\n\n¿Qué tipo de calzado quieres?",
-                'key_field': 'pies'
-            },
-            {
-                'id': 'fotos_referencia',
-                'nombre': 'FOTOS DE REFERENCIA',
-                'descripcion': 'imágenes de apoyo',
-                'prompt': "📸 **FOTOS DE REFERENCIA (OBLIGATORIO):**\n\nPor favor sube al menos una imagen de referencia para tu Funko.\n\nUsa el botón de imagen 🖼️ para subir fotos.\n\n• Si ya subiste tus fotos, escribe **'listo'** para continuar.\n• Si no tienes fotos, escribe **'no tengo'**.",
-                'key_field': 'fotos_referencia'
-            },
-            {
-                'id': 'detalles_adicionales',
-                'nombre': 'DETALLES ADICIONALES',
-                'descripcion': 'elementos extra',
-                'prompt': "✨ **DETALLES ADICIONALES:**\n\n¿Hay algo más que debamos considerar?\n• **Accesorios extra:** bolso, herramienta, mascota, etc.\n• **Base o soporte:** texto en la base, logo, etc.\n• **Notas especiales:** cualquier detalle importante\n\n¿Algo más que agregar?",
-                'key_field': 'detalles_adicionales'
-            },
-            {
-                'id': 'confirmacion',
-                'nombre': 'CONFIRMACIÓN FINAL',
-                'descripcion': 'confirmar todo el pedido',
-                'prompt': "📋 **¡REVISIÓN FINAL DEL PEDIDO!**\n\nPor favor, revisa cuidadosamente todos los detalles:\n\n{RESUMEN_COMPLETO}\n\n**¿Está todo CORRECTO?**\n\nResponde:\n• **SÍ** - para confirmar y enviar tu pedido\n• **NO** - para corregir algo\n• **CAMBIAR [sección]** - para modificar una parte específica\n\nEscribe tu respuesta:",
-                'key_field': 'confirmacion'
-            }
-        ]
+    if DEFAULT_FLOW_ID not in flows:
+        raise RuntimeError(f"Default order flow '{DEFAULT_FLOW_ID}' not found in {directory}")
+    return flows
 
-        # Removed default_order from __init__ to avoid mutable state issues
-        # We will use a method to get a fresh copy
+ORDER_FLOWS = load_flows(catalog=message_catalog)
+
+def get_flow(flow_id):
+    """Flow by id, falling back to the default product"""
+    return ORDER_FLOWS.get(flow_id) or ORDER_FLOWS[DEFAULT_FLOW_ID]
+
+class FunkoOrderManager:
+    """Order wizard logic for one product flow (see OrderFlow)"""
+
+    def __init__(self, flow, catalog=None):
+        self.flow = flow
+        self.graph = flow.graph
+        self.pasos_orden = flow.graph.steps
+        self.catalog = catalog or message_catalog
+        # Resúmenes ya renderizados, por idioma + valores de las secciones
+        self._summary_cache = OrderedDict()
+        self._summary_lock = threading.Lock()
+        self._summary_hits = 0
+        self._summary_misses = 0
 
     @property
     def default_order(self):
         """Return a fresh copy of default order structure"""
-        return {
-            'datos_cliente': '',
-            'cabeza': '',
-            'parte_superior': '',
-            'parte_inferior': '',
-            'pies': '',
-            'detalles_adicionales': '',
-            'fotos_referencia': [],
-            'fotos_comentarios': '',
-            'confirmacion': ''
-        }
+        order = copy.deepcopy(dict(self.flow.fields))
+        order['producto'] = self.flow.id
+        return order
 
-    def get_current_step(self, order_data):
-        """Determinar en qué paso está el pedido"""
+    def get_current_step(self, order_data, completed=None):
+        """Determinar en qué paso está el pedido (primer paso incompleto)"""
         if not order_data:
             return self.pasos_orden[0]
+        if completed is None:
+            completed = self.graph.completion(order_data)
+        return self.graph.first_incomplete(completed)  # None = completado
 
-        # Check if current step has data
-        for i, paso in enumerate(self.pasos_orden):
-            if not self._is_step_complete(order_data, paso):
-                return paso
+    def get_completion(self, order_data):
+        """Completion bitmap for an order (bit i = step i complete)"""
+        return self.graph.completion(order_data) if order_data else 0
 
-        return None  # Completado
+    def update_completion(self, completed, order_data, fields):
+        """Update a completion bitmap after the given order_data fields changed"""
+        if completed is None:
+            return self.get_completion(order_data)
+        return self.graph.update_completion(completed, order_data, fields)
 
     def _is_step_complete(self, order_data, paso):
         """Check if a specific step is complete"""
-        if paso['id'] == 'confirmacion':
-            return False  # La confirmación es manual
-
-        key_field = paso['key_field']
-
-        # Special logic for photo step
-        if key_field == 'fotos_referencia':
-            has_photos = len(order_data.get('fotos_referencia', [])) > 0
-            has_comments = bool(order_data.get('fotos_comentarios', '').strip())
-            return has_photos or has_comments
-
-        # Special logic for detalles_adicionales (optional)
-        if key_field == 'detalles_adicionales':
-            # It's always "complete" in terms of not blocking, BUT to be a step in the flow
-            # we need to know if we should move past it.
-            # In our new auto-advance logic, we move next if it HAS content.
-            # If it's empty, get_current_step will return it, so we stop there.
-            # This matches "part of the flow".
-            pass
-
-        # NUEVA LÓGICA: Una sección está completa si tiene contenido
-        value = order_data.get(key_field, '')
-        has_content = bool(value and value.strip())
-
-        return has_content
+        return paso.is_complete(order_data)
 
     def get_next_step(self, current_step_id):
         """Get the next step after current one"""
-        for i, paso in enumerate(self.pasos_orden):
-            if paso['id'] == current_step_id and i + 1 < len(self.pasos_orden):
-                return self.pasos_orden[i + 1]
-        return None
+        step = self.graph.by_id.get(current_step_id)
+        return self.graph.next(step) if step else None
 
     def extract_step_info(self, message, step_id):
         """Extract information specific to the current step"""
-        message_clean = message.strip()
-        extracted = self.default_order.copy() # Now uses property, so it's fresh dict
-        # But wait, property returns new dict, so .copy() is redundant but safe.
-        # Actually property returns new dict each time.
-        # But 'fotos_referencia': [] is new list each time.
-        # So shallow copy of return value of property is fine.
-        # Actually better to just call property.
         extracted = self.default_order
-
-        if step_id == 'datos_cliente':
-            extracted['datos_cliente'] = message_clean
-        
-        elif step_id == 'cabeza':
-            extracted['cabeza'] = message_clean
-
-        elif step_id == 'parte_superior':
-            extracted['parte_superior'] = message_clean
-
-        elif step_id == 'parte_inferior':
-            extracted['parte_inferior'] = message_clean
-
-        elif step_id == 'pies':
-            extracted['pies'] = message_clean
-
-        elif step_id == 'detalles_adicionales':
-            extracted['detalles_adicionales'] = message_clean
-
-        elif step_id == 'fotos_referencia':
-            # If user types text here, save it as comments about photos
-            if message_clean:
-                extracted['fotos_comentarios'] = message_clean
-
-        elif step_id == 'confirmacion':
-            # Extraer respuesta de confirmación
-            message_lower = message_clean.lower()
-
-            if any(word in message_lower for word in ['sí', 'si', 'confirmar', 'correcto', 'ok']):
-                extracted['confirmacion'] = 'confirmado'
-            elif any(word in message_lower for word in ['no', 'incorrecto', 'mal']):
-                extracted['confirmacion'] = 'rechazado'
-            elif 'cambiar' in message_lower:
-                extracted['confirmacion'] = 'cambiar'
-                # Extraer qué se quiere cambiar
-                for section in ['cabeza', 'parte superior', 'parte inferior', 'pies', 'detalles']:
-                    if section in message_lower:
-                        extracted['cambiar_seccion'] = section
-                        break
-            else:
-                extracted['confirmacion'] = 'pendiente'
-
+        step = self.graph.by_id.get(step_id)
+        if step:
+            step.extractor(self.flow, step, message.strip(), extracted)
         return extracted
 
     def get_step_by_id(self, step_id):
         """Get step object by ID"""
-        for paso in self.pasos_orden:
-            if paso['id'] == step_id:
-                return paso
-        return None
+        return self.graph.by_id.get(step_id)
+
+    def get_step_by_key(self, key_field):
+        """Get step object by the order_data field it fills"""
+        return self.graph.by_key_field.get(key_field)
 
     def merge_order_data(self, current_order, new_data):
         """Merge new extracted data into current order"""
@@ -536,84 +2365,489 @@ class FunkoOrderManager:
 
         return current_order
 
-    def get_completion_summary(self, order_data):
-        """Generate a complete summary of the order"""
-        if not order_data:
-            return "No hay datos del pedido."
+    def text(self, key, lang=None, **values):
+        """Render one of this flow's catalog texts ('nombre', 'steps.<id>.prompt', ...)"""
+        return self.catalog.render(f"flows.{self.flow.id}.{key}", lang, **values)
 
-        summary = "**📋 RESUMEN COMPLETO DEL PEDIDO FUNKO:**\n\n"
+    def step_name(self, step, lang=None):
+        return self.text(f"steps.{step.id}.nombre", lang)
 
-        sections = [
-            ('🧠', 'CABEZA', 'cabeza'),
-            ('👕', 'PARTE SUPERIOR', 'parte_superior'),
-            ('👖', 'PARTE INFERIOR', 'parte_inferior'),
-            ('👟', 'PIES', 'pies'),
-            ('✨', 'DETALLES ADICIONALES', 'detalles_adicionales')
-        ]
+    def step_prompt(self, step, order_data=None, lang=None):
+        """Prompt of a step; {RESUMEN_COMPLETO} is filled with the (cached) order summary"""
+        template = self.catalog.template(f"flows.{self.flow.id}.steps.{step.id}.prompt", lang)
+        if 'RESUMEN_COMPLETO' in template.fields:
+            return template.render(RESUMEN_COMPLETO=self.get_completion_summary(order_data, lang))
+        return template.render()
 
-        for emoji, title, key in sections:
-            value = order_data.get(key, '')
-            if value and value.strip():
-                summary += f"{emoji} **{title}:**\n{value}\n\n"
-            else:
-                summary += f"{emoji} **{title}:** No especificado\n\n"
+    def get_completion_summary(self, order_data, lang=None):
+        """Generate a complete summary of the order.
+
+        Summaries are memoized on the values they show (section texts and photo
+        count), so re-rendering the review step costs one lookup until the
+        customer actually changes a section.
+        """
+        if not order_data:
+            return self.catalog.render('summary.empty', lang)
+
+        lang = self.catalog.resolve(lang)
+        summary_config = self.flow.summary
+        sections = summary_config.get('sections', [])
+        fotos = order_data.get(summary_config.get('photos_field', 'fotos_referencia')) or []
+        key = (lang, len(fotos)) + tuple(order_data.get(section['field']) or '' for section in sections)
+
+        with self._summary_lock:
+            summary = self._summary_cache.get(key)
+            if summary is not None:
+                self._summary_cache.move_to_end(key)
+                self._summary_hits += 1
+                return summary
+            self._summary_misses += 1
+
+        title_key = f"flows.{self.flow.id}.summary.title"
+        if self.catalog.has(title_key):
+            blocks = [self.catalog.render(title_key, lang)]
+        else:
+            blocks = [self.catalog.render('summary.title', lang, PRODUCT=self.text('nombre', lang).upper())]
+
+        for section, value in zip(sections, key[2:]):
+            blocks.append(self.catalog.render(
+                'summary.section' if value.strip() else 'summary.section_empty', lang,
+                EMOJI=section['emoji'],
+                TITLE=self.text(f"summary.sections.{section['field']}", lang),
+                VALUE=value
+            ))
 
         # Fotos de referencia
-        fotos = order_data.get('fotos_referencia', [])
         if fotos:
-            summary += f"📸 **FOTOS DE REFERENCIA:** {len(fotos)} archivo(s) subido(s)\n\n"
+            blocks.append(self.catalog.render('summary.photos', lang, COUNT=len(fotos)))
 
+        summary = '\n\n'.join(blocks) + '\n\n'
+        with self._summary_lock:
+            self._summary_cache[key] = summary
+            while len(self._summary_cache) > SUMMARY_CACHE_SIZE:
+                self._summary_cache.popitem(last=False)
         return summary
 
+    def summary_cache_stats(self):
+        with self._summary_lock:
+            return {
+                'size': len(self._summary_cache),
+                'hits': self._summary_hits,
+                'misses': self._summary_misses
+            }
+
     def get_section_to_change(self, section_name):
         """Get the step ID for a section name"""
-        section_mapping = {
-            'cabeza': 'cabeza',
-            'parte superior': 'parte_superior',
-            'parte inferior': 'parte_inferior',
-            'pies': 'pies',
-            'detalles': 'detalles_adicionales'
+        sections = self.flow.change_sections
+        default = next(iter(sections.values()), self.pasos_orden[0].id)
+        return sections.get(section_name.lower(), default)
+
+# ============= SMTP =============
+def smtp_config(settings):
+    return {
+        'host': settings.get('smtp_server', 'mail.peru-code.com'),
+        'port': int(settings.get('smtp_port', 465)),
+        'security': settings.get('smtp_security', 'ssl'),        # ssl (465) | starttls (587) | none
+        'username': settings.get('smtp_username', 'forms@peru-code.com'),
+        'password': settings.get('smtp_password', '1wVTFLsQIrt36OG9'),
+        'timeout': float(settings.get('smtp_timeout', 30)),
+        'pool_size': int(settings.get('smtp_pool_size', 2)),          # requiere reiniciar
+        'checkout_timeout': float(settings.get('smtp_checkout_timeout', 60)),
+        'keepalive_interval': float(settings.get('smtp_keepalive', 60)),  # NOOP a conexiones ociosas
+        'max_idle': float(settings.get('smtp_max_idle', 240)),            # después se cierra (los servidores cortan ~5 min)
+        'max_messages': int(settings.get('smtp_max_messages', 100))       # mensajes por sesión antes de reciclarla
+    }
+
+SMTP_CONFIG = smtp_config(app_settings)
+
+# Cambiarlas invalida las sesiones abiertas (servidor o credenciales distintos)
+SMTP_CONNECTION_KEYS = ('host', 'port', 'security', 'username', 'password', 'timeout')
+
+class SMTPPool:
+    """Authenticated SMTP sessions reused across emails.
+
+    A connection pays the TLS handshake and AUTH once and then delivers up to
+    ``max_messages`` emails. Idle sessions get a NOOP every
+    ``keepalive_interval`` seconds and are closed after ``max_idle``; a
+    session the server dropped is replaced and the send retried once.
+    When the server or credentials change, sessions opened with the old
+    ones are closed instead of being reused.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._idle = deque()   # [smtp, last_used, messages_sent, generation]
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(config['pool_size'])
+        self._stop = threading.Event()
+        self._keepalive_thread = None
+        self._stats = {
+            'sent': 0, 'failed': 0, 'connects': 0, 'reconnects': 0,
+            'noops': 0, 'expired': 0, 'in_use': 0, 'send_seconds': 0.0, 'last_error': None
         }
-        return section_mapping.get(section_name.lower(), 'cabeza')
+
+    def _connect(self):
+        config = self.config
+        if config['security'] == 'ssl':
+            smtp = smtplib.SMTP_SSL(config['host'], config['port'], timeout=config['timeout'])
+        else:
+            smtp = smtplib.SMTP(config['host'], config['port'], timeout=config['timeout'])
+            if config['security'] == 'starttls':
+                smtp.starttls()
+        try:
+            smtp.ehlo_or_helo_if_needed()
+            if config['username']:
+                smtp.login(config['username'], config['password'])
+        except Exception:
+            self._discard(smtp)
+            raise
+        with self._lock:
+            self._stats['connects'] += 1
+        return [smtp, time.time(), 0, self._generation]
+
+    def on_settings_changed(self, settings, changed):
+        """Apply smtp_* settings; smtp_pool_size only takes effect after a restart"""
+        if not any(key.startswith('smtp_') for key in changed):
+            return
+        config = smtp_config(settings)
+        if config['pool_size'] != self.config['pool_size']:
+            logger.warning("smtp_pool_size changed: restart to apply it")
+        config['pool_size'] = self.config['pool_size']
+        reconnect = any(config[key] != self.config[key] for key in SMTP_CONNECTION_KEYS)
+        with self._lock:
+            self.config = config
+            if reconnect:
+                self._generation += 1
+                stale, self._idle = list(self._idle), deque()
+            else:
+                stale = []
+        for entry in stale:
+            self._discard(entry[0])
+        logger.info(f"SMTP settings updated ({config['host']}:{config['port']})")
+
+    def _discard(self, smtp):
+        try:
+            smtp.quit()
+        except Exception:
+            try:
+                smtp.close()
+            except Exception:
+                pass
+
+    def acquire(self):
+        """Check out an authenticated session (reused when one is idle)"""
+        if not self._slots.acquire(timeout=self.config['checkout_timeout']):
+            raise smtplib.SMTPException('SMTP pool exhausted')
+        try:
+            entry, expired = None, []
+            with self._lock:
+                while self._idle:
+                    candidate = self._idle.pop()
+                    if time.time() - candidate[1] < self.config['max_idle'] and candidate[3] == self._generation:
+                        entry = candidate
+                        break
+                    expired.append(candidate)
+                self._stats['expired'] += len(expired)
+                self._stats['in_use'] += 1
+            for candidate in expired:
+                self._discard(candidate[0])
+            return entry or self._connect()
+        except Exception:
+            with self._lock:
+                self._stats['in_use'] -= 1
+            self._slots.release()
+            raise
+
+    def release(self, entry, healthy=True):
+        if healthy and entry[2] < self.config['max_messages'] and entry[3] == self._generation:
+            entry[1] = time.time()
+            with self._lock:
+                self._idle.append(entry)
+            self._start_keepalive()
+        else:
+            self._discard(entry[0])
+        with self._lock:
+            self._stats['in_use'] -= 1
+        self._slots.release()
+
+    def send(self, from_addr, to_addrs, message):
+        """Deliver one message over a pooled session; returns refused recipients.
+
+        ``message`` is a str/bytes, or a binary file with CRLF lines (see
+        StreamingMIMEMessage) that is streamed to the socket and rewound for
+        the retry.
+        """
+        started = time.time()
+        recipients = [to_addrs] if isinstance(to_addrs, str) else to_addrs
+        with tracer.span('smtp send', 'CLIENT', {'smtp.server': self.config['host'], 'smtp.recipients': len(recipients)}) as span:
+            entry = self.acquire()
+            try:
+                try:
+                    refused = self._deliver(entry[0], from_addr, to_addrs, message)
+                except OSError as e:
+                    # Sesión cerrada por el servidor (timeout, reinicio) o socket caído: una nueva y un reintento.
+                    # Las respuestas SMTP (5xx, destinatarios rechazados, error tras DATA) son SMTPException
+                    # (subclase de OSError) y no se reenvían: el servidor pudo haber aceptado el mensaje
+                    if isinstance(e, smtplib.SMTPException) and not isinstance(e, smtplib.SMTPServerDisconnected):
+                        raise
+                    logger.warning(f"SMTP session lost ({e}), reconnecting")
+                    self._discard(entry[0])
+                    with self._lock:
+                        self._stats['reconnects'] += 1
+                    if span is not None:
+                        span.set_attribute('smtp.reconnected', True)
+                    entry = self._connect()
+                    refused = self._deliver(entry[0], from_addr, to_addrs, message)
+            except Exception as e:
+                with self._lock:
+                    self._stats['failed'] += 1
+                    self._stats['last_error'] = f"{type(e).__name__}: {e}"
+                self.release(entry, healthy=False)
+                SMTP_FAILURES.inc(type(e).__name__)
+                SMTP_SEND_SECONDS.observe(time.time() - started)
+                raise
+
+            entry[2] += 1
+            self.release(entry)
+            with self._lock:
+                self._stats['sent'] += 1
+                self._stats['send_seconds'] += time.time() - started
+            SMTP_SEND_SECONDS.observe(time.time() - started)
+            return refused
+
+    def _deliver(self, smtp, from_addr, to_addrs, message):
+        if not hasattr(message, 'read'):
+            return smtp.sendmail(from_addr, to_addrs, message)
+        message.seek(0)
+        return self._sendmail_stream(smtp, from_addr, to_addrs, message)
+
+    def _sendmail_stream(self, smtp, from_addr, to_addrs, fp):
+        """smtplib's sendmail() for a message file: DATA is written in blocks of
+        lines (dot-stuffed) instead of from one string holding the whole email"""
+        code, resp = smtp.mail(from_addr)
+        if code != 250:
+            smtp.rset()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        refused = {}
+        for addr in to_addrs:
+            code, resp = smtp.rcpt(addr)
+            if code not in (250, 251):
+                refused[addr] = (code, resp)
+        if len(refused) == len(to_addrs):
+            smtp.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        code, resp = smtp.docmd('data')
+        if code != 354:
+            smtp.rset()
+            raise smtplib.SMTPDataError(code, resp)
+        block, pending = [], 0
+        for line in fp:
+            if line.startswith(b'.'):
+                line = b'.' + line
+            block.append(line)
+            pending += len(line)
+            if pending >= 64 * 1024:
+                smtp.send(b''.join(block))
+                block, pending = [], 0
+        block.append(b'.\r\n')
+        smtp.send(b''.join(block))
+        code, resp = smtp.getreply()
+        if code != 250:
+            raise smtplib.SMTPDataError(code, resp)
+        return refused
+
+    def _start_keepalive(self):
+        if self._keepalive_thread is None:
+            with self._lock:
+                if self._keepalive_thread is None:
+                    self._keepalive_thread = threading.Thread(
+                        target=self._keepalive_loop, name='smtp-keepalive', daemon=True
+                    )
+                    self._keepalive_thread.start()
+
+    def _keepalive_loop(self):
+        while not self._stop.wait(max(1.0, self.config['keepalive_interval'] / 2)):
+            interval = self.config['keepalive_interval']
+            now = time.time()
+            with self._lock:
+                due = [e for e in self._idle if now - e[1] >= interval]
+                for entry in due:
+                    self._idle.remove(entry)
+            for entry in due:
+                if now - entry[1] >= self.config['max_idle']:
+                    with self._lock:
+                        self._stats['expired'] += 1
+                    self._discard(entry[0])
+                    continue
+                try:
+                    entry[0].noop()
+                except Exception as e:
+                    logger.info(f"SMTP keepalive failed, dropping session: {e}")
+                    self._discard(entry[0])
+                    continue
+                with self._lock:
+                    self._stats['noops'] += 1
+                    # last_used no cambia: max_idle cuenta desde el último envío
+                    stale = entry[3] != self._generation
+                    if not stale:
+                        self._idle.appendleft(entry)
+                if stale:
+                    self._discard(entry[0])
+
+    def close(self):
+        self._stop.set()
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for entry in idle:
+            self._discard(entry[0])
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+        send_seconds = stats.pop('send_seconds')
+        stats['avg_send_ms'] = round(send_seconds / stats['sent'] * 1000, 1) if stats['sent'] else None
+        stats['size'] = self.config['pool_size']
+        stats['server'] = f"{self.config['host']}:{self.config['port']}"
+        return stats
+
+smtp_pool = SMTPPool(SMTP_CONFIG)
+app_settings.subscribe(smtp_pool.on_settings_changed)
+atexit.register(smtp_pool.close)
+
+# ============= STREAMING MIME =============
+EMAIL_CONFIG = {
+    'spool_memory': int(app_settings.get('email_spool_memory', 1024 * 1024)),       # más allá, el mensaje pasa a disco
+    'max_message_bytes': int(app_settings.get('email_max_bytes', 20 * 1024 * 1024))  # la mayoría de servidores corta en 25 MB
+}
+
+def mime_param(name, value):
+    """Content-Type/Disposition parameter, RFC 2231 encoded when not ASCII"""
+    value = re.sub(r'[\r\n]', ' ', str(value))
+    if value.isascii():
+        return '{}="{}"'.format(name, value.replace('\\', '_').replace('"', "'"))
+    return f"{name}*=utf-8''{quote(value, safe='')}"
+
+def base64_encoded_size(size):
+    """Bytes a payload of ``size`` bytes takes as base64 in 76-char CRLF lines"""
+    encoded = (size + 2) // 3 * 4
+    return encoded + (encoded + 75) // 76 * 2
+
+class StreamingMIMEMessage:
+    """multipart/related message written part by part into a spooled file.
+
+    Parts are base64-encoded from their source file in blocks of 57 KB, so an
+    email never holds more than ``spool_memory`` bytes of message plus one
+    block in memory: past that the spool rolls over to a temporary file.
+    Lines end in CRLF, ready for SMTPPool.send to stream it as DATA.
+    """
+
+    BLOCK = 57 * 1024   # 57 bytes de entrada = una línea base64 de 76 caracteres
+
+    def __init__(self, subtype='related', spool_memory=None):
+        self.spool_memory = spool_memory or EMAIL_CONFIG['spool_memory']
+        self.fp = tempfile.SpooledTemporaryFile(max_size=self.spool_memory)
+        self.boundary = f"=_cuix_{secrets.token_hex(12)}"
+        self.subtype = subtype
+        self.size = 0
+        self._headers = []
+        self._started = False
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.size += len(data)
+
+    def add_header(self, name, value):
+        if not value.isascii():
+            value = Header(value, 'utf-8').encode()
+        self._headers.append(f"{name}: {value}")
+
+    def _begin_part(self, headers):
+        if not self._started:
+            content_type = f'multipart/{self.subtype}; boundary="{self.boundary}"'
+            if self.subtype == 'related':
+                content_type += '; type="text/html"'
+            lines = self._headers + ['MIME-Version: 1.0', f"Content-Type: {content_type}", '']
+            self._write('\r\n'.join(lines).encode('ascii') + b'\r\n')
+            self._started = True
+        lines = [f"--{self.boundary}"] + headers + ['Content-Transfer-Encoding: base64', '']
+        self._write('\r\n'.join(lines).encode('ascii') + b'\r\n')
+
+    def _write_base64(self, block):
+        encoded = base64.encodebytes(block)   # líneas de 76 caracteres terminadas en \n
+        self._write(encoded.replace(b'\n', b'\r\n'))
+
+    def attach_text(self, text, subtype='html'):
+        self._begin_part([f'Content-Type: text/{subtype}; charset="utf-8"'])
+        data = text.encode('utf-8')
+        for start in range(0, len(data), self.BLOCK):
+            self._write_base64(data[start:start + self.BLOCK])
+
+    def attach_file(self, f, mime, filename=None, content_id=None, disposition='attachment'):
+        """Stream a binary file into a base64 part (inline parts get a Content-ID)"""
+        headers = [f"Content-Type: {mime}"]
+        disposition_value = disposition
+        if filename:
+            disposition_value += '; ' + mime_param('filename', filename)
+        headers.append(f"Content-Disposition: {disposition_value}")
+        if content_id:
+            headers.append(f"Content-ID: <{content_id}>")
+        self._begin_part(headers)
+        for block in iter(lambda: f.read(self.BLOCK), b''):
+            self._write_base64(block)
+
+    def finish(self):
+        """Close the multipart and return the spooled file, rewound"""
+        if not self._started:
+            self._begin_part(['Content-Type: text/plain; charset="utf-8"'])
+        self._write(f"--{self.boundary}--\r\n".encode('ascii'))
+        self.fp.seek(0)
+        return self.fp
+
+    @property
+    def spooled_to_disk(self):
+        return self.size > self.spool_memory
+
+    def close(self):
+        self.fp.close()
 
 class EmailManager:
-    def __init__(self):
-        self.smtp_server = "mail.peru-code.com"
-        self.smtp_port = 465
-        self.smtp_username = "forms@peru-code.com"
-        self.smtp_password = "1wVTFLsQIrt36OG9"
-        self.from_email = "forms@peru-code.com"
+    def __init__(self, smtp=None):
+        self.smtp = smtp or smtp_pool
+        self.from_email = app_settings.get('smtp_from', SMTP_CONFIG['username'] or 'forms@peru-code.com')
         self.from_name = "Funko Live Chat"
         self.to_email = "cuicuix.studio@gmail.com"
-        self.settings = self.load_settings()
-
-    def load_settings(self):
-        """Load settings from config file"""
-        try:
-            config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-            if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    return json.load(f)
-        except Exception as e:
-            logger.error(f"Error loading settings: {e}")
-        return {'email_enabled': True, 'email_destinatarios': 'cuicuix.studio@gmail.com'}
+        self.destinatarios = self.parse_destinatarios(app_settings.get('email_destinatarios'))
+        app_settings.subscribe(self.on_settings_changed)
+
+    def on_settings_changed(self, settings, changed):
+        """Rebuild the cached recipient list when email_destinatarios changes"""
+        if 'smtp_from' in changed or 'smtp_username' in changed:
+            self.from_email = settings.get('smtp_from', settings.get('smtp_username') or 'forms@peru-code.com')
+        if 'email_destinatarios' in changed:
+            self.destinatarios = self.parse_destinatarios(settings.get('email_destinatarios'))
+            logger.info(f"Email recipients updated: {self.destinatarios}")
+
+    def parse_destinatarios(self, destinatarios):
+        if not destinatarios:
+            return [self.to_email]
+        if isinstance(destinatarios, str):
+            return [e.strip() for e in destinatarios.split(',') if e.strip()]
+        return list(destinatarios)
 
     def is_email_enabled(self):
         """Check if email sending is enabled"""
-        self.settings = self.load_settings()  # Reload each time
-        return self.settings.get('email_enabled', True)
+        return app_settings.get('email_enabled', True)
 
     def get_destinatarios(self):
         """Get destination emails from settings"""
-        self.settings = self.load_settings()  # Reload each time
-        destinatarios = self.settings.get('email_destinatarios', 'cuicuix.studio@gmail.com')
-        if isinstance(destinatarios, str):
-            return [e.strip() for e in destinatarios.split(',') if e.strip()]
-        return destinatarios
+        app_settings.refresh()
+        return self.destinatarios
 
     def extract_customer_info(self, datos_cliente):
         """Extraer nombre y teléfono del campo datos_cliente"""
-        import re
         nombre = 'Cliente Web'
         telefono = ''
         
@@ -633,107 +2867,118 @@ class EmailManager:
     def save_order_to_db(self, order_data, user_id):
         """Guardar pedido en MySQL (tabla orders)"""
         try:
-            conn = get_mysql_connection()
-            if not conn:
-                logger.warning("MySQL no disponible, usando SQLite")
-                return self.save_order_to_sqlite(order_data, user_id)
-
-            cursor = conn.cursor()
-
-            # Extraer nombre y teléfono del cliente
-            datos_cliente = order_data.get('datos_cliente', '')
-            customer_name, customer_phone = self.extract_customer_info(datos_cliente)
+            with db_pool.connection() as conn:
+                if not conn:
+                    logger.warning("MySQL no disponible, usando SQLite")
+                    return self.save_order_to_sqlite(order_data, user_id)
 
-            # Generar descripción combinada del pedido
-            description = f"Cabeza: {order_data.get('cabeza', '')}\n"
-            description += f"Parte Superior: {order_data.get('parte_superior', '')}\n"
-            description += f"Parte Inferior: {order_data.get('parte_inferior', '')}\n"
-            description += f"Pies: {order_data.get('pies', '')}\n"
-            description += f"Detalles: {order_data.get('detalles_adicionales', '')}"
+                cursor = conn.cursor()
 
-            # Guardar como JSON en order_data
-            import json
-            order_json = json.dumps(order_data, ensure_ascii=False)
+                # Extraer nombre y teléfono del cliente
+                datos_cliente = order_data.get('datos_cliente', '')
+                customer_name, customer_phone = self.extract_customer_info(datos_cliente)
 
-            cursor.execute('''
-                INSERT INTO orders (user_id, customer_name, customer_phone, order_type, order_data, price, status, created_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
-            ''', (
-                user_id,
-                customer_name,
-                customer_phone,
-                'Funko Personalizado',
-                order_json,
-                0,
-                'pending'
-            ))
+                # Guardar como JSON en order_data
+                order_json = json.dumps(order_data, ensure_ascii=False)
 
-            conn.commit()
-            order_id = cursor.lastrowid
-            conn.close()
+                cursor.execute('''
+                    INSERT INTO orders (user_id, customer_name, customer_phone, order_type, order_data, price, status, created_at)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, NOW())
+                ''', (
+                    user_id,
+                    customer_name,
+                    customer_phone,
+                    get_flow(order_data.get('producto')).nombre,
+                    order_json,
+                    0,
+                    'pending'
+                ))
 
-            logger.info(f"Pedido {order_id} guardado en MySQL")
-            return order_id
+                conn.commit()
+                order_id = cursor.lastrowid
 
         except Exception as e:
             logger.error(f"Error guardando pedido en MySQL: {str(e)}")
             # Fallback a SQLite
             return self.save_order_to_sqlite(order_data, user_id)
 
+        # El pedido ya está confirmado en MySQL: nada de aquí en adelante puede volver a guardarlo
+        logger.info(f"Pedido {order_id} guardado en MySQL")
+        self.notify_order_created(order_id, 'mysql')
+        return order_id
+
     def save_order_to_sqlite(self, order_data, user_id):
         """Fallback: guardar pedido en SQLite"""
         try:
-            conn = sqlite3.connect('conversations.db')
-            cursor = conn.cursor()
-
-            # Agregar columna order_data si no existe
-            cursor.execute("PRAGMA table_info(orders)")
-            columns = [col[1] for col in cursor.fetchall()]
-            if 'order_data' not in columns:
-                cursor.execute("ALTER TABLE orders ADD COLUMN order_data TEXT")
-
             # Extraer nombre y teléfono del cliente
             datos_cliente = order_data.get('datos_cliente', '')
             customer_name, customer_phone = self.extract_customer_info(datos_cliente)
 
-            description = f"Cabeza: {order_data.get('cabeza', '')}\n"
-            description += f"Parte Superior: {order_data.get('parte_superior', '')}\n"
-            description += f"Parte Inferior: {order_data.get('parte_inferior', '')}\n"
-            description += f"Pies: {order_data.get('pies', '')}\n"
-            description += f"Detalles: {order_data.get('detalles_adicionales', '')}"
-
             # Guardar como JSON completo
             order_json = json.dumps(order_data, ensure_ascii=False)
 
-            cursor.execute('''
-                INSERT INTO orders (user_id, cliente, customer_phone, tipo, description, clothing, shoes, accessories, order_data, price, status, created_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                user_id,
-                customer_name,
-                customer_phone,
-                'Funko Personalizado',
-                description,
-                order_data.get('parte_superior', ''),
-                order_data.get('pies', ''),
-                order_data.get('detalles_adicionales', ''),
-                order_json,
-                0,
-                'pending',
-                datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            ))
-
-            conn.commit()
-            order_id = cursor.lastrowid
-            conn.close()
+            with sqlite_pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute('''
+                    INSERT INTO orders (user_id, cliente, customer_phone, tipo, description, clothing, shoes, accessories, order_data, price, status, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (
+                    user_id,
+                    customer_name,
+                    customer_phone,
+                    get_flow(order_data.get('producto')).nombre,
+                    build_order_description(order_data),
+                    order_data.get('parte_superior', ''),
+                    order_data.get('pies', ''),
+                    order_data.get('detalles_adicionales', ''),
+                    order_json,
+                    0,
+                    'pending',
+                    datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                ))
 
-            logger.info(f"Pedido {order_id} guardado en SQLite")
-            return order_id
+                conn.commit()
+                order_id = cursor.lastrowid
 
         except Exception as e:
             logger.error(f"Error guardando pedido en SQLite: {str(e)}")
             return None
 
+        logger.info(f"Pedido {order_id} guardado en SQLite")
+        self.notify_order_created(order_id, 'sqlite')
+        return order_id
+
+    def notify_order_created(self, order_id, backend):
+        """Push a saved order to the admin feed and the report rollups.
+
+        Runs after the commit and only logs on failure: a broken feed or
+        rollup must never make the caller (or the order job) save it again.
+        """
+        try:
+            if backend == 'mysql':
+                with db_pool.connection() as conn:
+                    cursor = conn.cursor(dictionary=True)
+                    cursor.execute(f"SELECT {ORDER_SUMMARY_COLUMNS_MYSQL} FROM orders WHERE id = %s", (order_id,))
+                    item = mysql_order_item(cursor.fetchone())
+            else:
+                with sqlite_pool.connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.row_factory = sqlite3.Row
+                    cursor.execute(f"SELECT {ORDER_SUMMARY_COLUMNS_SQLITE} FROM orders WHERE id = ?", (order_id,))
+                    item = sqlite_order_item(cursor.fetchone())
+        except Exception as e:
+            logger.error(f"Error leyendo pedido {order_id} para el feed: {e}")
+            return
+
+        try:
+            admin_feed.order_created(item)
+        except Exception as e:
+            logger.error(f"Error publicando pedido {order_id} en el feed: {e}")
+        try:
+            report_manager.order_created(item)
+        except Exception as e:
+            logger.error(f"Error actualizando reportes del pedido {order_id}: {e}")
+
     def send_order_email(self, order_data, user_id):
         """Enviar correo electrónico con el resumen del pedido"""
         try:
@@ -748,47 +2993,57 @@ class EmailManager:
                 logger.warning("No destination emails configured")
                 return False
             
-            msg = MIMEMultipart()
-            msg['From'] = formataddr((self.from_name, self.from_email))
-            msg['To'] = ', '.join(destinatarios)
-            msg['Subject'] = f"🎯 Nuevo Pedido Funko Personalizado - {datetime.now().strftime('%Y-%m-%d %H:%M')}"
-
-            html_content = self.generate_order_html(order_data, user_id)
-            html_part = MIMEText(html_content, 'html', 'utf-8')
-            msg.attach(html_part)
-
-            # Attach photos
+            # Cada foto una sola vez: parte inline (cid:) que el HTML referencia
+            # y que los clientes de correo ofrecen también para descargar
             fotos = order_data.get('fotos_referencia', [])
-            for i, foto in enumerate(fotos):
-                try:
-                    # Check if data has header (e.g. "data:image/png;base64,")
-                    img_data_str = foto.get('data', '')
-                    if ',' in img_data_str:
-                        img_data_str = img_data_str.split(',')[1]
-
-                    img_data = base64.b64decode(img_data_str)
+            budget = EMAIL_CONFIG['max_message_bytes'] - 64 * 1024   # HTML y cabeceras
+            inline_images, sources = [], []
+            try:
+                for i, foto in enumerate(fotos):
                     img_filename = foto.get('filename', f'referencia_{i+1}.jpg')
+                    try:
+                        # Versión reducida y sin EXIF cuando está disponible (ver ImageProcessor)
+                        f, img_mime, size = image_processor.open(foto, 'display')
+                    except Exception as e:
+                        logger.error(f"Error attaching image {i}: {str(e)}")
+                        continue
+                    if base64_encoded_size(size) > budget:
+                        f.close()
+                        logger.warning(f"Image {i} ({size} bytes) exceeds the email size limit, not attached")
+                        inline_images.append({'filename': img_filename, 'cid': None})
+                        continue
+                    budget -= base64_encoded_size(size)
+                    if img_mime == 'image/jpeg' and foto.get('mime') != 'image/jpeg' and foto.get('hash'):
+                        img_filename = os.path.splitext(img_filename)[0] + '.jpg'
+                    if not img_mime.startswith('image/'):
+                        img_mime = mimetypes.guess_type(img_filename)[0] or 'image/jpeg'
+                    cid = make_msgid(f'foto{i+1}', 'cuix')[1:-1]
+                    inline_images.append({'filename': img_filename, 'cid': cid})
+                    sources.append((f, img_mime, img_filename, cid))
+
+                msg = StreamingMIMEMessage('related')
+                msg.add_header('From', formataddr((self.from_name, self.from_email)))
+                msg.add_header('To', ', '.join(destinatarios))
+                msg.add_header('Subject', f"🎯 Nuevo Pedido {get_flow(order_data.get('producto')).nombre} - {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+                msg.add_header('Date', formatdate(localtime=True))
+                msg.add_header('Message-ID', make_msgid(domain='cuix'))
+                msg.attach_text(self.generate_order_html(order_data, user_id, inline_images))
+                for f, img_mime, img_filename, cid in sources:
+                    msg.attach_file(f, img_mime, img_filename, content_id=cid, disposition='inline')
+            finally:
+                for source in sources:
+                    source[0].close()
 
-                    # Guess content type based on extension or default to jpeg
-                    maintype = 'image'
-                    subtype = 'jpeg'
-                    if img_filename.lower().endswith('.png'):
-                        subtype = 'png'
-                    elif img_filename.lower().endswith('.gif'):
-                        subtype = 'gif'
-
-                    img = MIMEImage(img_data, _subtype=subtype)
-                    img.add_header('Content-Disposition', 'attachment', filename=img_filename)
-                    msg.attach(img)
-                except Exception as e:
-                    logger.error(f"Error attaching image {i}: {str(e)}")
-
-            # Usar SMTP_SSL para puerto 465 (SSL directo)
-            with smtplib.SMTP_SSL(self.smtp_server, self.smtp_port) as server:
-                server.login(self.smtp_username, self.smtp_password)
-                server.sendmail(self.from_email, destinatarios, msg.as_string())
-
-            logger.info(f"Email enviado exitosamente a {destinatarios}")
+            try:
+                # Sesión SMTP reutilizada del pool (TLS + AUTH una sola vez)
+                self.smtp.send(self.from_email, destinatarios, msg.finish())
+            finally:
+                msg.close()
+
+            logger.info(
+                f"Email enviado exitosamente a {destinatarios} "
+                f"({msg.size} bytes, {len(sources)} fotos, spool {'en disco' if msg.spooled_to_disk else 'en memoria'})"
+            )
             return True
 
         except smtplib.SMTPAuthenticationError as e:
@@ -801,49 +3056,60 @@ class EmailManager:
             logger.error(f"Error enviando correo: {str(e)}")
             return False
 
-    def generate_order_html(self, order_data, user_id):
-        """Generar contenido HTML para el correo del pedido"""
+    def generate_order_html(self, order_data, user_id, inline_images=None):
+        """Generar contenido HTML para el correo del pedido.
+
+        inline_images: [{'filename', 'cid'}] de las fotos adjuntas como partes
+        inline; cid None si la foto no se adjuntó.
+        """
         order_date = datetime.now().strftime('%d/%m/%Y a las %H:%M')
 
-        sections = [
-            ('🧠', 'CABEZA', 'cabeza'),
-            ('👕', 'PARTE SUPERIOR DEL CUERPO', 'parte_superior'),
-            ('👖', 'PARTE INFERIOR DEL CUERPO', 'parte_inferior'),
-            ('👟', 'PIES', 'pies'),
-            ('✨', 'DETALLES ADICIONALES', 'detalles_adicionales')
-        ]
+        # Secciones y campo de fotos del flujo del producto, como en get_completion_summary
+        manager = order_managers.get(order_data.get('producto')) or order_managers[DEFAULT_FLOW_ID]
+        summary_config = manager.flow.summary
 
         sections_html = ""
-        for emoji, title, key in sections:
-            value = order_data.get(key, '')
-            if value and value.strip():
+        for section in summary_config.get('sections', []):
+            title = manager.text(f"summary.sections.{section['field']}")
+            value = order_data.get(section['field']) or ''
+            if value.strip():
+                value_html = value.replace('\n', '<br>')
                 sections_html += f"""
                 <div class="section">
-                    <h3>{emoji} {title}</h3>
-                    <p>{value.replace('\n', '<br>')}</p>
+                    <h3>{section['emoji']} {title}</h3>
+                    <p>{value_html}</p>
                 </div>
                 """
             else:
                 sections_html += f"""
                 <div class="section">
-                    <h3>{emoji} {title}</h3>
+                    <h3>{section['emoji']} {title}</h3>
                     <p><em>No especificado</em></p>
                 </div>
                 """
 
-        # Fotos
-        fotos = order_data.get('fotos_referencia', [])
-        if fotos:
+        # Fotos (referenciadas por cid:, la imagen va una sola vez en el correo)
+        if inline_images is None:
+            inline_images = [
+                {'filename': foto.get('filename', f'imagen_{i+1}'), 'cid': None}
+                for i, foto in enumerate(order_data.get(summary_config.get('photos_field', 'fotos_referencia')) or [])
+            ]
+        if inline_images:
             fotos_html = "<div class='fotos-grid' style='display: flex; flex-wrap: wrap; gap: 10px;'>"
-            for i, foto in enumerate(fotos):
-                img_data = foto.get('data', '')
-                img_filename = foto.get('filename', f'imagen_{i+1}')
-                if img_data:
+            for image in inline_images:
+                img_filename = image['filename']
+                if image['cid']:
                     fotos_html += f"""
-                    <div class="foto-item">
-                        <img src="data:image/jpeg;base64,{img_data}" alt="{img_filename}" style="max-width: 150px; max-height: 150px; border-radius: 8px; border: 2px solid #FF6B6B;">
-                    </div>
-                    """
+                <div class="foto-item">
+                    <img src="cid:{image['cid']}" alt="{img_filename}" style="max-width: 150px; max-height: 150px; border-radius: 8px; border: 2px solid #FF6B6B;">
+                </div>
+                """
+                else:
+                    fotos_html += f"""
+                <div class="foto-item">
+                    <p><em>{img_filename} (no adjuntada por tamaño)</em></p>
+                </div>
+                """
             fotos_html += "</div>"
         else:
             fotos_html = "<p><em>No se subieron fotos de referencia</em></p>"
@@ -908,21 +3174,453 @@ class EmailManager:
 
         return html
 
+# ============= ORDER FINALIZATION PIPELINE =============
+ORDER_JOBS_CONFIG = {
+    'workers': 2,
+    'max_attempts': 6,
+    'backoff_base': 10,      # segundos; se duplica en cada reintento
+    'backoff_max': 900,
+    'lease_seconds': 300,    # un job 'running' sin terminar se reintenta tras el lease
+    'poll_interval': 5
+}
+
+class OrderJobQueue:
+    """Durable queue that finalizes confirmed orders off the socket handler.
+
+    Jobs are rows of ``order_jobs`` in conversations.db (created by migration
+    4), so a restart picks up
+    whatever was still pending. A job first saves the order (its order_id is
+    recorded so retries never insert twice) and then sends the email; any
+    failed step is retried with exponential backoff up to ``max_attempts``.
+    """
+
+    def __init__(self, config, email_manager):
+        self.config = config
+        self.email_manager = email_manager
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._workers = []
+        self._start_lock = threading.Lock()
+
+    def enqueue(self, order_data, user_id, notify_sid=None):
+        """Persist a finalization job and wake a worker; returns the job id"""
+        with sqlite_pool.connection() as conn:
+            cursor = conn.execute('''
+                INSERT INTO order_jobs (user_id, order_data, notify_sid, next_run_at)
+                VALUES (?, ?, ?, ?)
+            ''', (user_id, json.dumps(order_data, ensure_ascii=False), notify_sid, time.time()))
+            conn.commit()
+            job_id = cursor.lastrowid
+
+        logger.info(f"Pedido de {user_id[:8]} encolado (job {job_id})")
+        self.start()
+        self._wakeup.set()
+        return job_id
+
+    def get_jobs(self, status=None, limit=50):
+        """Recent jobs with their status, newest first"""
+        query = '''
+            SELECT id, user_id, status, attempts, order_id, email_sent, last_error, created_at, updated_at
+            FROM order_jobs
+        '''
+        params = []
+        if status:
+            query += ' WHERE status = ?'
+            params.append(status)
+        query += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+
+        with sqlite_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(query, params)
+            return [dict(row) for row in cursor.fetchall()]
+
+    def start(self):
+        """Start the worker threads (idempotent)"""
+        with self._start_lock:
+            if self._workers or self._stopping:
+                return
+            for i in range(self.config['workers']):
+                worker = threading.Thread(target=self._worker_loop, name=f'order-job-{i}', daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        logger.info(f"Order finalization workers started ({self.config['workers']})")
+
+    def stop(self):
+        self._stopping = True
+        self._wakeup.set()
+
+    def _claim(self):
+        """Atomically take the next due job (pending, or running with an expired lease)"""
+        now = time.time()
+        with sqlite_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute('''
+                SELECT id FROM order_jobs
+                WHERE (status = 'pending' AND next_run_at <= ?)
+                   OR (status = 'running' AND locked_until < ?)
+                ORDER BY id LIMIT 1
+            ''', (now, now))
+            row = cursor.fetchone()
+            if not row:
+                return None
+
+            cursor.execute('''
+                UPDATE order_jobs
+                SET status = 'running', attempts = attempts + 1, locked_until = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE id = ? AND (status = 'pending' OR (status = 'running' AND locked_until < ?))
+            ''', (now + self.config['lease_seconds'], row['id'], now))
+            conn.commit()
+            if cursor.rowcount != 1:
+                return None  # Otro worker lo tomó primero
+
+            cursor.execute('SELECT * FROM order_jobs WHERE id = ?', (row['id'],))
+            return dict(cursor.fetchone())
+
+    def _update(self, job_id, **fields):
+        assignments = ', '.join(f"{key} = ?" for key in fields)
+        with sqlite_pool.connection() as conn:
+            conn.execute(
+                f"UPDATE order_jobs SET {assignments}, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
+                list(fields.values()) + [job_id]
+            )
+            conn.commit()
+
+    def _run(self, job):
+        order_data = json.loads(job['order_data'])
+        user_id = job['user_id']
+        order_id = job['order_id']
+        email_sent = bool(job['email_sent'])
+        error = None
+
+        if not order_id:
+            with tracer.span('save_order_to_db'):
+                order_id = self.email_manager.save_order_to_db(order_data, user_id)
+            if order_id:
+                self._update(job['id'], order_id=order_id)
+            else:
+                error = 'No se pudo guardar el pedido'
+
+        if order_id and not email_sent and self.email_manager.is_email_enabled():
+            with tracer.span('send_order_email'):
+                email_sent = self.email_manager.send_order_email(order_data, user_id)
+            if email_sent:
+                self._update(job['id'], email_sent=1)
+            else:
+                error = 'No se pudo enviar el correo'
+
+        if error is None:
+            self._update(job['id'], status='done', last_error=None, locked_until=None)
+            logger.info(f"Job {job['id']} completado (pedido {order_id})")
+        elif job['attempts'] >= self.config['max_attempts']:
+            self._update(job['id'], status='failed', last_error=error, locked_until=None)
+            logger.error(f"Job {job['id']} falló definitivamente: {error}")
+        else:
+            delay = min(self.config['backoff_base'] * 2 ** (job['attempts'] - 1), self.config['backoff_max'])
+            self._update(job['id'], status='pending', last_error=error, locked_until=None, next_run_at=time.time() + delay)
+            logger.warning(f"Job {job['id']} reintentará en {delay}s: {error}")
+
+        # Avisar al cliente tras el primer intento; los reintentos siguen en segundo plano
+        if job['attempts'] == 1 and job['notify_sid']:
+            socketio.emit('order_finalized', {
+                'order_id': order_id,
+                'email_sent': email_sent,
+                'saved': bool(order_id),
+                'timestamp': datetime.now().isoformat()
+            }, to=job['notify_sid'])
+
+    def _worker_loop(self):
+        while not self._stopping:
+            try:
+                job = self._claim()
+            except Exception as e:
+                logger.error(f"Error claiming order job: {e}")
+                job = None
+
+            if job is None:
+                self._wakeup.wait(self.config['poll_interval'])
+                self._wakeup.clear()
+                continue
+
+            try:
+                with tracer.trace('order_job finalize', 'INTERNAL', {'job.id': job['id'], 'job.attempt': job['attempts']}):
+                    tracer.annotate(user_id=job['user_id'], step_id='confirmacion')
+                    self._run(job)
+            except Exception as e:
+                logger.error(f"Error running order job {job['id']}: {e}")
+                self._update(job['id'], status='pending', last_error=str(e), locked_until=None,
+                             next_run_at=time.time() + self.config['backoff_base'])
+
+# ============= SESSION STORE =============
+SESSION_STORE_CONFIG = {
+    # memory | redis; con cola de mensajes compartida las sesiones también se comparten por defecto
+    'backend': os.environ.get('CUIX_SESSION_BACKEND', app_settings.get('session_backend', 'redis' if MESSAGE_QUEUE else 'memory')),
+    'redis_url': os.environ.get('CUIX_REDIS_URL', app_settings.get('session_redis_url', MESSAGE_QUEUE or 'redis://localhost:6379/0')),
+    'ttl': int(app_settings.get('session_ttl', 3600)),                        # segundos sin actividad
+    'max_sessions': int(app_settings.get('session_max_sessions', 2000)),
+    'max_bytes': int(app_settings.get('session_max_bytes', 64 * 1024 * 1024))
+}
+
+class MemorySessionBackend:
+    """Per-process LRU of live session dicts with TTL and a byte budget"""
+
+    shared = False
+
+    def __init__(self, ttl, max_sessions, max_bytes):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()   # user_id -> (session, size, expires_at)
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            if item[2] < time.time():
+                self._remove(user_id)
+                self._evictions += 1
+                return None
+            self._items.move_to_end(user_id)
+            return item[0]
+
+    def set(self, user_id, session, size):
+        with self._lock:
+            if user_id in self._items:
+                self._remove(user_id)
+            self._items[user_id] = (session, size, time.time() + self.ttl)
+            self._bytes += size
+            self._evict()
+
+    def delete(self, user_id):
+        with self._lock:
+            if user_id in self._items:
+                self._remove(user_id)
+
+    def release(self, user_id):
+        """Called when the user's last socket goes away"""
+        self.delete(user_id)
+
+    def _remove(self, user_id):
+        _, size, _ = self._items.pop(user_id)
+        self._bytes -= size
+
+    def _evict(self):
+        now = time.time()
+        # Los más antiguos están al principio: expirados primero, luego LRU hasta volver al presupuesto
+        while self._items:
+            user_id, (_, _, expires_at) = next(iter(self._items.items()))
+            if expires_at >= now and len(self._items) <= self.max_sessions and self._bytes <= self.max_bytes:
+                break
+            self._remove(user_id)
+            self._evictions += 1
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._items), 'bytes': self._bytes, 'evictions': self._evictions}
+
+class RedisSessionBackend:
+    """Sessions shared between worker processes, stored as JSON with a TTL"""
+
+    shared = True
+
+    def __init__(self, client, ttl, prefix='cuix:session:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, user_id):
+        raw = self.client.get(self.prefix + user_id)
+        return json.loads(raw) if raw else None
+
+    def set(self, user_id, session, size):
+        self.client.set(self.prefix + user_id, session, ex=self.ttl)
+
+    def delete(self, user_id):
+        self.client.delete(self.prefix + user_id)
+
+    def release(self, user_id):
+        # Otro worker puede seguir atendiendo al cliente; el TTL se encarga del resto
+        pass
+
+    def __len__(self):
+        return sum(1 for _ in self.client.scan_iter(match=self.prefix + '*', count=500))
+
+    def stats(self):
+        return {'sessions': len(self)}
+
+class SessionStore:
+    """Conversation sessions keyed by user id, plus the Socket.IO sid -> user map.
+
+    A session missing from the backend (evicted, expired, or created by
+    another worker) is rebuilt lazily from ConversationManager, order data
+    and connection settings included, so eviction only costs a database read. Handlers must call save() after mutating a
+    session; with the shared backend that is what publishes the change.
+    """
+
+    def __init__(self, config, conversation_manager, order_managers):
+        self.config = config
+        self.conversations = conversation_manager
+        self.managers = order_managers
+        self.backend = self._create_backend(config)
+        self._sids = {}   # sid -> user_id (solo conexiones de este proceso)
+        self._user_sids = {}   # user_id -> set de sids, para saber cuándo se va el último
+        self._lock = threading.Lock()
+
+    def _create_backend(self, config):
+        if config['backend'] == 'redis':
+            client = connect_redis(config['redis_url'], 'Session store')
+            if client is not None:
+                return RedisSessionBackend(client, config['ttl'])
+        return MemorySessionBackend(config['ttl'], config['max_sessions'], config['max_bytes'])
+
+    def manager_for(self, session):
+        """Order manager of the session's product flow"""
+        return self.managers.get(session.get('product')) or self.managers[DEFAULT_FLOW_ID]
+
+    def new_session(self, conversation_id, order_data, product=None, lang=None, deltas=False):
+        # El producto elegido al conectar, o el guardado en el pedido al rehidratar
+        product = product or (order_data or {}).get('producto')
+        manager = self.managers.get(product) or self.managers[DEFAULT_FLOW_ID]
+        order_data = order_data or manager.default_order
+        return {
+            'conversation_id': conversation_id,
+            'product': manager.flow.id,
+            'lang': message_catalog.resolve(lang),
+            'order_data': order_data,
+            'current_step': manager.get_current_step(order_data),
+            'completed': manager.get_completion(order_data),
+            # Protocolo de deltas (ver order_update_payload)
+            'deltas': bool(deltas),
+            'order_version': 0,
+            'order_synced': copy.deepcopy(order_data),
+            'connected_at': datetime.now().isoformat()
+        }
+
+    def get(self, user_id):
+        """Return the user's session, rehydrating it from the database if needed"""
+        if not user_id:
+            return None
+        try:
+            stored = self.backend.get(user_id)
+        except Exception as e:
+            logger.error(f"Error reading session {user_id}: {e}")
+            stored = None
+        if stored is not None:
+            session = self._decode(stored) if self.backend.shared else stored
+        else:
+            conv_id, order_data, settings = self.conversations.get_or_create_conversation(user_id)
+            if conv_id is None:
+                return None
+            session = self.new_session(conv_id, order_data, lang=settings.get('lang'), deltas=settings.get('deltas'))
+            self.save(user_id, session)
+        # Paso en el que estaba el usuario al entrar al handler
+        step = session.get('current_step')
+        tracer.annotate(user_id=user_id, step_id=step.id if step else None, flow_id=session.get('product'))
+        return session
+
+    def save(self, user_id, session):
+        try:
+            encoded = self._encode(session)
+            self.backend.set(user_id, encoded if self.backend.shared else session, len(encoded))
+        except Exception as e:
+            logger.error(f"Error saving session {user_id}: {e}")
+
+    def delete(self, user_id):
+        self.backend.delete(user_id)
+
+    def bind(self, sid, user_id):
+        with self._lock:
+            self._sids[sid] = user_id
+            self._user_sids.setdefault(user_id, set()).add(sid)
+
+    def unbind(self, sid):
+        """Forget a disconnected socket; release the session if it was the user's last one"""
+        with self._lock:
+            user_id = self._sids.pop(sid, None)
+            sids = self._user_sids.get(user_id)
+            last = False
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._user_sids[user_id]
+                    last = True
+        if last:
+            self.backend.release(user_id)
+        return user_id
+
+    def _encode(self, session):
+        current_step = session.get('current_step')
+        return json.dumps(dict(session, current_step=current_step.id if current_step else None))
+
+    def _decode(self, stored):
+        step_id = stored.get('current_step')
+        stored['current_step'] = self.manager_for(stored).get_step_by_id(step_id) if step_id else None
+        return stored
+
+    def __len__(self):
+        return len(self.backend)
+
+    def stats(self):
+        stats = self.backend.stats()
+        stats['backend'] = 'redis' if self.backend.shared else 'memory'
+        stats['sockets'] = len(self._sids)
+        return stats
+
 # Initialize managers (NO OLLAMA)
-response_manager = ResponseManager()
+response_manager = ResponseManager(message_catalog)
 conversation_manager = ConversationManager()
-order_manager = FunkoOrderManager()
+atexit.register(conversation_manager.close)
+order_managers = {flow_id: FunkoOrderManager(flow, message_catalog) for flow_id, flow in ORDER_FLOWS.items()}
+order_manager = order_managers[DEFAULT_FLOW_ID]
 email_manager = EmailManager()
+order_jobs = OrderJobQueue(ORDER_JOBS_CONFIG, email_manager)
+atexit.register(order_jobs.stop)
 
 # Active sessions storage
-conversation_sessions = {}
+session_store = SessionStore(SESSION_STORE_CONFIG, conversation_manager, order_managers)
 
 # ============= AUTH DECORATOR =============
+# Tokens del panel: "<user_id>.<expira>.<HMAC-SHA256>" firmados con el secreto
+# configurado (CUIX_ADMIN_SECRET o admin_token_secret). Sin secreto configurado
+# se genera uno al arrancar: los tokens caducan al reiniciar el servidor.
+ADMIN_TOKEN_SECRET = os.environ.get('CUIX_ADMIN_SECRET') or app_settings.get('admin_token_secret')
+if not ADMIN_TOKEN_SECRET:
+    ADMIN_TOKEN_SECRET = secrets.token_hex(32)
+    logger.warning("admin_token_secret no configurado: las sesiones del panel no sobreviven a un reinicio")
+ADMIN_TOKEN_TTL = int(app_settings.get('admin_token_ttl', 12 * 3600))   # segundos
+
+def _admin_token_signature(payload):
+    return hmac.new(ADMIN_TOKEN_SECRET.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+def verify_admin_token(token):
+    """User id of a valid, unexpired admin token, or None"""
+    if not isinstance(token, str) or token.count('.') != 2:
+        return None
+    payload, signature = token.rsplit('.', 1)
+    if not hmac.compare_digest(signature, _admin_token_signature(payload)):
+        return None
+    user_id, expires = payload.split('.')
+    try:
+        if int(expires) < time.time():
+            return None
+    except ValueError:
+        return None
+    return user_id
+
 def require_auth(f):
     """Decorator to require authentication"""
     def decorated(*args, **kwargs):
         auth_header = request.headers.get('Authorization', '')
-        if not auth_header.startswith('Bearer '):
+        if not auth_header.startswith('Bearer ') or verify_admin_token(auth_header[len('Bearer '):]) is None:
             return jsonify({'error': 'No autorizado'}), 401
         return f(*args, **kwargs)
     decorated.__name__ = f.__name__
@@ -958,157 +3656,867 @@ def admin_html():
     response.headers['Expires'] = '0'
     return response
 
+# ============= ORDER LISTING =============
+ORDERS_PAGE_SIZE = 50
+ORDERS_MAX_PAGE_SIZE = 200
+
+def encode_order_cursor(created_at, order_id):
+    """Opaque keyset cursor for (created_at, id)"""
+    raw = json.dumps([str(created_at), order_id]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_order_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    created_at, order_id = json.loads(base64.urlsafe_b64decode(padded))
+    return created_at, int(order_id)
+
+def parse_order_filters(args):
+    """Read pagination, filter and projection parameters from the query string"""
+    try:
+        limit = int(args.get('limit', ORDERS_PAGE_SIZE))
+    except ValueError:
+        limit = ORDERS_PAGE_SIZE
+
+    filters = {
+        'limit': max(1, min(limit, ORDERS_MAX_PAGE_SIZE)),
+        'cursor': decode_order_cursor(args['cursor']) if args.get('cursor') else None,
+        'status': args.get('status') or None,
+        'date_from': args.get('date_from') or None,
+        'date_to': args.get('date_to') or None,
+        'phone': args.get('phone') or None,
+        'fields': 'summary' if args.get('fields') == 'summary' else 'full'
+    }
+
+    # date_to es inclusivo: se compara contra el inicio del día siguiente
+    if filters['date_to']:
+        filters['date_to'] = (datetime.strptime(filters['date_to'], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+
+    return filters
+
+def build_order_where(filters, placeholder, phone_column, with_cursor=True):
+    """WHERE clause and parameters shared by the MySQL and SQLite queries"""
+    clauses = []
+    params = []
+
+    if filters['status']:
+        clauses.append(f"status = {placeholder}")
+        params.append(filters['status'])
+    if filters['date_from']:
+        clauses.append(f"created_at >= {placeholder}")
+        params.append(filters['date_from'])
+    if filters['date_to']:
+        clauses.append(f"created_at < {placeholder}")
+        params.append(filters['date_to'])
+    if filters['phone']:
+        clauses.append(f"{phone_column} LIKE {placeholder}")
+        params.append(f"%{filters['phone']}%")
+    if with_cursor and filters['cursor']:
+        created_at, order_id = filters['cursor']
+        clauses.append(f"(created_at < {placeholder} OR (created_at = {placeholder} AND id < {placeholder}))")
+        params.extend([created_at, created_at, order_id])
+
+    where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+    return where, params
+
+def build_order_description(order_data):
+    """Texto combinado de las secciones del pedido"""
+    return (
+        f"Cabeza: {order_data.get('cabeza', '')}\n"
+        f"Parte Superior: {order_data.get('parte_superior', '')}\n"
+        f"Parte Inferior: {order_data.get('parte_inferior', '')}\n"
+        f"Pies: {order_data.get('pies', '')}\n"
+        f"Detalles: {order_data.get('detalles_adicionales', '')}"
+    )
+
+def format_order_list_item(row, cliente, tipo, price, created_at, updated_at, full):
+    """Order as returned by /api/admin/orders (optionally without order_data)"""
+    item = {
+        'id': row['id'],
+        'user_id': row['user_id'],
+        'cliente': cliente,
+        'tipo': tipo,
+        'price': price,
+        'status': row['status'] or 'pending',
+        'customer_phone': row['customer_phone'] or '',
+        'created_at': created_at,
+        'updated_at': updated_at
+    }
+
+    if full:
+        order_data = row['order_data'] or {}
+        if isinstance(order_data, (str, bytes)):
+            try:
+                order_data = json.loads(order_data)
+            except Exception:
+                order_data = {}
+        item.update({
+            'description': build_order_description(order_data),
+            'clothing': order_data.get('parte_superior', ''),
+            'shoes': order_data.get('pies', ''),
+            'accessories': order_data.get('detalles_adicionales', ''),
+            'order_data': order_data
+        })
+
+    return item
+
+ORDER_SUMMARY_COLUMNS_MYSQL = 'id, user_id, customer_name, customer_phone, order_type, price, status, created_at, updated_at'
+ORDER_SUMMARY_COLUMNS_SQLITE = 'id, user_id, cliente, customer_phone, tipo, price, status, created_at, updated_at'
+
+def mysql_order_item(row, full=False):
+    return format_order_list_item(
+        row,
+        row['customer_name'] or 'Cliente Web',
+        row['order_type'] or 'Funko Personalizado',
+        float(row['price']) if row['price'] else 0,
+        str(row['created_at']) if row['created_at'] else None,
+        str(row['updated_at']) if row['updated_at'] else None,
+        full
+    )
+
+def sqlite_order_item(row, full=False):
+    return format_order_list_item(
+        row,
+        row['cliente'] or 'Cliente Web',
+        row['tipo'] or 'Funko Personalizado',
+        row['price'] or 0,
+        row['created_at'],
+        row['updated_at'],
+        full
+    )
+
+def paginate_orders(items, filters):
+    """Trim the extra look-ahead row and build the response with next_cursor"""
+    next_cursor = None
+    if len(items) > filters['limit']:
+        items = items[:filters['limit']]
+        next_cursor = encode_order_cursor(items[-1]['created_at'], items[-1]['id'])
+    return jsonify({'orders': items, 'next_cursor': next_cursor})
+
+# ============= ADMIN REAL-TIME FEED =============
+ADMIN_NAMESPACE = '/admin'
+
+class AdminFeed:
+    """Pushes order_created / order_updated deltas to open admin dashboards.
+
+    Each event carries a sequence number and is kept in a bounded replay
+    buffer: a reconnecting tab sends the last sequence it applied and gets
+    only the events it missed, or ``resync_required`` if it fell behind the
+    buffer and must reload the list over HTTP.
+
+    With a Redis client the sequence and the buffer live in Redis, so every
+    worker process numbers events the same way and any of them can answer a
+    resync.
+    """
+
+    def __init__(self, buffer_size=500, redis_client=None, prefix='cuix:admin_feed:'):
+        self.buffer_size = buffer_size
+        self.redis = redis_client
+        self.prefix = prefix
+        self._events = deque(maxlen=buffer_size)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def publish(self, event, order, **extra):
+        if self.redis is not None:
+            seq = self.redis.incr(self.prefix + 'seq')
+            payload = dict(extra, seq=seq, order=order)
+            pipe = self.redis.pipeline()
+            pipe.rpush(self.prefix + 'events', json.dumps([seq, event, payload]))
+            pipe.ltrim(self.prefix + 'events', -self.buffer_size, -1)
+            pipe.execute()
+        else:
+            with self._lock:
+                self._seq += 1
+                payload = dict(extra, seq=self._seq, order=order)
+                self._events.append((self._seq, event, payload))
+        socketio.emit(event, payload, namespace=ADMIN_NAMESPACE)
+
+    def order_created(self, order):
+        try:
+            self.publish('order_created', order)
+        except Exception as e:
+            logger.error(f"Error publishing order_created: {e}")
+
+    def order_updated(self, order, previous_status=None):
+        try:
+            self.publish('order_updated', order, previous_status=previous_status)
+        except Exception as e:
+            logger.error(f"Error publishing order_updated: {e}")
+
+    def resync(self, last_seq):
+        """Events after last_seq, or a resync_required marker"""
+        if self.redis is not None:
+            pipe = self.redis.pipeline()
+            pipe.get(self.prefix + 'seq')
+            pipe.lrange(self.prefix + 'events', 0, -1)
+            current, raw = pipe.execute()
+            current = int(current or 0)
+            # INCR y RPUSH no son atómicos entre workers: ordenar por secuencia
+            events = sorted((tuple(json.loads(item)) for item in raw), key=lambda e: e[0])
+        else:
+            with self._lock:
+                current = self._seq
+                events = list(self._events)
+
+        oldest = events[0][0] if events else current + 1
+        if last_seq is None or last_seq > current or last_seq + 1 < oldest:
+            return {'resync_required': True, 'seq': current}
+        return {
+            'resync_required': False,
+            'seq': current,
+            'events': [{'event': event, **payload} for seq, event, payload in events if seq > last_seq]
+        }
+
+admin_feed = AdminFeed(redis_client=connect_redis(MESSAGE_QUEUE, 'Admin feed') if MESSAGE_QUEUE else None)
+
+# ============= REPORTS =============
+REPORT_PERIODS = ('day', 'week')
+# Límite superior (segundos) de cada bin del tiempo hasta confirmar; después del último, bin abierto
+CONFIRM_TIME_BINS = (60, 120, 300, 600, 900, 1800, 3600, 7200, 14400, 43200, 86400, 259200, 604800)
+FUNNEL_MAX_DEPTH = 20   # mensajes del cliente por conversación que distingue el embudo
+
+def report_buckets(day):
+    """(period, bucket) pairs of a date: the day and its week (keyed by Monday)"""
+    date = datetime.strptime(str(day)[:10], '%Y-%m-%d').date()
+    monday = date - timedelta(days=date.weekday())
+    return (('day', date.isoformat()), ('week', monday.isoformat()))
+
+def local_to_utc(value):
+    """UTC 'YYYY-MM-DD HH:MM:SS' of a local timestamp (orders.created_at)"""
+    local = datetime.strptime(str(value)[:19], '%Y-%m-%d %H:%M:%S')
+    return local.astimezone(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+def confirm_time_bin(seconds):
+    for index, limit in enumerate(CONFIRM_TIME_BINS):
+        if seconds <= limit:
+            return index
+    return len(CONFIRM_TIME_BINS)
+
+def histogram_median(counts):
+    """Median of {bin: count}, interpolated linearly inside its bin"""
+    total = sum(counts.values())
+    if not total:
+        return None
+    half, seen = total / 2, 0
+    for index in sorted(counts):
+        count = counts[index]
+        if count and seen + count >= half:
+            lower = CONFIRM_TIME_BINS[index - 1] if index > 0 else 0
+            if index >= len(CONFIRM_TIME_BINS):
+                return lower
+            return round(lower + (CONFIRM_TIME_BINS[index] - lower) * (half - seen) / count)
+        seen += count
+    return None
+
+def report_price(value):
+    try:
+        return float(value or 0)
+    except (TypeError, ValueError):
+        return 0.0
+
+class ReportManager:
+    """Daily and weekly order analytics kept as rollup tables in SQLite.
+
+    Order rollups (count and revenue per status, time from conversation start
+    to order) are adjusted on every order insert and admin update, so reports
+    read a handful of rows per bucket instead of aggregating the orders table.
+    The message funnel (conversations that reached N customer messages, and
+    those that ended in an order) advances from the messages table past a
+    stored watermark; abandonment is read from the per-conversation progress
+    rows it keeps. The first report, or ``--rebuild-reports``, backfills
+    everything from scratch.
+    """
+
+    def __init__(self, batch_size=5000):
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._ready = False
+
+    def _state(self, conn, key, default=None):
+        row = conn.execute('SELECT value FROM report_state WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, conn, key, value):
+        conn.execute('''
+            INSERT INTO report_state (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+        ''', (key, str(value)))
+
+    def is_ready(self):
+        """Whether the rollups were backfilled (until then, writes are not tracked)"""
+        if not self._ready:
+            with sqlite_pool.connection() as conn:
+                self._ready = self._state(conn, 'built_at') is not None
+        return self._ready
+
+    def _add_order(self, conn, created_at, status, orders, revenue):
+        conn.executemany('''
+            INSERT INTO report_orders (period, bucket, status, orders, revenue) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(period, bucket, status) DO UPDATE
+            SET orders = orders + excluded.orders, revenue = revenue + excluded.revenue
+        ''', [(period, bucket, status or 'pending', orders, revenue) for period, bucket in report_buckets(created_at)])
+
+    def _add_funnel(self, conn, day, depth, conversations=0, ordered=0):
+        conn.executemany('''
+            INSERT INTO report_funnel (period, bucket, depth, conversations, ordered) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(period, bucket, depth) DO UPDATE
+            SET conversations = conversations + excluded.conversations, ordered = ordered + excluded.ordered
+        ''', [(period, bucket, depth, conversations, ordered) for period, bucket in report_buckets(day)])
+
+    def _order_confirmed(self, conn, conversation_id, conversation_created, created_at):
+        """Time-to-confirm and funnel conversion of an order's conversation"""
+        created_utc = local_to_utc(created_at)
+        seconds = (datetime.strptime(created_utc, '%Y-%m-%d %H:%M:%S')
+                   - datetime.strptime(str(conversation_created)[:19], '%Y-%m-%d %H:%M:%S')).total_seconds()
+        conn.executemany('''
+            INSERT INTO report_confirm_times (period, bucket, bin, count) VALUES (?, ?, ?, 1)
+            ON CONFLICT(period, bucket, bin) DO UPDATE SET count = count + 1
+        ''', [(period, bucket, confirm_time_bin(max(0, seconds))) for period, bucket in report_buckets(created_at)])
+
+        # Solo el primer pedido de la conversación cuenta como conversión
+        day = str(conversation_created)[:10]
+        marked = conn.execute('''
+            INSERT INTO report_conversations (conversation_id, day, ordered) VALUES (?, ?, 1)
+            ON CONFLICT(conversation_id) DO UPDATE SET ordered = 1 WHERE ordered = 0
+        ''', (conversation_id, day)).rowcount
+        if marked:
+            depth = conn.execute('''
+                SELECT COUNT(*) FROM messages
+                WHERE conversation_id = ? AND role = 'user' AND timestamp <= ?
+            ''', (conversation_id, created_utc)).fetchone()[0]
+            self._add_funnel(conn, day, min(max(depth, 1), FUNNEL_MAX_DEPTH), ordered=1)
+
+    def order_created(self, order):
+        """Count a new order (the item published to the admin feed)"""
+        try:
+            if not self.is_ready():
+                return
+            # El mensaje de confirmación puede estar aún en el buffer de escritura
+            conversation_manager.flush()
+            with sqlite_pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._add_order(conn, order['created_at'], order['status'], 1, report_price(order['price']))
+                conversation = conn.execute(
+                    'SELECT id, created_at FROM conversations WHERE user_id = ?', (order['user_id'],)
+                ).fetchone()
+                if conversation:
+                    self._order_confirmed(conn, conversation[0], conversation[1], order['created_at'])
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error updating order rollups: {e}")
+
+    def order_updated(self, order, previous_status, previous_price):
+        """Move an order between status rollups and apply its price change"""
+        try:
+            previous_status = previous_status or 'pending'
+            previous_price = report_price(previous_price)
+            price = report_price(order['price'])
+            if (previous_status, previous_price) == (order['status'], price) or not self.is_ready():
+                return
+            with sqlite_pool.connection() as conn:
+                conn.execute('BEGIN IMMEDIATE')
+                self._add_order(conn, order['created_at'], previous_status, -1, -previous_price)
+                self._add_order(conn, order['created_at'], order['status'], 1, price)
+                conn.commit()
+        except Exception as e:
+            logger.error(f"Error updating order rollups: {e}")
+
+    def _sync_messages(self, conn):
+        """Fold customer messages past the watermark into the funnel (caller commits)"""
+        last_id = int(self._state(conn, 'last_message_id', 0))
+        processed = 0
+        while True:
+            rows = conn.execute('''
+                SELECT m.id, m.conversation_id, c.created_at
+                FROM messages m LEFT JOIN conversations c ON c.id = m.conversation_id
+                WHERE m.id > ? AND m.role = 'user'
+                ORDER BY m.id
+                LIMIT ?
+            ''', (last_id, self.batch_size)).fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            processed += len(rows)
+
+            new_messages = {}
+            for _, conversation_id, created_at in rows:
+                if conversation_id is not None and created_at:
+                    count, day = new_messages.get(conversation_id, (0, str(created_at)[:10]))
+                    new_messages[conversation_id] = (count + 1, day)
+
+            for conversation_id, (count, day) in new_messages.items():
+                row = conn.execute(
+                    'SELECT user_messages FROM report_conversations WHERE conversation_id = ?', (conversation_id,)
+                ).fetchone()
+                before = row[0] if row else 0
+                conn.execute('''
+                    INSERT INTO report_conversations (conversation_id, day, user_messages) VALUES (?, ?, ?)
+                    ON CONFLICT(conversation_id) DO UPDATE SET user_messages = user_messages + excluded.user_messages
+                ''', (conversation_id, day, count))
+                for depth in range(before + 1, min(before + count, FUNNEL_MAX_DEPTH) + 1):
+                    self._add_funnel(conn, day, depth, conversations=1)
+
+        # El watermark avanza también sobre mensajes del asistente ya descartados
+        self._set_state(conn, 'last_message_id', last_id)
+        return processed
+
+    def sync_messages(self):
+        with self._lock, sqlite_pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            processed = self._sync_messages(conn)
+            conn.commit()
+        return processed
+
+    def _load_orders(self):
+        """(user_id, status, price, created_at) of every order, MySQL first"""
+        try:
+            with db_pool.connection() as conn:
+                if conn:
+                    cursor = conn.cursor()
+                    cursor.execute('SELECT user_id, status, price, created_at FROM orders')
+                    return cursor.fetchall()
+        except Exception as e:
+            logger.error(f"Error reading orders from MySQL for reports: {e}")
+        with sqlite_pool.connection() as conn:
+            return conn.execute('SELECT user_id, status, price, created_at FROM orders').fetchall()
+
+    def rebuild(self):
+        """Recompute every rollup from the orders, conversations and messages tables"""
+        conversation_manager.flush()
+        orders = self._load_orders()
+        with self._lock, sqlite_pool.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for table in ('report_orders', 'report_confirm_times', 'report_funnel', 'report_conversations', 'report_state'):
+                conn.execute(f'DELETE FROM {table}')
+            self._sync_messages(conn)
+
+            conversations = {
+                user_id: (conversation_id, created_at)
+                for user_id, conversation_id, created_at in conn.execute('SELECT user_id, id, created_at FROM conversations')
+            }
+            for user_id, status, price, created_at in sorted(orders, key=lambda o: str(o[3])):
+                if not created_at:
+                    continue
+                self._add_order(conn, created_at, status, 1, report_price(price))
+                if user_id in conversations:
+                    self._order_confirmed(conn, *conversations[user_id], created_at)
+
+            self._set_state(conn, 'built_at', datetime.now().isoformat())
+            conn.commit()
+        self._ready = True
+        logger.info(f"Report rollups rebuilt from {len(orders)} orders")
+        return len(orders)
+
+    def report(self, period='day', date_from=None, date_to=None):
+        """Buckets of the period between two dates (inclusive) plus the message funnel"""
+        if not self.is_ready():
+            self.rebuild()
+        else:
+            self.sync_messages()
+
+        today = datetime.now().date()
+        date_to = date_to or today
+        date_from = date_from or (date_to - timedelta(days=29) if period == 'day' else date_to - timedelta(weeks=11))
+        if period == 'week':
+            date_from -= timedelta(days=date_from.weekday())
+        bounds = (period, date_from.isoformat(), date_to.isoformat())
+
+        with sqlite_pool.connection() as conn:
+            order_rows = conn.execute('''
+                SELECT bucket, status, orders, revenue FROM report_orders
+                WHERE period = ? AND bucket BETWEEN ? AND ? ORDER BY bucket
+            ''', bounds).fetchall()
+            time_rows = conn.execute('''
+                SELECT bucket, bin, count FROM report_confirm_times
+                WHERE period = ? AND bucket BETWEEN ? AND ?
+            ''', bounds).fetchall()
+            funnel_rows = conn.execute('''
+                SELECT depth, SUM(conversations), SUM(ordered) FROM report_funnel
+                WHERE period = ? AND bucket BETWEEN ? AND ? GROUP BY depth
+            ''', bounds).fetchall()
+            # Abandono = conversaciones sin pedido según el último mensaje que enviaron
+            last_day = date_to if period == 'day' else date_to - timedelta(days=date_to.weekday()) + timedelta(days=6)
+            abandoned = dict(conn.execute('''
+                SELECT MIN(user_messages, ?), COUNT(*) FROM report_conversations
+                WHERE ordered = 0 AND user_messages > 0 AND day BETWEEN ? AND ?
+                GROUP BY 1
+            ''', (FUNNEL_MAX_DEPTH, date_from.isoformat(), last_day.isoformat())).fetchall())
+
+        buckets, times, all_times = {}, {}, {}
+        for bucket, status, orders, revenue in order_rows:
+            if not orders and not revenue:
+                continue
+            entry = buckets.setdefault(bucket, {'bucket': bucket, 'orders': 0, 'revenue': 0.0, 'by_status': {}})
+            entry['orders'] += orders
+            entry['revenue'] = round(entry['revenue'] + revenue, 2)
+            entry['by_status'][status] = {'orders': orders, 'revenue': round(revenue, 2)}
+        for bucket, index, count in time_rows:
+            times.setdefault(bucket, {})[index] = count
+            all_times[index] = all_times.get(index, 0) + count
+        for bucket, entry in buckets.items():
+            entry['median_confirm_seconds'] = histogram_median(times.get(bucket, {}))
+
+        reached = {depth: conversations for depth, conversations, _ in funnel_rows}
+        ordered = {depth: count for depth, _, count in funnel_rows}
+        funnel = []
+        for depth in range(1, max(reached, default=0) + 1):
+            funnel.append({
+                'messages': depth,
+                'conversations': reached.get(depth, 0),
+                'ordered': ordered.get(depth, 0),
+                'abandoned': abandoned.get(depth, 0)
+            })
+
+        return {
+            'period': period,
+            'date_from': date_from.isoformat(),
+            'date_to': date_to.isoformat(),
+            'totals': {
+                'orders': sum(b['orders'] for b in buckets.values()),
+                'revenue': round(sum(b['revenue'] for b in buckets.values()), 2),
+                'median_confirm_seconds': histogram_median(all_times),
+                'conversations': reached.get(1, 0),
+                'ordered_conversations': sum(ordered.values())
+            },
+            'buckets': [buckets[key] for key in sorted(buckets)],
+            'funnel': funnel
+        }
+
+def report_csv(report, section='orders'):
+    """CSV export of a report: one row per bucket, or the funnel"""
+    out = io.StringIO()
+    writer = csv.writer(out)
+    if section == 'funnel':
+        writer.writerow(['messages', 'conversations', 'ordered', 'abandoned'])
+        for row in report['funnel']:
+            writer.writerow([row['messages'], row['conversations'], row['ordered'], row['abandoned']])
+        return out.getvalue()
+
+    statuses = sorted({status for b in report['buckets'] for status in b['by_status']})
+    writer.writerow([report['period'], 'orders', 'revenue', 'median_confirm_seconds']
+                    + [f'orders_{status}' for status in statuses]
+                    + [f'revenue_{status}' for status in statuses])
+    for b in report['buckets']:
+        writer.writerow([b['bucket'], b['orders'], b['revenue'], b['median_confirm_seconds'] or '']
+                        + [b['by_status'].get(status, {}).get('orders', 0) for status in statuses]
+                        + [b['by_status'].get(status, {}).get('revenue', 0) for status in statuses])
+    return out.getvalue()
+
+report_manager = ReportManager()
+
+# ============= CONVERSATION FUNNEL =============
+FUNNEL_CONFIG = {
+    'buffer_size': int(app_settings.get('funnel_buffer_size', 20000)),        # eventos pendientes como máximo
+    'flush_interval': float(app_settings.get('funnel_flush_interval', 30)),
+    'abandon_after': float(app_settings.get('funnel_abandon_after', 1800))    # segundos sin actividad = abandono
+}
+
+# Contadores por (día, flujo, paso), en el orden de las columnas de step_metrics
+STEP_COUNTERS = ('entered', 'exited', 'seconds', 'messages', 'edits', 'photos', 'abandoned')
+
+class FunnelTracker:
+    """Time spent and drop-off per step of the order wizard.
+
+    Handlers only append (time, user, flow, step, event) to a bounded ring
+    buffer. A background thread folds the events into each conversation's
+    current step (entered at / last seen) and per-day counters every
+    ``flush_interval`` seconds, and upserts the counters into step_metrics
+    in one transaction. A full buffer drops its oldest events instead of
+    slowing the chat. A conversation that disconnects, or stays idle for
+    ``abandon_after`` seconds, without confirming is counted as abandoned at
+    the step it was on.
+    """
+
+    def __init__(self, config=None):
+        self.config = config or FUNNEL_CONFIG
+        self._events = deque(maxlen=self.config['buffer_size'])
+        self._users = {}      # user_id -> [flow, step, entered_at, last_seen, completed]
+        self._counters = {}   # (day, flow, step) -> [entered, exited, seconds, messages, edits, photos, abandoned]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._dropped = 0
+        self._flushes = 0
+
+    def record(self, user_id, session, event):
+        """Queue a funnel event: start, message, photo, edit, step, complete or end"""
+        step = session.get('current_step') if session else None
+        if len(self._events) == self._events.maxlen:
+            self._dropped += 1
+        self._events.append((time.time(), user_id, session.get('product') if session else None,
+                             step.id if step else None, event))
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name='funnel-flush', daemon=True)
+                self._thread.start()
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.config['flush_interval']):
+            self.flush()
+
+    def _counter(self, ts, flow, step):
+        key = (datetime.fromtimestamp(ts).strftime('%Y-%m-%d'), flow or 'unknown', step)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters[key] = [0, 0, 0.0, 0, 0, 0, 0]
+        return counter
+
+    def _move(self, state, step, ts):
+        if step == state[1]:
+            return
+        if state[1] is not None:
+            counter = self._counter(ts, state[0], state[1])
+            counter[1] += 1
+            counter[2] += ts - state[2]
+        if step is not None:
+            self._counter(ts, state[0], step)[0] += 1
+        state[1], state[2] = step, ts
+
+    def _end(self, user_id, state, ts):
+        if not state[4] and state[1] is not None:
+            self._counter(ts, state[0], state[1])[6] += 1
+        del self._users[user_id]
+
+    def _apply(self, now):
+        """Fold buffered events into conversation state and counters (holding _lock)"""
+        while self._events:
+            ts, user_id, flow, step, event = self._events.popleft()
+            state = self._users.get(user_id)
+            if state is None:
+                if event == 'end':
+                    continue
+                state = self._users[user_id] = [flow, None, ts, ts, False]
+            if event == 'end':
+                self._end(user_id, state, ts)
+                continue
+            state[0] = flow or state[0]
+            state[3] = ts
+            if event in ('message', 'photo', 'edit') and step is not None:
+                self._counter(ts, state[0], step)[{'message': 3, 'edit': 4, 'photo': 5}[event]] += 1
+            self._move(state, step, ts)
+            if event == 'complete':
+                state[4] = True
+
+        idle_before = now - self.config['abandon_after']
+        for user_id, state in list(self._users.items()):
+            if state[3] < idle_before:
+                self._end(user_id, state, now)
+
+    def flush(self):
+        """Apply pending events and add the counters to step_metrics"""
+        with self._lock:
+            self._apply(time.time())
+            counters, self._counters = self._counters, {}
+        if not counters:
+            return 0
+
+        try:
+            with sqlite_pool.connection() as conn:
+                conn.executemany(f'''
+                    INSERT INTO step_metrics (day, flow, step, {', '.join(STEP_COUNTERS)})
+                    VALUES (?, ?, ?, {', '.join('?' * len(STEP_COUNTERS))})
+                    ON CONFLICT(day, flow, step) DO UPDATE SET
+                    {', '.join(f'{name} = {name} + excluded.{name}' for name in STEP_COUNTERS)}
+                ''', [key + tuple(values) for key, values in counters.items()])
+                conn.commit()
+            self._flushes += 1
+            return len(counters)
+        except Exception as e:
+            logger.error(f"Error flushing funnel metrics: {e}")
+            # Se vuelven a sumar en el siguiente flush
+            with self._lock:
+                for key, values in counters.items():
+                    current = self._counters.setdefault(key, [0, 0, 0.0, 0, 0, 0, 0])
+                    for i, value in enumerate(values):
+                        current[i] += value
+            return 0
+
+    def report(self, flow_id, date_from, date_to):
+        """Per-step funnel of a flow between two YYYY-MM-DD dates (inclusive)"""
+        self.flush()
+        with sqlite_pool.connection() as conn:
+            rows = conn.execute(f'''
+                SELECT step, {', '.join(f'SUM({name})' for name in STEP_COUNTERS)}
+                FROM step_metrics
+                WHERE flow = ? AND day BETWEEN ? AND ?
+                GROUP BY step
+            ''', (flow_id, date_from, date_to)).fetchall()
+        with self._lock:
+            active = {}
+            for state in self._users.values():
+                if state[0] == flow_id and state[1] is not None and not state[4]:
+                    active[state[1]] = active.get(state[1], 0) + 1
+
+        totals = {row[0]: dict(zip(STEP_COUNTERS, row[1:])) for row in rows}
+        manager = order_managers.get(flow_id)
+        order = [step.id for step in manager.pasos_orden] if manager else []
+        steps = []
+        for step_id in order + sorted(set(totals) - set(order)):
+            values = totals.get(step_id, dict.fromkeys(STEP_COUNTERS, 0))
+            entered = values['entered']
+            steps.append({
+                'step': step_id,
+                'entered': entered,
+                'exited': values['exited'],
+                'abandoned': values['abandoned'],
+                'abandon_rate': round(values['abandoned'] / entered, 3) if entered else None,
+                'avg_seconds': round(values['seconds'] / values['exited'], 1) if values['exited'] else None,
+                'messages': values['messages'],
+                'messages_per_visit': round(values['messages'] / entered, 2) if entered else None,
+                'edits': values['edits'],
+                'photos': values['photos'],
+                'active': active.get(step_id, 0)
+            })
+        return {'flow': flow_id, 'date_from': date_from, 'date_to': date_to, 'steps': steps}
+
+    def stats(self):
+        return {
+            'buffered': len(self._events),
+            'dropped': self._dropped,
+            'tracked_conversations': len(self._users),
+            'flushes': self._flushes
+        }
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+funnel_tracker = FunnelTracker()
+atexit.register(funnel_tracker.close)
+
 @app.route('/api/admin/orders')
 @require_auth
 def admin_get_orders():
-    """Get all orders for admin from MySQL or SQLite"""
-    try:
-        conn = get_mysql_connection()
-        logger.info("Conexion MySQL: " + str(conn))
-        if not conn:
-            # Fallback a SQLite
-            return get_orders_sqlite()
-        
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute('''
-            SELECT id, user_id, customer_name, customer_phone, order_type, order_data, price, status, delivery_date, delivery_notes, created_at, updated_at
-            FROM orders
-            ORDER BY created_at DESC
-            LIMIT 50
-        ''')
-        
-        rows = cursor.fetchall()
-        logger.info("Filas encontradas en MySQL: " + str(len(rows)))
-        
-        orders = []
-        for row in rows:
-            # Extraer datos del JSON
-            order_data = row.get('order_data', {})
-            if isinstance(order_data, str):
-                try:
-                    order_data = json.loads(order_data)
-                except:
-                    order_data = {}
-            
-            # Usar customer_name del registro o del JSON
-            cliente = row['customer_name'] or order_data.get('nombre', 'Cliente Web')
-            tipo = row['order_type'] or 'Funko Personalizado'
-            
-            # Extraer campos del JSON para descripción
-            description = f"Cabeza: {order_data.get('cabeza', '')}\n"
-            description += f"Parte Superior: {order_data.get('parte_superior', '')}\n"
-            description += f"Parte Inferior: {order_data.get('parte_inferior', '')}\n"
-            description += f"Pies: {order_data.get('pies', '')}\n"
-            description += f"Detalles: {order_data.get('detalles_adicionales', '')}"
-            
-            orders.append({
-                'id': row['id'],
-                'user_id': row['user_id'],
-                'cliente': cliente,
-                'tipo': tipo,
-                'description': description,
-                'clothing': order_data.get('parte_superior', ''),
-                'shoes': order_data.get('pies', ''),
-                'accessories': order_data.get('detalles_adicionales', ''),
-                'order_data': order_data,
-                'price': float(row['price']) if row['price'] else 0,
-                'status': row['status'] or 'pending',
-                'customer_phone': row.get('customer_phone', ''),
-                'created_at': str(row['created_at']) if row['created_at'] else None,
-                'updated_at': str(row['updated_at']) if row['updated_at'] else None
-            })
-        
-        conn.close()
-        logger.info("Pedidos a devolver: " + str(len(orders)))
-        return jsonify({'orders': orders})
-        
+    """Get a page of orders for admin from MySQL or SQLite.
+
+    Keyset pagination on (created_at, id): pass ``next_cursor`` back as
+    ``cursor``. Filters: status, date_from/date_to (YYYY-MM-DD), phone.
+    ``fields=summary`` omits order_data and the derived description.
+    """
+    try:
+        filters = parse_order_filters(request.args)
+    except Exception:
+        return jsonify({'error': 'Parámetros inválidos'}), 400
+
+    try:
+        full = filters['fields'] == 'full'
+        columns = ORDER_SUMMARY_COLUMNS_MYSQL
+        if full:
+            columns += ', order_data'
+        where, params = build_order_where(filters, '%s', 'customer_phone')
+
+        with db_pool.connection() as conn:
+            if not conn:
+                # Fallback a SQLite
+                return get_orders_sqlite(filters)
+
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute(f'''
+                SELECT {columns}
+                FROM orders
+                {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            ''', params + [filters['limit'] + 1])
+
+            rows = cursor.fetchall()
+
+        orders = [mysql_order_item(row, full) for row in rows]
+        return paginate_orders(orders, filters)
+
     except Exception as e:
         logger.error(f"Error fetching orders: {e}")
-        import traceback
-        traceback.print_exc()
         # Fallback a SQLite
         try:
-            return get_orders_sqlite()
+            return get_orders_sqlite(filters)
         except Exception as e2:
             return jsonify({'error': str(e)}), 500
 
-def get_orders_sqlite():
-    """Get orders from SQLite"""
+def get_orders_sqlite(filters):
+    """Get a page of orders from SQLite"""
     try:
-        conn = sqlite3.connect('conversations.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, user_id, cliente, customer_phone, tipo, description, clothing, shoes, accessories, order_data, price, status, delivery_date, delivery_notes, created_at, updated_at
-            FROM orders
-            ORDER BY created_at DESC
-            LIMIT 50
-        ''')
-        
-        orders = []
-        for row in cursor.fetchall():
-            # Obtener order_data
-            order_data_str = row['order_data']
-            order_data = {}
-            if order_data_str:
-                try:
-                    order_data = json.loads(order_data_str)
-                except:
-                    pass
-            
-            # Usar datos del registro o del JSON
-            cliente = row['cliente'] or order_data.get('nombre', 'Cliente Web')
-            tipo = row['tipo'] or 'Funko Personalizado'
-            
-            # Extraer campos del JSON para descripción
-            description = f"Cabeza: {order_data.get('cabeza', '')}\n"
-            description += f"Parte Superior: {order_data.get('parte_superior', '')}\n"
-            description += f"Parte Inferior: {order_data.get('parte_inferior', '')}\n"
-            description += f"Pies: {order_data.get('pies', '')}\n"
-            description += f"Detalles: {order_data.get('detalles_adicionales', '')}"
-            
-            orders.append({
-                'id': row['id'],
-                'user_id': row['user_id'],
-                'cliente': cliente,
-                'tipo': tipo,
-                'description': description,
-                'clothing': order_data.get('parte_superior', ''),
-                'shoes': order_data.get('pies', ''),
-                'accessories': order_data.get('detalles_adicionales', ''),
-                'order_data': order_data,
-                'price': row['price'] or 0,
-                'status': row['status'] or 'pending',
-                'customer_phone': row['customer_phone'] or '',
-                'created_at': row['created_at'],
-                'updated_at': row['updated_at']
-            })
-        
-        conn.close()
-        return jsonify({'orders': orders})
+        full = filters['fields'] == 'full'
+        columns = ORDER_SUMMARY_COLUMNS_SQLITE
+        if full:
+            columns += ', order_data'
+        where, params = build_order_where(filters, '?', 'customer_phone')
+
+        with sqlite_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute(f'''
+                SELECT {columns}
+                FROM orders
+                {where}
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', params + [filters['limit'] + 1])
+            rows = cursor.fetchall()
+
+        orders = [sqlite_order_item(row, full) for row in rows]
+        return paginate_orders(orders, filters)
     except Exception as e:
         logger.error(f"Error fetching orders from SQLite: {e}")
         return jsonify({'error': str(e)}), 500
 
+def summarize_status_counts(rows):
+    """Response of /api/admin/orders/count from (status, count) rows"""
+    by_status = {}
+    for status, count in rows:
+        # Sin estado cuenta como pendiente (igual que en el listado)
+        key = status or 'pending'
+        by_status[key] = by_status.get(key, 0) + count
+    return {'total': sum(by_status.values()), 'by_status': by_status}
+
+@app.route('/api/admin/orders/count')
+@require_auth
+def admin_count_orders():
+    """Total orders matching the filters, plus a per-status breakdown"""
+    try:
+        filters = parse_order_filters(request.args)
+    except Exception:
+        return jsonify({'error': 'Parámetros inválidos'}), 400
+
+    try:
+        with db_pool.connection() as conn:
+            if conn:
+                where, params = build_order_where(filters, '%s', 'customer_phone', with_cursor=False)
+                cursor = conn.cursor()
+                cursor.execute(f"SELECT status, COUNT(*) FROM orders {where} GROUP BY status", params)
+                return jsonify(summarize_status_counts(cursor.fetchall()))
+    except Exception as e:
+        logger.error(f"Error counting orders in MySQL: {e}")
+
+    try:
+        where, params = build_order_where(filters, '?', 'customer_phone', with_cursor=False)
+        with sqlite_pool.connection() as conn:
+            rows = conn.execute(f"SELECT status, COUNT(*) FROM orders {where} GROUP BY status", params).fetchall()
+        return jsonify(summarize_status_counts(rows))
+    except Exception as e:
+        logger.error(f"Error counting orders in SQLite: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/admin/order/<int:order_id>')
 @require_auth
 def admin_get_order_detail(order_id):
     """Get detailed order info from MySQL or SQLite"""
     try:
-        conn = get_mysql_connection()
-        if not conn:
-            # Fallback a SQLite
-            return get_order_detail_sqlite(order_id)
+        with db_pool.connection() as conn:
+            if not conn:
+                # Fallback a SQLite
+                return get_order_detail_sqlite(order_id)
 
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute('''
-            SELECT id, user_id, customer_name, customer_phone, order_type, order_data, price, status, delivery_date, delivery_notes, created_at, updated_at
-            FROM orders WHERE id = %s
-        ''', (order_id,))
+            cursor = conn.cursor(dictionary=True)
+            cursor.execute('''
+                SELECT id, user_id, customer_name, customer_phone, order_type, order_data, price, status, delivery_date, delivery_notes, created_at, updated_at
+                FROM orders WHERE id = %s
+            ''', (order_id,))
 
-        row = cursor.fetchone()
-        conn.close()
+            row = cursor.fetchone()
 
         if not row:
             return jsonify({'error': 'Order not found'}), 404
@@ -1147,17 +4555,15 @@ def admin_get_order_detail(order_id):
 def get_order_detail_sqlite(order_id):
     """Get order detail from SQLite"""
     try:
-        conn = sqlite3.connect('conversations.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT id, user_id, cliente, customer_phone, tipo, description, clothing, shoes, accessories, order_data, price, status, delivery_date, delivery_notes, created_at, updated_at
-            FROM orders WHERE id = ?
-        ''', (order_id,))
-        
-        row = cursor.fetchone()
-        conn.close()
+        with sqlite_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute('''
+                SELECT id, user_id, cliente, customer_phone, tipo, description, clothing, shoes, accessories, order_data, price, status, delivery_date, delivery_notes, created_at, updated_at
+                FROM orders WHERE id = ?
+            ''', (order_id,))
+
+            row = cursor.fetchone()
         
         if not row:
             return jsonify({'error': 'Order not found'}), 404
@@ -1201,10 +4607,7 @@ def admin_update_order(order_id):
         logger.info(f"=== Actualizando pedido {order_id} con datos: {data} ===")
         
         # Intentar MySQL primero
-        conn = get_mysql_connection()
-        logger.info(f"Conexión MySQL: {conn}")
-        
-        if conn:
+        if db_pool.is_available():
             logger.info("Usando MySQL para actualizar")
             return update_order_mysql(order_id, data)
         else:
@@ -1221,78 +4624,66 @@ def admin_update_order(order_id):
 def update_order_mysql(order_id, data):
     """Update order in MySQL"""
     try:
-        conn = get_mysql_connection()
-        cursor = conn.cursor()
+        with db_pool.connection() as conn:
+            if not conn:
+                # El pool pudo caerse entre la comprobación y la actualización
+                return update_order_sqlite(order_id, data)
 
-        updates = []
-        values = []
+            cursor = conn.cursor()
 
-        if 'customer_name' in data:
-            updates.append("customer_name = %s")
-            values.append(data['customer_name'])
-        if 'customer_phone' in data:
-            updates.append("customer_phone = %s")
-            values.append(data['customer_phone'])
-        if 'order_type' in data:
-            updates.append("order_type = %s")
-            values.append(data['order_type'])
-        if 'price' in data and data['price'] is not None:
-            updates.append("price = %s")
-            values.append(float(data['price']) if data['price'] else None)
-        if 'status' in data:
-            updates.append("status = %s")
-            values.append(data['status'])
-        if 'delivery_date' in data:
-            updates.append("delivery_date = %s")
-            values.append(data['delivery_date'])
-        if 'delivery_notes' in data:
-            updates.append("delivery_notes = %s")
-            values.append(data['delivery_notes'])
+            updates = []
+            values = []
+
+            if 'customer_name' in data:
+                updates.append("customer_name = %s")
+                values.append(data['customer_name'])
+            if 'customer_phone' in data:
+                updates.append("customer_phone = %s")
+                values.append(data['customer_phone'])
+            if 'order_type' in data:
+                updates.append("order_type = %s")
+                values.append(data['order_type'])
+            if 'price' in data and data['price'] is not None:
+                updates.append("price = %s")
+                values.append(float(data['price']) if data['price'] else None)
+            if 'status' in data:
+                updates.append("status = %s")
+                values.append(data['status'])
+            if 'delivery_date' in data:
+                updates.append("delivery_date = %s")
+                values.append(data['delivery_date'])
+            if 'delivery_notes' in data:
+                updates.append("delivery_notes = %s")
+                values.append(data['delivery_notes'])
+
+            if updates:
+                cursor.execute("SELECT status, price FROM orders WHERE id = %s", (order_id,))
+                previous = cursor.fetchone()
+
+                values.append(order_id)
+                query = f"UPDATE orders SET {', '.join(updates)} WHERE id = %s"
+                cursor.execute(query, values)
+                conn.commit()
+                logger.info(f"Pedido {order_id} actualizado en MySQL")
 
-        if updates:
-            values.append(order_id)
-            query = f"UPDATE orders SET {', '.join(updates)} WHERE id = %s"
-            cursor.execute(query, values)
-            conn.commit()
-            logger.info(f"Pedido {order_id} actualizado en MySQL")
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute(f"SELECT {ORDER_SUMMARY_COLUMNS_MYSQL} FROM orders WHERE id = %s", (order_id,))
+                row = cursor.fetchone()
+                if row:
+                    item = mysql_order_item(row)
+                    admin_feed.order_updated(item, previous[0] if previous else None)
+                    if previous:
+                        report_manager.order_updated(item, previous[0], previous[1])
 
-        conn.close()
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error updating order in MySQL: {e}")
         return jsonify({'error': str(e)}), 500
-        if 'status' in data:
-            updates.append("status = %s")
-            values.append(data['status'])
-        if 'delivery_date' in data:
-            updates.append("delivery_date = %s")
-            values.append(data['delivery_date'])
-        if 'delivery_notes' in data:
-            updates.append("delivery_notes = %s")
-            values.append(data['delivery_notes'])
-
-        if updates:
-            values.append(order_id)
-            query = f"UPDATE orders SET {', '.join(updates)} WHERE id = %s"
-            cursor.execute(query, values)
-            conn.commit()
-
-        conn.close()
-        return jsonify({'success': True})
-    except Exception as e:
-        logger.error(f"Error updating order: {e}")
-        # Fallback a SQLite
-        try:
-            return update_order_sqlite(order_id, data)
-        except Exception as e2:
-            return jsonify({'error': str(e)}), 500
 
 def update_order_sqlite(order_id, data):
     """Update order in SQLite"""
     try:
         logger.info(f"update_order_sqlite: orden_id={order_id}, data={data}")
-        conn = sqlite3.connect('conversations.db')
-        cursor = conn.cursor()
 
         # Build update query
         updates = []
@@ -1323,19 +4714,61 @@ def update_order_sqlite(order_id, data):
         logger.info(f"update_order_sqlite: updates={updates}, values={values}")
         
         if updates:
+            updates.append("updated_at = CURRENT_TIMESTAMP")
             values.append(order_id)
             query = f"UPDATE orders SET {', '.join(updates)} WHERE id = ?"
             logger.info(f"update_order_sqlite: query={query}")
-            cursor.execute(query, values)
-            conn.commit()
-            logger.info(f"update_order_sqlite: afectados={cursor.rowcount}")
+            with sqlite_pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.row_factory = sqlite3.Row
+                cursor.execute("SELECT status, price FROM orders WHERE id = ?", (order_id,))
+                previous = cursor.fetchone()
+
+                cursor.execute(query, values)
+                conn.commit()
+                logger.info(f"update_order_sqlite: afectados={cursor.rowcount}")
+
+                cursor.execute(f"SELECT {ORDER_SUMMARY_COLUMNS_SQLITE} FROM orders WHERE id = ?", (order_id,))
+                row = cursor.fetchone()
+                if row:
+                    item = sqlite_order_item(row)
+                    admin_feed.order_updated(item, previous['status'] if previous else None)
+                    if previous:
+                        report_manager.order_updated(item, previous['status'], previous['price'])
 
-        conn.close()
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error updating order in SQLite: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/blob/<digest>')
+@require_auth
+def admin_get_blob(digest):
+    """Serve a stored reference photo by its SHA-256 (?variant=thumb|display for the resized copies)"""
+    if not blob_store.exists(digest):
+        return jsonify({'error': 'Not found'}), 404
+
+    mime = request.args.get('mime', '')
+    if not mime.startswith('image/'):
+        mime = 'image/jpeg'
+
+    path = blob_store.path_for(digest)
+    fallback = False
+    variant = request.args.get('variant')
+    if variant:
+        variant_path, variant_mime = image_processor.variant({'hash': digest, 'mime': mime}, variant)
+        if variant_path:
+            path, mime = variant_path, variant_mime
+        else:
+            # Todavía no generada (o sin Pillow): se sirve el original sin cachearlo
+            fallback = True
+            image_processor.submit({'hash': digest})
+
+    response = send_file(os.path.abspath(path), mimetype=mime)
+    # Content-addressed: the bytes behind a hash never change
+    response.headers['Cache-Control'] = 'private, no-cache' if fallback else 'private, max-age=31536000, immutable'
+    return response
+
 @app.route('/api/admin/whatsapp-link')
 def admin_whatsapp_link():
     """Generate WhatsApp pre-filled link"""
@@ -1363,30 +4796,27 @@ def admin_whatsapp_link():
 def load_users_mysql():
     """Load users from MySQL, fallback to SQLite"""
     # Intentar primero con MySQL
-    conn = get_mysql_connection()
-    if conn:
-        try:
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute("SELECT id, username, password_hash, full_name, email, role FROM admin_users")
-            users = {}
-            for row in cursor.fetchall():
-                users[row['username']] = dict(row)
-            conn.close()
-            return users
-        except Exception as e:
-            logger.warning(f"MySQL error, using SQLite: {e}")
-            conn.close()
+    with db_pool.connection() as conn:
+        if conn:
+            try:
+                cursor = conn.cursor(dictionary=True)
+                cursor.execute("SELECT id, username, password_hash, full_name, email, role FROM admin_users")
+                users = {}
+                for row in cursor.fetchall():
+                    users[row['username']] = dict(row)
+                return users
+            except Exception as e:
+                logger.warning(f"MySQL error, using SQLite: {e}")
 
     # Fallback a SQLite
     try:
-        conn = sqlite3.connect('conversations.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT id, username, password as password_hash, full_name, email, role FROM admin_users")
-        users = {}
-        for row in cursor.fetchall():
-            users[row['username']] = dict(row)
-        conn.close()
+        with sqlite_pool.connection() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = sqlite3.Row
+            cursor.execute("SELECT id, username, password as password_hash, full_name, email, role FROM admin_users")
+            users = {}
+            for row in cursor.fetchall():
+                users[row['username']] = dict(row)
         return users
     except Exception as e:
         logger.error(f"Error loading users from SQLite: {e}")
@@ -1394,72 +4824,66 @@ def load_users_mysql():
 
 def save_user_mysql(user_data):
     """Save user to MySQL"""
-    conn = get_mysql_connection()
-    if not conn:
-        return False
-    try:
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO admin_users (username, password_hash, full_name, email, role)
-            VALUES (%s, %s, %s, %s, %s)
-        """, (user_data['username'], user_data['password_hash'],
-              user_data['full_name'], user_data['email'], user_data['role']))
-        conn.commit()
-        return True
-    except Exception as e:
-        logger.error(f"Error saving user: {e}")
-        return False
-    finally:
-        conn.close()
+    with db_pool.connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO admin_users (username, password_hash, full_name, email, role)
+                VALUES (%s, %s, %s, %s, %s)
+            """, (user_data['username'], user_data['password_hash'],
+                  user_data['full_name'], user_data['email'], user_data['role']))
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Error saving user: {e}")
+            return False
 
 def update_user_mysql(user_id, user_data):
     """Update user in MySQL"""
-    conn = get_mysql_connection()
-    if not conn:
-        return False
-    try:
-        cursor = conn.cursor()
-        # Si se proporciona contraseña, actualizarla también
-        if 'password_hash' in user_data:
-            cursor.execute("""
-                UPDATE admin_users
-                SET full_name = %s, email = %s, role = %s, password_hash = %s
-                WHERE id = %s
-            """, (user_data['full_name'], user_data['email'], user_data['role'], user_data['password_hash'], user_id))
-        else:
-            cursor.execute("""
-                UPDATE admin_users
-                SET full_name = %s, email = %s, role = %s
-                WHERE id = %s
-            """, (user_data['full_name'], user_data['email'], user_data['role'], user_id))
-        conn.commit()
-        return cursor.rowcount > 0
-    except Exception as e:
-        logger.error(f"Error updating user: {e}")
-        return False
-    finally:
-        conn.close()
+    with db_pool.connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            # Si se proporciona contraseña, actualizarla también
+            if 'password_hash' in user_data:
+                cursor.execute("""
+                    UPDATE admin_users
+                    SET full_name = %s, email = %s, role = %s, password_hash = %s
+                    WHERE id = %s
+                """, (user_data['full_name'], user_data['email'], user_data['role'], user_data['password_hash'], user_id))
+            else:
+                cursor.execute("""
+                    UPDATE admin_users
+                    SET full_name = %s, email = %s, role = %s
+                    WHERE id = %s
+                """, (user_data['full_name'], user_data['email'], user_data['role'], user_id))
+            conn.commit()
+            return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Error updating user: {e}")
+            return False
 
 def delete_user_mysql(user_id):
     """Delete user from MySQL"""
-    conn = get_mysql_connection()
-    if not conn:
-        return False
-    try:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM admin_users WHERE id = %s", (user_id,))
-        conn.commit()
-        return cursor.rowcount > 0
-    except Exception as e:
-        logger.error(f"Error deleting user: {e}")
-        return False
-    finally:
-        conn.close()
+    with db_pool.connection() as conn:
+        if not conn:
+            return False
+        try:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM admin_users WHERE id = %s", (user_id,))
+            conn.commit()
+            return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"Error deleting user: {e}")
+            return False
 
-def generate_token(user_id, username):
-    """Generate auth token"""
-    payload = f"{user_id}:{username}:{datetime.now().timestamp()}"
-    return hashlib.sha256(payload.encode()).hexdigest()
+def generate_token(user_id):
+    """Generate auth token (checked by verify_admin_token)"""
+    payload = f"{user_id}.{int(time.time()) + ADMIN_TOKEN_TTL}"
+    return f"{payload}.{_admin_token_signature(payload)}"
 
 @app.route('/api/admin/login', methods=['POST'])
 def admin_login():
@@ -1479,7 +4903,7 @@ def admin_login():
             hashed = hashlib.sha256(password.encode()).hexdigest()
             logger.info(f"Usuario encontrado: {user['username']}, hash guardado: {user['password_hash']}, hash calculado: {hashed}")
             if user['password_hash'] == hashed or user['password_hash'] == password:
-                token = generate_token(user['id'], username)
+                token = generate_token(user['id'])
                 return jsonify({
                     'success': True,
                     'token': token,
@@ -1600,13 +5024,7 @@ def admin_delete_user(user_id):
 def get_settings():
     """Get application settings"""
     try:
-        config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-        if os.path.exists(config_path):
-            with open(config_path, 'r') as f:
-                settings = json.load(f)
-        else:
-            settings = {'email_enabled': True, 'email_destinatarios': 'cuicuix.studio@gmail.com'}
-        return jsonify(settings)
+        return jsonify(redact_settings(app_settings.as_dict()))
     except Exception as e:
         logger.error(f"Error loading settings: {e}")
         return jsonify({'error': str(e)}), 500
@@ -1616,82 +5034,269 @@ def get_settings():
 def save_settings():
     """Save application settings"""
     try:
-        data = request.get_json()
-        config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.json')
-        with open(config_path, 'w') as f:
-            json.dump(data, f, indent=4)
-        logger.info(f"Settings saved: {data}")
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            # Formularios que reenvían lo que leyeron por GET: el secreto sigue igual
+            data = {key: value for key, value in data.items()
+                    if not (key in SECRET_SETTINGS and value == SETTINGS_REDACTED)}
+        errors = validate_settings(data)
+        if errors:
+            return jsonify({'error': 'Invalid settings', 'details': errors}), 400
+        # Merge so keys not shown in the admin form (e.g. mysql_pool_size) survive
+        app_settings.update(data)
+        logger.info(f"Settings saved: {redact_settings(data)}")
         return jsonify({'success': True})
     except Exception as e:
         logger.error(f"Error saving settings: {e}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/admin/jobs')
+@require_auth
+def admin_get_jobs():
+    """Status of the order finalization jobs"""
+    try:
+        return jsonify({'jobs': order_jobs.get_jobs(request.args.get('status'))})
+    except Exception as e:
+        logger.error(f"Error fetching order jobs: {e}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/reports')
+@require_auth
+def admin_get_reports():
+    """Order report from the rollup tables.
+
+    period=day|week, date_from/date_to (YYYY-MM-DD, inclusive; default last
+    30 days or 12 weeks), format=csv for a download (section=funnel exports
+    the message funnel instead of the buckets).
+    """
+    period = request.args.get('period', 'day')
+    if period not in REPORT_PERIODS:
+        return jsonify({'error': 'Parámetros inválidos'}), 400
+    try:
+        date_from, date_to = (
+            datetime.strptime(request.args[key], '%Y-%m-%d').date() if request.args.get(key) else None
+            for key in ('date_from', 'date_to')
+        )
+    except ValueError:
+        return jsonify({'error': 'Parámetros inválidos'}), 400
+
+    try:
+        report = report_manager.report(period, date_from, date_to)
+    except Exception as e:
+        logger.error(f"Error building report: {e}")
+        return jsonify({'error': str(e)}), 500
+
+    if request.args.get('format') == 'csv':
+        section = 'funnel' if request.args.get('section') == 'funnel' else 'orders'
+        response = make_response(report_csv(report, section))
+        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+        response.headers['Content-Disposition'] = (
+            f"attachment; filename=reporte_{section}_{period}_{report['date_from']}_{report['date_to']}.csv"
+        )
+        return response
+    return jsonify(report)
+
+@app.route('/api/admin/funnel')
+@require_auth
+def admin_get_funnel():
+    """Time, messages, edits and drop-off per wizard step
+    (?flow=funko&date_from=YYYY-MM-DD&date_to=YYYY-MM-DD, default last 30 days)"""
+    flow_id = request.args.get('flow') or next(iter(ORDER_FLOWS))
+    try:
+        date_to = datetime.strptime(request.args['date_to'], '%Y-%m-%d').date() if request.args.get('date_to') else datetime.now().date()
+        date_from = datetime.strptime(request.args['date_from'], '%Y-%m-%d').date() if request.args.get('date_from') else date_to - timedelta(days=29)
+    except ValueError:
+        return jsonify({'error': 'Parámetros inválidos'}), 400
+
+    try:
+        return jsonify(funnel_tracker.report(flow_id, date_from.isoformat(), date_to.isoformat()))
+    except Exception as e:
+        logger.error(f"Error building funnel: {e}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/api/health')
 def health_check():
     """Health check endpoint"""
     return jsonify({
         'status': 'healthy',
         'ai_enabled': False,
-        'active_sessions': len(conversation_sessions),
+        'active_sessions': len(session_store),
+        'sessions': session_store.stats(),
+        'messages': {
+            'languages': message_catalog.languages,
+            'summary_cache': {flow_id: manager.summary_cache_stats() for flow_id, manager in order_managers.items()}
+        },
+        'mysql_pool': db_pool.stats(),
+        'chat_write_behind': conversation_manager.stats(),
+        'smtp': smtp_pool.stats(),
+        'funnel': funnel_tracker.stats(),
+        'tracing': tracer.stats(),
         'timestamp': datetime.now().isoformat()
     })
 
+# ============= METRICS ENDPOINT =============
+def socket_event(event, namespace=None):
+    """socketio.on() that also records the handler's latency and errors and traces it"""
+    label = event if namespace is None else f"{namespace}:{event}"
+
+    def decorator(handler):
+        # python-socketio prueba firmas con TypeError (disconnect con/sin reason):
+        # pasar solo los argumentos que el handler acepta para no contar falsos errores
+        arity = handler.__code__.co_argcount
+
+        @functools.wraps(handler)
+        def timed(*args):
+            started = time.perf_counter()
+            try:
+                with tracer.trace(f"socketio {label}", 'SERVER', {'messaging.operation': label}):
+                    if args and isinstance(args[0], dict) and args[0].get('user_id'):
+                        tracer.annotate(user_id=args[0]['user_id'])
+                    return handler(*args[:arity])
+            except Exception:
+                SOCKET_EVENT_ERRORS.inc(label)
+                raise
+            finally:
+                SOCKET_EVENT_SECONDS.observe(time.perf_counter() - started, label)
+        return socketio.on(event, namespace=namespace)(timed)
+    return decorator
+
+def _pool_gauges():
+    values = {}
+    mysql = db_pool.stats()
+    for state in ('in_use', 'available', 'size', 'peak_in_use'):
+        values[('mysql', state)] = mysql[state]
+    for state, value in sqlite_pool.stats().items():
+        values[('sqlite', state)] = value
+    smtp = smtp_pool.stats()
+    for state in ('in_use', 'idle', 'size'):
+        values[('smtp', state)] = smtp[state]
+    return values
+
+Gauge('cuix_active_connections', 'Socket.IO connections open in this process',
+      callback=lambda: {(): session_store.stats()['sockets']})
+Gauge('cuix_pool_connections', 'Connection pool usage by pool and state', ['pool', 'state'], callback=_pool_gauges)
+Gauge('cuix_mysql_pool_exhausted', 'MySQL checkouts that timed out waiting for a free connection (cumulative)',
+      callback=lambda: {(): db_pool.stats()['exhausted']})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition of this process's metrics"""
+    response = make_response(metrics_registry.render())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+# ============= ORDER DELTAS =============
+# order_updated ships the whole order document to legacy clients. Clients
+# that connect with auth {'deltas': true} instead receive JSON-patch style
+# operations against the last version they were sent:
+#   {'version': 8, 'base_version': 7, 'patch': [{'op': 'replace', 'path': '/cabeza', 'value': ...}]}
+# A client whose version differs from base_version asks for 'order_resync'.
+def _json_pointer(key):
+    return '/' + str(key).replace('~', '~0').replace('/', '~1')
+
+def order_patch(previous, current):
+    """Top-level patch operations turning previous into current (appends to lists use '/-')"""
+    ops = []
+    for key, value in current.items():
+        path = _json_pointer(key)
+        if key not in previous:
+            ops.append({'op': 'add', 'path': path, 'value': value})
+            continue
+        old = previous[key]
+        if old == value:
+            continue
+        if isinstance(old, list) and isinstance(value, list) and len(value) > len(old) and value[:len(old)] == old:
+            ops.extend({'op': 'add', 'path': path + '/-', 'value': item} for item in value[len(old):])
+        else:
+            ops.append({'op': 'replace', 'path': path, 'value': value})
+    for key in previous:
+        if key not in current:
+            ops.append({'op': 'remove', 'path': _json_pointer(key)})
+    return ops
+
+def order_update_payload(session):
+    """Build the next order_updated event and advance the session's order version.
+
+    Returns None when nothing changed since the last update. Mutates the
+    session (version, synced snapshot): call it before session_store.save().
+    """
+    ops = order_patch(session.get('order_synced') or {}, session['order_data'])
+    if not ops:
+        return None
+    base_version = session.get('order_version', 0)
+    session['order_version'] = base_version + 1
+    session['order_synced'] = copy.deepcopy(session['order_data'])
+    if session.get('deltas'):
+        return {'version': session['order_version'], 'base_version': base_version, 'patch': ops}
+    return {'version': session['order_version'], 'order_data': session['order_data']}
+
+def emit_order_update(payload):
+    """emit('order_updated') to the current client, recording the payload size"""
+    # Mismo json.dumps que usa python-socketio: los bytes que viajan por el socket
+    ORDER_UPDATE_BYTES.observe(len(json.dumps(payload)), 'patch' if 'patch' in payload else 'full')
+    emit('order_updated', payload)
+
 # SocketIO event handlers
-@socketio.on('connect')
-def handle_connect():
-    """Handle new WebSocket connection"""
+@socket_event('connect')
+def handle_connect(auth=None):
+    """Handle new WebSocket connection (auth may carry the product flow, the
+    language and delta support, e.g. {'producto': 'funko', 'lang': 'en', 'deltas': true})"""
     user_id = str(uuid.uuid4())
+    tracer.annotate(user_id=user_id)
+    auth = auth or {}
 
-    conv_id, order_data = conversation_manager.get_or_create_conversation(user_id)
+    conv_id, order_data, _ = conversation_manager.get_or_create_conversation(user_id)
 
-    conversation_sessions[user_id] = {
-        'conversation_id': conv_id,
-        'order_data': order_data or order_manager.default_order.copy(),
-        'current_step': order_manager.get_current_step(order_data),
-        'connected_at': datetime.now().isoformat()
-    }
+    session = session_store.new_session(conv_id, order_data, auth.get('producto'), auth.get('lang'), auth.get('deltas'))
+    # Si la sesión se desaloja, al rehidratarla se recuperan idioma y deltas
+    conversation_manager.save_session_settings(user_id, session['lang'], session['deltas'])
+    session_store.save(user_id, session)
+    session_store.bind(request.sid, user_id)
+    funnel_tracker.record(user_id, session, 'start')
+    manager = session_store.manager_for(session)
+    lang = session['lang']
 
     history = conversation_manager.get_conversation_history(user_id)
 
     emit('connection_status', {
         'status': 'online',
         'user_id': user_id,
-        'initial_prompt': conversation_sessions[user_id]['current_step']['prompt'] if conversation_sessions[user_id]['current_step'] else response_manager.get_response('greeting'),
-        'current_step': conversation_sessions[user_id]['current_step']['id'] if conversation_sessions[user_id]['current_step'] else None,
-        'order_data': conversation_sessions[user_id]['order_data'],
+        'product': session['product'],
+        'lang': lang,
+        'initial_prompt': (manager.step_prompt(session['current_step'], session['order_data'], lang)
+                           if session['current_step'] else response_manager.get_response('greeting', lang=lang)),
+        'current_step': session['current_step'].id if session['current_step'] else None,
+        'order_data': session['order_data'],
+        'order_version': session['order_version'],
         'conversation_history': history[-5:]
     })
 
     logger.info(f"Client connected: {user_id}")
 
-@socketio.on('disconnect')
+@socket_event('disconnect')
 def handle_disconnect():
     """Handle WebSocket disconnection"""
-    for user_id in list(conversation_sessions.keys()):
-        if conversation_sessions[user_id].get('connected_at'):
-            del conversation_sessions[user_id]
-            break
+    user_id = session_store.unbind(request.sid)
+    if user_id:
+        funnel_tracker.record(user_id, None, 'end')
 
-    logger.info("Client disconnected")
+    logger.info(f"Client disconnected: {user_id}")
 
-@socketio.on('user_message')
+@socket_event('user_message')
 def handle_user_message(data):
     """Handle user message with sequential auto-advance"""
+    lang = None
     try:
         user_id = data.get('user_id', str(uuid.uuid4()))
         message_content = data.get('content', '')
 
-        if user_id not in conversation_sessions:
-            conv_id, order_data = conversation_manager.get_or_create_conversation(user_id)
-            conversation_sessions[user_id] = {
-                'conversation_id': conv_id,
-                'order_data': order_data if order_data else order_manager.default_order,
-                'current_step': order_manager.pasos_orden[0],
-                'connected_at': datetime.now().isoformat()
-            }
-
-        session = conversation_sessions[user_id]
+        session = session_store.get(user_id)
+        if session is None:
+            raise RuntimeError(f"No session for user {user_id}")
+        manager = session_store.manager_for(session)
+        lang = session.get('lang')
         logger.info(f"Message from {user_id}: {message_content}")
+        funnel_tracker.record(user_id, session, 'message')
 
         # Save user message
         conversation_manager.save_message(
@@ -1703,79 +5308,94 @@ def handle_user_message(data):
 
         current_step = session['current_step']
         order_confirmed = False
+        order_queued = False
         email_sent = False
         
-        logger.info(f"User {user_id[:8]} - Current step: {current_step['id'] if current_step else 'None'}")
+        logger.info(f"User {user_id[:8]} - Current step: {current_step.id if current_step else 'None'}")
 
         if current_step:
-            extracted_info = order_manager.extract_step_info(message_content, current_step['id'])
+            extracted_info = manager.extract_step_info(message_content, current_step.id)
             logger.info(f"Extracted: {extracted_info}")
 
             # Merge extracted information (OVERWRITE mode)
-            session['order_data'] = order_manager.merge_order_data(
+            session['order_data'] = manager.merge_order_data(
                 session['order_data'],
                 extracted_info
             )
+            session['completed'] = manager.update_completion(
+                session.get('completed'), session['order_data'], current_step.fields
+            )
 
             # Update order data in database immediately
             conversation_manager.update_order_data(user_id, session['order_data'])
 
             # Handle confirmation step
-            if current_step['id'] == 'confirmacion':
+            if current_step.id == 'confirmacion':
                 confirmation = session['order_data'].get('confirmacion', '')
 
                 if confirmation == 'confirmado':
                     order_confirmed = True
-                    # Guardar pedido en la base de datos
-                    email_manager.save_order_to_db(session['order_data'], user_id)
-                    # Enviar correo
-                    email_sent = email_manager.send_order_email(session['order_data'], user_id)
+                    # Guardar pedido y enviar correo en segundo plano (ver OrderJobQueue)
+                    order_jobs.enqueue(session['order_data'], user_id, request.sid)
+                    order_queued = True
                     session['current_step'] = None  # Pedido completado
-                    ai_response = response_manager.get_response('confirmation_positive') + "\n\n" + response_manager.get_response('order_complete') + "\n\n📧 Tu pedido ha sido enviado exitosamente a cuicuix.studio@gmail.com. Nos pondremos en contacto contigo pronto para confirmar el precio y fecha de entrega.\n\n¡Gracias por tu pedido de figura Funko personalizada! 🎯"
+                    ai_response = message_catalog.render(
+                        'chat.order_sent', lang,
+                        CONFIRMATION=response_manager.get_response('confirmation_positive', lang=lang),
+                        COMPLETE=response_manager.get_response('order_complete', lang=lang)
+                    )
 
                 elif confirmation == 'rechazado':
-                    session['order_data'] = order_manager.default_order
+                    session['order_data'] = manager.default_order
+                    session['completed'] = 0
                     conversation_manager.update_order_data(user_id, session['order_data'])
-                    session['current_step'] = order_manager.pasos_orden[0]
-                    ai_response = response_manager.get_response('confirmation_negative') + "\n\nHe reiniciado el proceso de pedido. Vamos a empezar de nuevo.\n\n" + order_manager.pasos_orden[0]['prompt']
+                    session['current_step'] = manager.pasos_orden[0]
+                    ai_response = message_catalog.render(
+                        'chat.order_restarted', lang,
+                        RESPONSE=response_manager.get_response('confirmation_negative', lang=lang),
+                        PROMPT=manager.step_prompt(manager.pasos_orden[0], session['order_data'], lang)
+                    )
 
                 elif confirmation == 'cambiar':
                     change_section = session['order_data'].get('cambiar_seccion', '')
-                    target_step_id = order_manager.get_section_to_change(change_section)
-                    target_step = order_manager.get_step_by_id(target_step_id)
+                    target_step_id = manager.get_section_to_change(change_section)
+                    target_step = manager.get_step_by_id(target_step_id)
                     if target_step:
                         session['current_step'] = target_step
-                        ai_response = response_manager.get_response('acknowledgment') + f"\n\nVamos a modificar los detalles de {change_section}.\n\nPor favor, describe los nuevos detalles que quieres:"
+                        ai_response = message_catalog.render(
+                            'chat.change_section', lang,
+                            RESPONSE=response_manager.get_response('acknowledgment', lang=lang),
+                            SECTION=change_section
+                        )
                     else:
                          # Fallback if section unknown
-                        next_incomplete_step = order_manager.get_current_step(session['order_data'])
+                        next_incomplete_step = manager.get_current_step(session['order_data'], session['completed'])
                         session['current_step'] = next_incomplete_step
-                        confirmation_prompt = order_manager.get_completion_summary(session['order_data'])
-                        prompt = next_incomplete_step['prompt'].replace('{RESUMEN_COMPLETO}', confirmation_prompt)
-                        ai_response = "No entendí qué sección cambiar. Volvamos a la confirmación.\n\n" + prompt
+                        ai_response = message_catalog.render(
+                            'chat.change_unknown', lang,
+                            PROMPT=manager.step_prompt(next_incomplete_step, session['order_data'], lang)
+                        )
 
                 else:
                     # Pendiente / No entendido
-                    confirmation_prompt = order_manager.get_completion_summary(session['order_data'])
-                    ai_response = f"Por favor, revisa el resumen y confirma:\n\n{confirmation_prompt}\n\n**¿Es correcta esta información?** Responde:\n• **SÍ** - para confirmar\n• **NO** - para corregir\n• **CAMBIAR [sección]** - para modificar algo específico"
+                    ai_response = message_catalog.render(
+                        'chat.confirm_pending', lang,
+                        SUMMARY=manager.get_completion_summary(session['order_data'], lang)
+                    )
             else:
                 # Normal step: Content saved, find next INCOMPLETE step
                 # This implements "resume where left off" logic
-                next_incomplete_step = order_manager.get_current_step(session['order_data'])
+                next_incomplete_step = manager.get_current_step(session['order_data'], session['completed'])
 
                 if next_incomplete_step:
                     session['current_step'] = next_incomplete_step
 
-                    if next_incomplete_step['id'] == 'confirmacion':
-                        confirmation_prompt = order_manager.get_completion_summary(session['order_data'])
-                        # Ensure we use a fresh copy to avoid multiple replacements
-                        next_step_copy = next_incomplete_step.copy()
-                        prompt = next_step_copy['prompt'].replace('{RESUMEN_COMPLETO}', confirmation_prompt)
-                        ai_response = "✅ ¡Guardado!\n\n" + prompt
-                    else:
-                        ai_response = f"✅ ¡Guardado! Pasemos a lo siguiente.\n\n{next_incomplete_step['prompt']}"
+                    ai_response = message_catalog.render(
+                        'chat.saved_review' if next_incomplete_step.id == 'confirmacion' else 'chat.saved_next', lang,
+                        PROMPT=manager.step_prompt(next_incomplete_step, session['order_data'], lang)
+                    )
                 else:
-                    ai_response = "✅ ¡Todo listo! Revisemos el pedido."
+                    ai_response = message_catalog.render('chat.all_done', lang)
         
         print(f"DEBUG: Sending ai_response: {ai_response[:80]}...")
         
@@ -1786,73 +5406,82 @@ def handle_user_message(data):
             ai_response,
             session['order_data']
         )
+        order_update = order_update_payload(session)
+        session_store.save(user_id, session)
+        funnel_tracker.record(user_id, session, 'complete' if order_confirmed else 'step')
+        if order_confirmed:
+            # Un pedido confirmado no debe depender del siguiente flush periódico
+            conversation_manager.flush()
 
         # Send response to client
         emit('ai_response', {
             'content': ai_response,
-            'current_step': session['current_step']['id'] if session['current_step'] else None,
+            'current_step': session['current_step'].id if session['current_step'] else None,
             'step_complete': True,
             'order_complete': session['current_step'] is None,
             'order_confirmed': order_confirmed,
+            'order_queued': order_queued,
             'email_sent': email_sent,
             'timestamp': datetime.now().isoformat()
         })
 
         # Update order summary
-        emit('order_updated', {
-            'order_data': session['order_data']
-        })
+        if order_update:
+            emit_order_update(order_update)
 
     except Exception as e:
         logger.error(f"Error handling message: {str(e)}")
         emit('ai_response', {
-            'content': response_manager.get_response('error_generic'),
+            'content': response_manager.get_response('error_generic', lang=lang),
             'error': True
         })
 
-@socketio.on('edit_section')
+@socket_event('edit_section')
 def handle_edit_section(data):
     """Handle request to edit a specific section"""
     user_id = data.get('user_id')
     section_key = data.get('section_key')
 
-    if user_id in conversation_sessions:
-        session = conversation_sessions[user_id]
-
+    session = session_store.get(user_id)
+    if session:
+        manager = session_store.manager_for(session)
         # Find step by key_field
-        target_step = None
-        for paso in order_manager.pasos_orden:
-            if paso['key_field'] == section_key:
-                target_step = paso
-                break
+        target_step = manager.get_step_by_key(section_key)
 
         if target_step:
             session['current_step'] = target_step
+            session_store.save(user_id, session)
+            funnel_tracker.record(user_id, session, 'edit')
 
             # Send prompt for that section
-            ai_response = f"✏️ **Editando: {target_step['nombre']}**\n\n{target_step['prompt']}"
+            lang = session.get('lang')
+            ai_response = message_catalog.render(
+                'chat.editing', lang,
+                STEP=manager.step_name(target_step, lang),
+                PROMPT=manager.step_prompt(target_step, session['order_data'], lang)
+            )
 
             # Save system notification
             conversation_manager.save_message(user_id, 'assistant', ai_response, session['order_data'])
 
             emit('ai_response', {
                 'content': ai_response,
-                'current_step': target_step['id'],
+                'current_step': target_step.id,
                 'is_edit_mode': True,
                 'timestamp': datetime.now().isoformat()
             })
 
             logger.info(f"User {user_id} switched to edit section: {section_key}")
 
-@socketio.on('clear_section')
+@socket_event('clear_section')
 def handle_clear_section(data):
     """Handle request to clear a specific section"""
     user_id = data.get('user_id')
     section_key = data.get('section_key')
 
-    if user_id in conversation_sessions:
-        session = conversation_sessions[user_id]
-
+    session = session_store.get(user_id)
+    if session:
+        manager = session_store.manager_for(session)
         # Clear data
         if section_key in session['order_data']:
             session['order_data'][section_key] = '' if section_key != 'fotos_referencia' else []
@@ -1861,95 +5490,113 @@ def handle_clear_section(data):
             if section_key == 'fotos_referencia':
                 session['order_data']['fotos_comentarios'] = ''
 
+            session['completed'] = manager.update_completion(
+                session.get('completed'), session['order_data'], (section_key, 'fotos_comentarios')
+            )
             conversation_manager.update_order_data(user_id, session['order_data'])
 
             # Find step and switch to it
-            target_step = None
-            for paso in order_manager.pasos_orden:
-                if paso['key_field'] == section_key:
-                    target_step = paso
-                    break
+            target_step = manager.get_step_by_key(section_key)
 
             if target_step:
                 session['current_step'] = target_step
-                ai_response = f"🗑️ **Sección borrada: {target_step['nombre']}**\n\n{target_step['prompt']}"
+                funnel_tracker.record(user_id, session, 'edit')
+                lang = session.get('lang')
+                ai_response = message_catalog.render(
+                    'chat.section_cleared', lang,
+                    STEP=manager.step_name(target_step, lang),
+                    PROMPT=manager.step_prompt(target_step, session['order_data'], lang)
+                )
 
                 conversation_manager.save_message(user_id, 'assistant', ai_response, session['order_data'])
 
                 emit('ai_response', {
                     'content': ai_response,
-                    'current_step': target_step['id'],
+                    'current_step': target_step.id,
                     'timestamp': datetime.now().isoformat()
                 })
 
-                emit('order_updated', {'order_data': session['order_data']})
-@socketio.on('image_upload')
-def handle_image_upload(data):
-    """Handle image upload for reference photos"""
-    try:
-        user_id = data.get('user_id')
-        filename = data.get('filename')
-        image_data = data.get('data')
+                order_update = order_update_payload(session)
+                if order_update:
+                    emit_order_update(order_update)
+
+            session_store.save(user_id, session)
+def attach_reference_photo(user_id, session, foto):
+    """Add a stored photo to the session's order, notify the client and
+    auto-advance past the photo step"""
+    manager = session_store.manager_for(session)
+    funnel_tracker.record(user_id, session, 'photo')
+    # order_data keeps only the blob reference
+    if 'fotos_referencia' not in session['order_data']:
+        session['order_data']['fotos_referencia'] = []
+
+    session['order_data']['fotos_referencia'].append(foto)
+    image_processor.submit(foto)
+    session['completed'] = manager.update_completion(
+        session.get('completed'), session['order_data'], ('fotos_referencia',)
+    )
+
+    # Update database
+    conversation_manager.update_order_data(user_id, session['order_data'])
+    order_update = order_update_payload(session)
+    session_store.save(user_id, session)
+
+    # Send success message
+    emit('image_processed', {
+        'filename': foto['filename'],
+        'success': True
+    })
 
-        if user_id in conversation_sessions:
-            session = conversation_sessions[user_id]
+    # Update order summary
+    if order_update:
+        emit_order_update(order_update)
+
+    logger.info(f"Image uploaded: {foto['filename']}")
+
+    # AUTO-ADVANCE LOGIC
+    # If we are currently in the 'fotos_referencia' step, check if we can advance
+    current_step = session.get('current_step')
+    if current_step and current_step.id == 'fotos_referencia':
+        # Determine next step
+        next_step = manager.get_current_step(session['order_data'], session['completed'])
+
+        # If the next logical step is different from current (meaning this one is complete), advance
+        if next_step and next_step.id != 'fotos_referencia':
+            session['current_step'] = next_step
+            session_store.save(user_id, session)
+            funnel_tracker.record(user_id, session, 'step')
+
+            # Generate response for the transition
+            ai_response = message_catalog.render(
+                'chat.photo_next', session.get('lang'),
+                PROMPT=manager.step_prompt(next_step, session['order_data'], session.get('lang'))
+            )
 
-            # Save image data to order
-            if 'fotos_referencia' not in session['order_data']:
-                session['order_data']['fotos_referencia'] = []
+            # Save assistant message
+            conversation_manager.save_message(user_id, 'assistant', ai_response, session['order_data'])
 
-            session['order_data']['fotos_referencia'].append({
-                'filename': filename,
-                'data': image_data,
+            # Emit response to client
+            emit('ai_response', {
+                'content': ai_response,
+                'current_step': next_step.id,
+                'step_complete': True,
                 'timestamp': datetime.now().isoformat()
             })
 
-            # Update database
-            conversation_manager.update_order_data(user_id, session['order_data'])
-
-            # Send success message
-            emit('image_processed', {
-                'filename': filename,
-                'success': True
-            })
-
-            # If current step is fotos_referencia, we might want to acknowledge it
-            # But the user might want to upload multiple.
-            # We'll just update summary and let them manually say "listo" or type something if they want to proceed,
-            # OR since we have auto-advance, maybe uploading a photo counts as "content"?
-            # For now, let's just confirm upload.
-
-            # Update order summary
-            emit('order_updated', {
-                'order_data': session['order_data']
-            })
-
-            logger.info(f"Image uploaded: {filename}")
-
-            # AUTO-ADVANCE LOGIC
-            # If we are currently in the 'fotos_referencia' step, check if we can advance
-            current_step = session.get('current_step')
-            if current_step and current_step['id'] == 'fotos_referencia':
-                # Determine next step
-                next_step = order_manager.get_current_step(session['order_data'])
-
-                # If the next logical step is different from current (meaning this one is complete), advance
-                if next_step and next_step['id'] != 'fotos_referencia':
-                    session['current_step'] = next_step
-
-                    # Generate response for the transition
-                    ai_response = f"✅ ¡Foto recibida! Pasemos al siguiente paso.\n\n{next_step['prompt']}"
-
-                    # Save assistant message
-                    conversation_manager.save_message(user_id, 'assistant', ai_response, session['order_data'])
+@socket_event('image_upload')
+def handle_image_upload(data):
+    """Handle a whole image sent as base64 in one event (legacy clients; see upload_start)"""
+    try:
+        user_id = data.get('user_id')
+        filename = data.get('filename')
+        image_data = data.get('data')
 
-                    # Emit response to client
-                    emit('ai_response', {
-                        'content': ai_response,
-                        'current_step': next_step['id'],
-                        'step_complete': True,
-                        'timestamp': datetime.now().isoformat()
-                    })
+        session = session_store.get(user_id)
+        if session:
+            # ~4 caracteres base64 por cada 3 bytes
+            if len(image_data or '') * 3 // 4 > UPLOAD_CONFIG['max_bytes']:
+                raise UploadError('La imagen supera el tamaño máximo')
+            attach_reference_photo(user_id, session, blob_store.put_base64(image_data, filename))
 
     except Exception as e:
         logger.error(f"Error handling image upload: {str(e)}")
@@ -1958,57 +5605,137 @@ def handle_image_upload(data):
             'success': False
         })
 
-@socketio.on('reset_order')
+# Subida por fragmentos (acks con callback):
+#   upload_start  {filename, size, mime, upload_id?} -> {upload_id, offset, size, chunk_size}
+#   upload_chunk  {upload_id, offset, data: bytes}   -> {offset}   (+ evento upload_progress)
+#   upload_status {upload_id}                        -> {offset, size, ...}  (reanudar tras reconectar)
+#   upload_finish {user_id, upload_id}               -> {success, foto}
+@socket_event('upload_start')
+def handle_upload_start(data):
+    try:
+        data = data or {}
+        return upload_manager.start(data.get('filename') or 'imagen', data.get('size'), data.get('mime'), data.get('upload_id'))
+    except UploadError as e:
+        return {'error': str(e)}
+    except Exception as e:
+        logger.error(f"Error starting upload: {e}")
+        return {'error': 'No se pudo iniciar la subida'}
+
+@socket_event('upload_chunk')
+def handle_upload_chunk(data):
+    upload_id = (data or {}).get('upload_id')
+    try:
+        offset = upload_manager.append(upload_id, int(data.get('offset', -1)), data.get('data'))
+        state = upload_manager.status(upload_id)
+        emit('upload_progress', {'upload_id': upload_id, 'received': offset, 'size': state['size']})
+        return {'offset': offset}
+    except UploadError as e:
+        return {'error': str(e)}
+    except Exception as e:
+        logger.error(f"Error receiving upload chunk {upload_id}: {e}")
+        return {'error': 'Error al recibir el fragmento'}
+
+@socket_event('upload_status')
+def handle_upload_status(data):
+    try:
+        return upload_manager.status((data or {}).get('upload_id'))
+    except UploadError as e:
+        return {'error': str(e)}
+
+@socket_event('upload_finish')
+def handle_upload_finish(data):
+    data = data or {}
+    user_id = data.get('user_id')
+    try:
+        session = session_store.get(user_id)
+        if session is None:
+            raise UploadError('Sesión no encontrada')
+        foto = upload_manager.finish(data.get('upload_id'))
+        attach_reference_photo(user_id, session, foto)
+        return {'success': True, 'foto': foto}
+    except UploadError as e:
+        return {'success': False, 'error': str(e)}
+    except Exception as e:
+        logger.error(f"Error finishing upload: {e}")
+        return {'success': False, 'error': 'No se pudo guardar la imagen'}
+
+@socket_event('reset_order')
 def handle_reset_order(data):
     """Reset the order"""
     user_id = data.get('user_id', str(uuid.uuid4()))
-    if user_id in conversation_sessions:
-        conversation_sessions[user_id]['order_data'] = order_manager.default_order
-        conversation_sessions[user_id]['current_step'] = order_manager.pasos_orden[0]
+    session = session_store.get(user_id)
+    if session:
+        manager = session_store.manager_for(session)
+        session['order_data'] = manager.default_order
+        session['current_step'] = manager.pasos_orden[0]
+        session['completed'] = 0
+        order_update = order_update_payload(session)
+        session_store.save(user_id, session)
+        funnel_tracker.record(user_id, session, 'step')
 
-        conversation_manager.update_order_data(user_id, conversation_sessions[user_id]['order_data'])
+        conversation_manager.update_order_data(user_id, session['order_data'])
 
+        if order_update:
+            emit_order_update(order_update)
         emit('order_reset', {
-            'message': 'Pedido reiniciado correctamente.',
-            'new_prompt': order_manager.pasos_orden[0]['prompt']
+            'message': message_catalog.render('chat.order_reset', session.get('lang')),
+            'new_prompt': manager.step_prompt(manager.pasos_orden[0], session['order_data'], session.get('lang'))
         })
 
-@socketio.on('get_order_summary')
+@socket_event('get_order_summary')
 def handle_get_order_summary(data):
     """Get current order summary"""
     user_id = data.get('user_id', str(uuid.uuid4()))
-    if user_id in conversation_sessions:
-        session = conversation_sessions[user_id]
-        summary = order_manager.get_completion_summary(session['order_data'])
+    session = session_store.get(user_id)
+    if session:
+        manager = session_store.manager_for(session)
+        lang = session.get('lang')
+        summary = manager.get_completion_summary(session['order_data'], lang)
         progress = []
 
-        for paso in order_manager.pasos_orden:
-            if order_manager._is_step_complete(session['order_data'], paso):
-                progress.append(f"✅ {paso['nombre']}")
+        completed = session.get('completed')
+        if completed is None:
+            completed = manager.get_completion(session['order_data'])
+        for paso in manager.pasos_orden:
+            if completed & paso.bit:
+                progress.append(f"✅ {manager.step_name(paso, lang)}")
             else:
-                progress.append(f"⏳ {paso['nombre']}")
+                progress.append(f"⏳ {manager.step_name(paso, lang)}")
 
         emit('order_summary', {
             'summary': summary,
             'progress': '\n'.join(progress),
-            'current_step': session['current_step']['nombre'] if session['current_step'] else 'Completo'
+            'current_step': (manager.step_name(session['current_step'], lang) if session['current_step']
+                             else message_catalog.render('chat.order_done', lang))
         })
 
-@socketio.on('borrar_seccion')
+@socket_event('order_resync')
+def handle_order_resync(data):
+    """Full order document and version for a client that missed a delta (acknowledgement reply)"""
+    user_id = (data or {}).get('user_id')
+    session = session_store.get(user_id)
+    if session is None:
+        return {'error': 'Sesión no encontrada'}
+    # Cualquier cambio pendiente se incluye en el documento completo
+    order_update_payload(session)
+    session_store.save(user_id, session)
+    return {'version': session['order_version'], 'order_data': session['order_data']}
+
+@socket_event('borrar_seccion')
 def handle_borrar_seccion(data):
     """Borrar una sección específica y solicitar que se complete de nuevo"""
     try:
         user_id = data.get('user_id')
         seccion = data.get('seccion')
 
-        if user_id not in conversation_sessions:
+        session = session_store.get(user_id)
+        if session is None:
             emit('seccion_borrada', {'success': False, 'error': 'Sesión no encontrada'})
             return
-
-        session = conversation_sessions[user_id]
+        manager = session_store.manager_for(session)
 
         # Guardar la sección actual donde estaba el usuario
-        seccion_retorno = session['current_step']['id'] if session['current_step'] else None
+        seccion_retorno = session['current_step'].id if session['current_step'] else None
 
         # Borrar el contenido de la sección
         if seccion == 'fotos':
@@ -2016,36 +5743,44 @@ def handle_borrar_seccion(data):
         else:
             session['order_data'][seccion] = ''
 
+        session['completed'] = manager.update_completion(
+            session.get('completed'), session['order_data'], ('fotos_referencia' if seccion == 'fotos' else seccion,)
+        )
+
         # Actualizar la base de datos
         conversation_manager.update_order_data(user_id, session['order_data'])
+        session_store.save(user_id, session)
 
         # Buscar el paso correspondiente a la sección borrada
-        paso_a_solicitar = None
-        for paso in order_manager.pasos_orden:
-            if paso['key_field'] == seccion:
-                paso_a_solicitar = paso
-                break
+        paso_a_solicitar = manager.get_step_by_key(seccion)
 
         if paso_a_solicitar:
             session['current_step'] = paso_a_solicitar
-            prompt = paso_a_solicitar['prompt']
+            funnel_tracker.record(user_id, session, 'edit')
+            lang = session.get('lang')
+            prompt = manager.step_prompt(paso_a_solicitar, session['order_data'], lang)
 
             # Si hay una sección de retorno, configurar para regresar después
             if seccion_retorno and seccion_retorno != seccion:
                 session['seccion_retorno'] = seccion_retorno
-                prompt += "\n\n⚠️ *Nota: Una vez completado, volverás a la sección donde estabas.*"
+                prompt = message_catalog.render('chat.section_return', lang, PROMPT=prompt)
+
+            order_update = order_update_payload(session)
+            session_store.save(user_id, session)
 
-            emit('seccion_borrada', {
+            result = {
                 'success': True,
-                'order_data': session['order_data'],
                 'nuevo_prompt': prompt,
                 'seccion_retorno': seccion_retorno
-            })
+            }
+            if not session.get('deltas'):
+                result['order_data'] = session['order_data']
+            emit('seccion_borrada', result)
 
             # Enviar mensaje al chat
             emit('ai_response', {
-                'content': f"🗑️ He borrado los datos de esta sección.\n\n{prompt}",
-                'current_step': paso_a_solicitar['id'],
+                'content': message_catalog.render('chat.section_deleted', lang, PROMPT=prompt),
+                'current_step': paso_a_solicitar.id,
                 'step_complete': False,
                 'order_complete': False,
                 'order_confirmed': False,
@@ -2053,9 +5788,8 @@ def handle_borrar_seccion(data):
                 'timestamp': datetime.now().isoformat()
             })
 
-            emit('order_updated', {
-                'order_data': session['order_data']
-            })
+            if order_update:
+                emit_order_update(order_update)
         else:
             emit('seccion_borrada', {'success': False, 'error': 'Sección no encontrada'})
 
@@ -2065,6 +5799,18 @@ def handle_borrar_seccion(data):
         logger.error(f"Error al borrar sección: {str(e)}")
         emit('seccion_borrada', {'success': False, 'error': str(e)})
 
+@socket_event('connect', namespace=ADMIN_NAMESPACE)
+def handle_admin_connect(auth):
+    """Admin dashboards authenticate with the same Bearer token as the API"""
+    if verify_admin_token((auth or {}).get('token')) is None:
+        return False
+    logger.info("Admin feed client connected")
+
+@socket_event('admin_resync', namespace=ADMIN_NAMESPACE)
+def handle_admin_resync(data):
+    """Replay feed events after the client's last sequence (acknowledgement reply)"""
+    return admin_feed.resync((data or {}).get('last_seq'))
+
 # Error handlers
 @app.errorhandler(404)
 def not_found(error):
@@ -2074,26 +5820,107 @@ def not_found(error):
 def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
+def parse_args(argv=None):
+    """Command line options for running the server"""
+    parser = argparse.ArgumentParser(description='Cuix Studio - Funko live chat server')
+    parser.add_argument('--mode', choices=ASYNC_MODES, default=ASYNC_MODE,
+                        help='threading = servidor de desarrollo; eventlet/gevent = producción (default: CUIX_ASYNC_MODE o threading)')
+    parser.add_argument('--host', default=os.environ.get('CUIX_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=int(os.environ.get('CUIX_PORT', 5001)))
+    parser.add_argument('--max-connections', type=int, default=int(os.environ.get('CUIX_MAX_CONNECTIONS', 2000)),
+                        help='green threads concurrentes del servidor eventlet/gevent')
+    parser.add_argument('--job-workers', type=int, default=ORDER_JOBS_CONFIG['workers'],
+                        help='workers de la cola de finalización de pedidos')
+    parser.add_argument('--processes', type=int, default=int(os.environ.get('CUIX_PROCESSES', 1)),
+                        help='procesos worker en puertos consecutivos desde --port (requiere message_queue)')
+    parser.add_argument('--debug', action='store_true',
+                        help='depurador y recarga automática de Werkzeug (solo para desarrollo)')
+    parser.add_argument('--rebuild-reports', action='store_true',
+                        help='recalcular las tablas de reportes desde orders/messages y salir')
+    return parser.parse_args(argv)
+
+def run_workers(args):
+    """Start one server process per port (port, port+1, ...) and wait for them.
+
+    Socket.IO's polling transport needs every request of a client to reach
+    the same process, so the front proxy must route with sticky sessions
+    (e.g. nginx ``ip_hash`` over the worker ports). Emits, sessions and the
+    admin feed are shared through MESSAGE_QUEUE.
+    """
+    import subprocess
+    import signal
+
+    children = []
+    for index in range(args.processes):
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--mode', args.mode, '--host', args.host, '--port', str(args.port + index),
+               '--max-connections', str(args.max_connections), '--job-workers', str(args.job_workers),
+               '--processes', '1']
+        # Mismo secreto en todos los workers: un token vale en cualquiera de ellos
+        env = dict(os.environ, CUIX_WORKER_INDEX=str(index), CUIX_ADMIN_SECRET=ADMIN_TOKEN_SECRET)
+        children.append(subprocess.Popen(cmd, env=env))
+        logger.info(f"Worker {index} started on port {args.port + index} (pid {children[-1].pid})")
+
+    def stop(signum=None, frame=None):
+        for child in children:
+            if child.poll() is None:
+                child.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for child in children:
+            child.wait()
+    except KeyboardInterrupt:
+        stop()
+        for child in children:
+            child.wait()
+
+def server_options(args):
+    """Keyword arguments for socketio.run() in the selected async mode"""
+    if args.mode == 'threading':
+        return {'debug': args.debug, 'use_reloader': args.debug, 'allow_unsafe_werkzeug': True}
+    if args.mode == 'eventlet':
+        return {'debug': False, 'use_reloader': False, 'log_output': args.debug, 'max_size': args.max_connections}
+    return {'debug': False, 'use_reloader': False, 'log_output': args.debug, 'spawn': args.max_connections}
+
 if __name__ == '__main__':
     # Create necessary directories
     for directory in ['logs', 'uploads', 'reports', 'orders_data']:
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-    logger.info("Starting Funko Live Chat Server - NO AI VERSION")
+    args = parse_args()
+
+    if args.rebuild_reports:
+        print(f"Reportes recalculados desde {report_manager.rebuild()} pedidos")
+        sys.exit(0)
+
+    if args.processes > 1:
+        if not MESSAGE_QUEUE:
+            sys.exit("--processes > 1 requiere message_queue (CUIX_MESSAGE_QUEUE=redis://...) para compartir emits y sesiones")
+        run_workers(args)
+        sys.exit(0)
+
+    logger.info(f"Starting Funko Live Chat Server - NO AI VERSION (mode={args.mode})")
+
+    # Drain jobs left over from a previous run. With the reloader the parent
+    # process only watches files, so the workers belong to the child.
+    order_jobs.config['workers'] = args.job_workers
+    reloader = args.mode == 'threading' and args.debug
+    if not reloader or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        order_jobs.start()
 
     print("=" * 60)
     print("🎯 FUNKO LIVE CHAT - VERSIÓN SIN IA - INICIANDO 🎯")
     print("=" * 60)
-    print("📍 Servidor corriendo en: http://localhost:5001")
+    print(f"📍 Servidor corriendo en: http://localhost:{args.port} (modo {args.mode})")
     print("🤖 IA: DESACTIVADA (Sistema de respuestas predefinidas)")
     print("🌐 Abre tu navegador y visita esa URL")
     print("=" * 60)
 
     socketio.run(
         app,
-        host='0.0.0.0',
-        port=5001,
-        debug=True,
-        allow_unsafe_werkzeug=True
+        host=args.host,
+        port=args.port,
+        **server_options(args)
     )
\ No newline at end of file
@@ -0,0 +1,140 @@
+"""Benchmark: CONFIRMATION_MATCHER vs the old any(word in message) checks.
+
+    python benchmarks/intent_matching.py [--db conversations.db] [--repeat 5]
+
+extract_confirmation only sees answers to the final review, so the corpus
+is every customer message stored in the chat database that follows the
+review prompt; if there are none, a synthetic corpus is built from typical
+review answers (casing, punctuation and short add-ons varied). Both sides
+run with the same extractor signature; the matcher is timed as the server
+runs it (find_all memo on) and with the memo off, which is the cost of a
+message seen for the first time. Also prints accuracy on a labeled set of
+review answers and how many corpus messages the two approaches classify
+differently.
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+LABELED = [
+    ('sí', 'confirmado'), ('Sí, confirmar', 'confirmado'), ('ok', 'confirmado'), ('de acuerdo', 'confirmado'),
+    ('Perfecto, no hay cambios', 'confirmado'), ('está bien así', 'confirmado'), ('dale, confirmo', 'confirmado'),
+    ('no', 'rechazado'), ('incorrecto', 'rechazado'), ('No está bien', 'rechazado'), ('está mal', 'rechazado'),
+    ('sí pero cambiar los pies', 'cambiar'), ('quiero cambiar la cabeza', 'cambiar'), ('modificar el polo', 'cambiar'),
+    ('casi listo', 'pendiente'), ('anotado', 'pendiente'), ('no sé si está bien', 'pendiente'),
+    ('tal vez', 'pendiente'), ('hola', 'pendiente'), ('¿cuánto cuesta?', 'pendiente'),
+]
+
+ADD_ONS = ['', '', '', '!', '.', ' 😀', ' gracias', ', gracias!', ' por favor']
+
+def legacy_confirmation(flow, step, message, extracted):
+    """extract_confirmation before the compiled matcher"""
+    message_lower = message.lower()
+    if any(word in message_lower for word in ['sí', 'si', 'confirmar', 'correcto', 'ok']):
+        extracted[step.target] = 'confirmado'
+    elif any(word in message_lower for word in ['no', 'incorrecto', 'mal']):
+        extracted[step.target] = 'rechazado'
+    elif 'cambiar' in message_lower:
+        extracted[step.target] = 'cambiar'
+        for section in ['cabeza', 'parte superior', 'parte inferior', 'pies', 'detalles']:
+            if section in message_lower:
+                extracted['cambiar_seccion'] = section
+                break
+    else:
+        extracted[step.target] = 'pendiente'
+
+def review_markers(app, flow):
+    """Tail of the review prompt in every language (after the order summary)"""
+    markers = set()
+    for lang in app.message_catalog.languages:
+        source = app.message_catalog.template(f"flows.{flow.id}.steps.confirmacion.prompt", lang).source
+        markers.add(source.split('{RESUMEN_COMPLETO}')[-1].strip())
+    return [marker for marker in markers if marker]
+
+def load_corpus(db_path, size, markers):
+    messages = []
+    if os.path.exists(db_path):
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            previous = (None, None, '')
+            for conversation_id, role, content in conn.execute(
+                    "SELECT conversation_id, role, content FROM messages ORDER BY conversation_id, timestamp, id"):
+                if role == 'user' and previous[0] == conversation_id and previous[1] == 'assistant' \
+                        and any(marker in previous[2] for marker in markers):
+                    messages.append(content)
+                previous = (conversation_id, role, content)
+        except sqlite3.Error:
+            pass
+        finally:
+            conn.close()
+    if messages:
+        return messages, f"{db_path} ({len(messages)} answers to the review prompt)"
+
+    rng = random.Random(42)
+    answers = [message for message, _ in LABELED]
+    for _ in range(size):
+        answer = rng.choice(answers)
+        answer = rng.choice([answer, answer.lower(), answer.capitalize(), answer.upper()])
+        messages.append(answer + rng.choice(ADD_ONS))
+    return messages, f"synthetic ({size} review answers, none found in {db_path})"
+
+def per_message_us(extract, flow, step, corpus, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for message in corpus:
+            extract(flow, step, message, {})
+        best = min(best, time.perf_counter() - started)
+    return best / len(corpus) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--db', default=os.path.join(ROOT, 'conversations.db'))
+    parser.add_argument('--size', type=int, default=20000, help='synthetic corpus size')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.chdir(ROOT)
+    os.makedirs('logs', exist_ok=True)
+    import app
+
+    flow = app.get_flow('funko')
+    step = SimpleNamespace(target='confirmacion')
+
+    def classify(extract, message):
+        extracted = {}
+        extract(flow, step, message, extracted)
+        return extracted['confirmacion']
+
+    corpus, source = load_corpus(args.db, args.size, review_markers(app, flow))
+    print(f"Corpus: {source}")
+
+    memo_max_length = app.INTENT_MEMO_MAX_LENGTH
+    timings = [('any() substrings', legacy_confirmation, memo_max_length),
+               ('IntentMatcher', app.extract_confirmation, memo_max_length),
+               ('  memo off', app.extract_confirmation, -1)]
+    for name, extract, app.INTENT_MEMO_MAX_LENGTH in timings:
+        for matcher in (app.CONFIRMATION_MATCHER, flow.section_matcher):
+            matcher._memo.clear()
+        correct = sum(classify(extract, message) == intent for message, intent in LABELED)
+        print(f"{name:18} {per_message_us(extract, flow, step, corpus, args.repeat):7.2f} us/message   "
+              f"labeled accuracy {correct}/{len(LABELED)}")
+    app.INTENT_MEMO_MAX_LENGTH = memo_max_length
+
+    differ = sum(classify(legacy_confirmation, message) != classify(app.extract_confirmation, message)
+                 for message in corpus)
+    print(f"Classified differently: {differ}/{len(corpus)}")
+    for message, intent in LABELED:
+        old, new = classify(legacy_confirmation, message), classify(app.extract_confirmation, message)
+        if old != intent or new != intent:
+            print(f"  {message!r:32} expected {intent:10} any(): {old:10} matcher: {new}")
+
+if __name__ == '__main__':
+    main()
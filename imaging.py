@@ -0,0 +1,39 @@
+"""Image rendering for the reference photo process pool.
+
+Workers of app.ImageProcessor run with the 'spawn' start method and import
+only this module, not app.py (which at import time patches the process for
+eventlet/gevent, opens the database pools, starts background threads and
+registers atexit hooks). Keep it that way: no imports from app and no
+module-level side effects; everything a job needs comes in its arguments.
+"""
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+def render_image_variants(src_path, targets, quality):
+    """Decode an image once and write each (path, max_edge) target as an EXIF-free JPEG"""
+    results = {}
+    with Image.open(src_path) as img:
+        img.seek(0)  # GIF animados: primer cuadro
+        # Aplicar la orientación EXIF antes de descartar los metadatos
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+        elif img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        for variant, (path, max_edge) in targets.items():
+            out = img.copy()
+            out.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            out.save(tmp_path, 'JPEG', quality=quality, optimize=True, progressive=True)
+            os.replace(tmp_path, path)
+            results[variant] = {'width': out.width, 'height': out.height, 'size': os.path.getsize(path)}
+    return results
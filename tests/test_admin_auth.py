@@ -0,0 +1,39 @@
+"""Admin tokens: shared by require_auth and the /admin Socket.IO namespace"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+os.makedirs('logs', exist_ok=True)
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+def test_token_round_trip():
+    assert app.verify_admin_token(app.generate_token(7)) == '7'
+
+def test_rejects_forged_and_expired_tokens(monkeypatch):
+    token = app.generate_token(7)
+    payload, signature = token.rsplit('.', 1)
+    assert app.verify_admin_token(f"8.{payload.split('.')[1]}.{signature}") is None
+    assert app.verify_admin_token('x') is None
+    assert app.verify_admin_token(None) is None
+
+    monkeypatch.setattr(app, 'ADMIN_TOKEN_TTL', -1)
+    assert app.verify_admin_token(app.generate_token(7)) is None
+
+def test_api_requires_a_valid_token():
+    client = app.app.test_client()
+    assert client.get('/api/admin/settings').status_code == 401
+    assert client.get('/api/admin/settings', headers={'Authorization': 'Bearer x'}).status_code == 401
+    headers = {'Authorization': f"Bearer {app.generate_token(1)}"}
+    assert client.get('/api/admin/settings', headers=headers).status_code == 200
+
+def test_admin_feed_requires_a_valid_token():
+    rejected = app.socketio.test_client(app.app, namespace=app.ADMIN_NAMESPACE, auth={'token': 'x'})
+    assert not rejected.is_connected(app.ADMIN_NAMESPACE)
+
+    accepted = app.socketio.test_client(app.app, namespace=app.ADMIN_NAMESPACE,
+                                        auth={'token': app.generate_token(1)})
+    assert accepted.is_connected(app.ADMIN_NAMESPACE)
+    accepted.disconnect(namespace=app.ADMIN_NAMESPACE)
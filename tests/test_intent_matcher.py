@@ -0,0 +1,45 @@
+"""Answers to the final order review (extract_confirmation)"""
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+os.makedirs('logs', exist_ok=True)
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+def classify(message):
+    extracted = {}
+    app.extract_confirmation(app.get_flow('funko'), SimpleNamespace(target='confirmacion'), message, extracted)
+    return extracted['confirmacion']
+
+@pytest.mark.parametrize('message, intent', [
+    ('sí', 'confirmado'),
+    ('Sí, confirmar', 'confirmado'),
+    ('de acuerdo', 'confirmado'),
+    ('Perfecto, no hay cambios', 'confirmado'),
+    ('No, no hay cambios', 'confirmado'),
+    ('todo bien, no?', 'confirmado'),
+    ('incorrecto', 'rechazado'),
+    ('no', 'rechazado'),
+    ('No está bien', 'rechazado'),
+    ('sí pero cambiar los pies', 'cambiar'),
+    ('casi listo', 'pendiente'),
+    ('anotado', 'pendiente'),
+    ('no sé si está bien', 'pendiente'),
+    ('No estoy seguro, tal vez sí', 'pendiente'),
+    ('no, sí, bueno', 'pendiente'),
+    ('¿No? Sí está bien', 'pendiente'),
+])
+def test_confirmation_intent(message, intent):
+    assert classify(message) == intent
+
+def test_match_span_points_into_original_message():
+    message = 'Está bien, CONFIRMO'
+    match = app.CONFIRMATION_MATCHER.match(message)
+    assert match.intent == 'confirmado'
+    assert message[match.start:match.end] == 'Está bien'
@@ -0,0 +1,57 @@
+"""MySQLPool checkout with a stand-in for mysql.connector's pool"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+os.makedirs('logs', exist_ok=True)
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+class FakeConnectionPool:
+    """Same slot semantics as pooling.MySQLConnectionPool: get_connection()
+    fails once pool_size connections are out, close() gives the slot back"""
+
+    def __init__(self, pool_size, **config):
+        self.free = pool_size
+        self.failing_pings = 0
+
+    def get_connection(self):
+        if self.free == 0:
+            raise app.mysql.connector.errors.PoolError('Failed getting connection; pool exhausted')
+        self.free -= 1
+        return FakeConnection(self)
+
+class FakeConnection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        if self.pool.failing_pings:
+            self.pool.failing_pings -= 1
+            raise app.mysql.connector.errors.InterfaceError('Lost connection to MySQL server')
+
+    def close(self):
+        self.pool.free += 1
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(app.pooling, 'MySQLConnectionPool', FakeConnectionPool)
+    return app.MySQLPool(dict(app.MYSQL_CONFIG, pool_size=3), checkout_timeout=0.1, retry_interval=0)
+
+def test_failed_ping_returns_connection_to_pool(pool):
+    size = pool.config['pool_size']
+    pool._pool.failing_pings = size
+    for _ in range(size):
+        assert pool.acquire() is None
+    assert pool.stats()['failures'] == size
+
+    conns = [pool.acquire() for _ in range(size)]
+    assert all(conn is not None for conn in conns)
+    assert pool.stats()['in_use'] == size
+    for conn in conns:
+        pool.release(conn)
+    assert pool._pool.free == size
@@ -0,0 +1,56 @@
+"""SessionStore: socket bookkeeping and rehydration after eviction"""
+import os
+import sys
+import uuid
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+os.makedirs('logs', exist_ok=True)
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+class RecordingBackend(app.MemorySessionBackend):
+    def __init__(self):
+        super().__init__(ttl=3600, max_sessions=100, max_bytes=1 << 20)
+        self.released = []
+
+    def release(self, user_id):
+        self.released.append(user_id)
+        super().release(user_id)
+
+@pytest.fixture
+def store():
+    store = app.SessionStore(app.SESSION_STORE_CONFIG, app.conversation_manager, app.order_managers)
+    store.backend = RecordingBackend()
+    return store
+
+def test_session_released_with_last_socket(store):
+    store.bind('sid-1', 'user-a')
+    store.bind('sid-2', 'user-a')
+    store.bind('sid-3', 'user-b')
+
+    assert store.unbind('sid-1') == 'user-a'
+    assert store.backend.released == []
+    assert store.unbind('sid-2') == 'user-a'
+    assert store.backend.released == ['user-a']
+    assert store.unbind('sid-2') is None
+    assert store.backend.released == ['user-a']
+    assert store.stats()['sockets'] == 1
+
+def test_rehydrated_session_keeps_language_and_deltas(store):
+    user_id = str(uuid.uuid4())
+    conv_id, order_data, _ = app.conversation_manager.get_or_create_conversation(user_id)
+    session = store.new_session(conv_id, order_data, lang='en', deltas=True)
+    app.conversation_manager.save_session_settings(user_id, session['lang'], session['deltas'])
+    store.save(user_id, session)
+
+    store.backend.delete(user_id)   # desalojada
+    rehydrated = store.get(user_id)
+
+    assert rehydrated is not session
+    assert rehydrated['conversation_id'] == conv_id
+    assert rehydrated['lang'] == 'en'
+    assert rehydrated['deltas'] is True
@@ -0,0 +1,99 @@
+"""SMTPPool against a local aiosmtpd stand-in (pip install aiosmtpd pytest)"""
+import os
+import smtplib
+import socket
+import sys
+
+import pytest
+
+aiosmtpd_controller = pytest.importorskip('aiosmtpd.controller')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+os.makedirs('logs', exist_ok=True)
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+MESSAGE = b'Subject: pedido\r\n\r\nhola\r\n'
+
+class Handler:
+    def __init__(self):
+        self.sessions = 0
+        self.data_commands = 0
+        self.data_reply = '250 OK'
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        self.sessions += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.data_commands += 1
+        return self.data_reply
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+@pytest.fixture
+def server():
+    handler = Handler()
+    controller = aiosmtpd_controller.Controller(handler, hostname='127.0.0.1', port=free_port())
+    controller.start()
+    yield handler, controller
+    controller.stop()
+
+def make_pool(controller, **overrides):
+    config = dict(app.SMTP_CONFIG, host='127.0.0.1', port=controller.port, security='none',
+                  username='', timeout=5, checkout_timeout=5, **overrides)
+    return app.SMTPPool(config)
+
+def test_reuses_one_session(server):
+    handler, controller = server
+    pool = make_pool(controller)
+    for _ in range(5):
+        assert pool.send('a@example.com', ['b@example.com'], MESSAGE) == {}
+    assert handler.sessions == 1
+    assert handler.data_commands == 5
+    assert pool.stats()['sent'] == 5
+    pool.close()
+
+def test_reconnects_when_server_drops_session(server):
+    handler, controller = server
+    pool = make_pool(controller)
+    pool.send('a@example.com', ['b@example.com'], MESSAGE)
+    # La conexión de la sesión ociosa se corta (timeout o reinicio del servidor)
+    pool._idle[0][0].sock.shutdown(socket.SHUT_RDWR)
+    pool.send('a@example.com', ['b@example.com'], MESSAGE)
+    assert pool.stats()['reconnects'] == 1
+    assert handler.data_commands == 2
+    pool.close()
+
+def test_smtp_error_is_not_resent(server):
+    handler, controller = server
+    handler.data_reply = '554 Transaction failed'
+    pool = make_pool(controller)
+    with pytest.raises(smtplib.SMTPDataError):
+        pool.send('a@example.com', ['b@example.com'], MESSAGE)
+    assert handler.data_commands == 1
+    assert pool.stats()['reconnects'] == 0
+    assert pool.stats()['failed'] == 1
+    pool.close()
+
+def test_settings_change_replaces_open_sessions(server):
+    handler, controller = server
+    pool = make_pool(controller)
+    pool.send('a@example.com', ['b@example.com'], MESSAGE)
+    old_session = pool._idle[0][0]
+
+    settings = {'smtp_server': '127.0.0.1', 'smtp_port': controller.port, 'smtp_security': 'none',
+                'smtp_username': '', 'smtp_timeout': 10}
+    pool.on_settings_changed(settings, {'smtp_timeout'})
+    assert pool.config['timeout'] == 10
+    assert old_session.sock is None   # cerrada, no se reutiliza
+
+    pool.send('a@example.com', ['b@example.com'], MESSAGE)
+    assert handler.sessions == 2
+    pool.close()